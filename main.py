@@ -1,23 +1,66 @@
-from src.plot_data import plot_data
-from src.save_original_raw import save_original_raw
-from src.preprocessing import filter_data
-from src.preprocessing import rereference
-from src.preprocessing import remove_artifact
-from src.get_erp import create_epochs
-from src.get_erp import average_epochs
-from src.get_erp import create_grand_average
-from src.stats_test import compute_cluster_permutation
-
-from src.preprocessing import interpolate_bads
+from src.lazy import entry_point
+
+# Each module is imported when one of its steps is first called (a preprocessing run never loads the plotting code)
+plot_data = entry_point('src.plot_data', 'plot_data')
+create_qc_report = entry_point('src.qc_report', 'create_qc_report')
+create_topo_animations = entry_point('src.topo_animation', 'create_topo_animations')
+save_original_raw = entry_point('src.save_original_raw', 'save_original_raw')
+filter_data = entry_point('src.preprocessing', 'filter_data')
+rereference = entry_point('src.preprocessing', 'rereference')
+remove_artifact = entry_point('src.preprocessing', 'remove_artifact')
+create_epochs = entry_point('src.get_erp', 'create_epochs')
+average_epochs = entry_point('src.get_erp', 'average_epochs')
+create_grand_average = entry_point('src.get_erp', 'create_grand_average')
+compute_cluster_permutation = entry_point('src.stats_test', 'compute_cluster_permutation')
+run_pipeline = entry_point('src.pipeline', 'run_pipeline')
+check_precision = entry_point('src.pipeline', 'check_precision')
+run_scheduled = entry_point('src.scheduler', 'run_scheduled')
+set_precision = entry_point('src.precision', 'set_precision')
+build_session_store = entry_point('src.session_store', 'build_session_store')
+build_event_index = entry_point('src.event_index', 'build_event_index')
+compact_epochs_store = entry_point('src.epochs_store', 'compact_epochs_store')
+run_stream = entry_point('src.streaming', 'run_stream')
+decode_feedback = entry_point('src.decoding', 'decode_feedback')
+generate_dataset = entry_point('src.synthetic', 'generate_dataset')
+run_benchmark = entry_point('src.benchmark', 'run_benchmark')
+check_import_time = entry_point('src.benchmark', 'check_import_time')
+set_quiet = entry_point('src.metrics', 'set_quiet')
+print_metrics_summary = entry_point('src.metrics', 'print_metrics_summary')
+
+interpolate_bads = entry_point('src.preprocessing', 'interpolate_bads')
+detect_bad_channels = entry_point('src.bad_channels', 'detect_bad_channels')
 
 ###########################################################################################
 # Note: Please make sure you have the original csv data under data/allData 
 #       Once you make sure you have the original data, please run each step sequentially.
+#       Each per-session step takes n_jobs to spread the sessions over worker processes (-1 = all cores).
+#       Steps skip sessions whose inputs and parameters did not change since the last run (force=True reruns them).
 ###########################################################################################
 def main():
+    #-- Quiet mode: no array/info dumps or MNE info logging; every stage still writes its per-session records
+    #-- (time, CPU, peak memory, bytes read/written, samples, epochs kept/dropped) to data/metrics/run_<time>.jsonl
+    # set_quiet(True)
+
+    ##### -------------- Synthetic Data / Benchmark --------------
+    #-- Without the real recordings: write synthetic sessions and AllDataLabels.csv in the same layout under data/
+    # generate_dataset(n_subjects=2, n_sessions=5, n_feedback=60)
+    #-- Time every stage (wall time, CPU time, peak memory) on synthetic data at several scales, appended to data/benchmark/benchmark.csv
+    # run_benchmark(scales=[(1, 2, 30), (2, 5, 60), (5, 5, 60)])
+    #-- Import time of main and of the preprocessing/stats/plotting paths without a display; the preprocessing path must
+    #-- stay under 2 s and load no GUI backend (plot_data picks Agg and saves figures to data/figures when headless)
+    # check_import_time()
+
     ##### -------------- Load Data --------------
     #-- Save original csv data as raw files
-    # save_original_raw()
+    # save_original_raw()   # csv_engine='pyarrow' uses the multithreaded Arrow reader (reports rows/s for both engines)
+
+    #-- Optional: store every output in float32 instead of float64 (check_precision reports the deviation on one session first)
+    # check_precision(16, 2, low_freq=1, high_freq=40, n_components=20, random_state=97, max_iter=800)
+    # set_precision('single')
+
+    #-- Optional: parse the csv files once into the binary session store, then later steps can read it without parsing
+    # build_session_store()
+    # save_original_raw(source='store')   # and create_epochs(..., event_source='store')
     
     
     # for i in range(1, 26+1):   # Num Subjects
@@ -26,8 +69,17 @@ def main():
 
     # plot_data('original', "16", "02")
 
-    #-- Interpolate bad channel attempt not sure if it is working
-    # interpolate_bads()  // not in use
+    #-- QC report of every session without opening windows: original, original_vs_filtered, filtered_vs_cleaned and epochs
+    #-- views rendered to data/qc/*.png on all cores, browse them from data/qc/index.html
+    # create_qc_report(n_jobs=-1)
+
+    #-- Bad channels of every session from variance, deviation, neighbour correlation and high-frequency noise, written to
+    #-- data/badChannels/bad_channels.csv (rereference runs it itself: channels bad in half of the sessions are dropped
+    #-- everywhere, the others are interpolated in the sessions that flag them)
+    # detect_bad_channels(z_threshold=5.0, correlation_threshold=0.4)
+
+    #-- Interpolate all detected bad channels of each session into data/preprocessed/interpolated
+    # interpolate_bads()
 
     ##### -------------- Data Preprocessing --------------
     
@@ -37,6 +89,8 @@ def main():
     
     #-- 2. Filter Data by bandpass filters and save data as filtered raw files
     # filter_data(low_freq=1, high_freq=40)
+    #-- Zero-phase Butterworth instead of the long FIR kernel (cheaper, slightly different response)
+    # filter_data(low_freq=1, high_freq=40, method='iir')
 
     #-- Plot Original vs Filtered Data
     subject = "16"
@@ -45,6 +99,16 @@ def main():
 
     #-- 3. Remove Arti1facts using ICA and save data as cleaned raw files
     # remove_artifact(n_components=20, random_state=97, max_iter=800)
+    #-- Fitted ICAs are kept in data/ica: changing only the EOG threshold or excluded components reuses them
+    # remove_artifact(n_components=20, random_state=97, max_iter=800, eog_threshold=2.5, exclude={'S16_Sess02': [1]})
+    #-- One ICA per subject on its decimated, concatenated sessions; compared with the per-session ICAs in data/ica/subject_vs_session.csv
+    # remove_artifact(n_components=20, random_state=97, max_iter=800, mode='subject', decim=4)
+
+    #-- Low-memory mode: sessions are never loaded whole, each stage streams them in 10 s chunks from file to file
+    #   (FIR filter only; the ICA is fitted and the EOG components scored on every 4th sample)
+    # rereference("data/originalRaw", "raw", chunk_sec=10)
+    # filter_data(low_freq=1, high_freq=40, chunk_sec=10)
+    # remove_artifact(n_components=20, random_state=97, max_iter=800, chunk_sec=10, decim=4)
 
     #-- Plot Filtered vs Cleaned Data
     subject = "16"
@@ -52,6 +116,16 @@ def main():
     # plot_data("filtered_vs_cleaned", subject, session)
     
 
+    #-- 1-3 + epochs in one pass: carries each session through rereference, filter, ICA and epoching in memory
+    #   (add e.g. save_stages=['filter', 'ica'] to also write those intermediates for plotting)
+    # run_pipeline(low_freq=1, high_freq=40, n_components=20, random_state=97, max_iter=800, sfreq=200)
+
+    #-- Load Data + 1-3 + epochs as a per-session task graph: sessions overlap across stages (one in ICA while the next is
+    #   filtered and the one after is read ahead), writes the same files as the separate steps. Finished (stage, session)
+    #   pairs go to data/scheduler/checkpoint.jsonl, so rerunning after a crash resumes where it stopped (resume=False starts over)
+    # run_scheduled(low_freq=1, high_freq=40, n_components=20, random_state=97, max_iter=800, sfreq=200, n_jobs=-1)
+
+
     ##### -------------- Epoch Cleaned Data --------------
     # preprocessed_dir = 'data/preprocessed/interpolated'
     # # identifier_fname = 'interpolated_raw'
@@ -67,6 +141,14 @@ def main():
     
     # create_epochs(preprocessed_dir, identifier_fname, sfreq=200)
 
+    #-- Faster: join the feedback labels with the event times once (also reports sessions whose label/event counts disagree)
+    # build_event_index(sfreq=200)
+    # create_epochs(preprocessed_dir, identifier_fname, sfreq=200, event_source='index')
+
+    #-- Rerunning sessions leaves their old rows in data/epochsStore/epochs.dat; create_epochs compacts the store once they
+    #-- pass a quarter of it, this drops them right away
+    # compact_epochs_store()
+
     #-- Plot Epochs
     subject = "16"
     session = "02"
@@ -75,7 +157,7 @@ def main():
     
     ##### -------------- Compute Grand Average --------------
     #-- Averages the epochs in each session by event types, then averages all evoked objects to get the grand average
-    # create_grand_average()  #-- Also saves the evoked objects for each subject in raw file 
+    # create_grand_average()  #-- Also saves the correct/incorrect evoked objects of each session to data/evoked
     
     #-- Plot Grand Average as ERP waveform
     # plot_data("grand_average")
@@ -85,11 +167,32 @@ def main():
     #-- Get Peaks and plot topomaps of amplitude at peaks
     # plot_data("peaks")
 
+    #-- Cluster permutation test over sensors and time, permutations spread over 8 workers; early_stop=True ends the
+    #-- test once every cluster p-value is clearly above or below 0.05
+    # compute_cluster_permutation(p_threshold=0.05, n_permutations=1000, n_jobs=8)
+
     #-- Conduct Permutation Cluster Test and Plot Cluster Map and Create Topomap movie of significant timepoints
     # plot_data("cluster_permutation")
 
+    #-- Single-trial decoding of correct vs incorrect feedback (features='spatial' for xDAWN-like filters, cv='loso' leaves one subject out)
+    # decode_feedback(features='amplitude', cv=5, n_jobs=-1)
+    # decode_feedback(features='spatial', cv='loso', n_jobs=-1)
+
     #-- Create Topomap movie at statistically important times
+    #-- Scalp map movies over all epoch samples (grand average difference, T-values and one difference movie per subject)
+    #-- in data/animations, one interpolation matrix for all frames, streamed to ffmpeg
+    # create_topo_animations(size=512, fps=10, n_jobs=-1)
+
+
+    ##### -------------- Live Analysis --------------
+    #-- Replay a recorded session as a live stream (realtime=True paces it at 200 Hz); prints the latency of every feedback epoch
+    # run_stream(16, 2, source='replay', low_freq=1, high_freq=40, realtime=True)
+    #-- Same through a local socket: run streaming.serve_session(16, 2) in another process first
+    # run_stream(16, 2, source='socket')
+
 
+    #-- Table of the stage records of this run
+    # print_metrics_summary()
 
     print("main function called")
 
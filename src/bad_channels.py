@@ -0,0 +1,175 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import signal
+import mne
+
+from src.save_original_raw import channel_names, channel_types, sampling_rate, original_raw_dir
+from src.session_executor import session_grid
+from src.stage_cache import is_fresh, record_output
+from src.metrics import measured_stage
+
+
+# Data-driven bad channels instead of hardcoded lists. Every EEG channel of every session gets four statistics from one
+# read of the session (binary session store when it exists, else the original Raw files):
+#   variance               of the 1-40 Hz signal
+#   deviation              robust amplitude (interquartile range / 1.349) of the 1-40 Hz signal
+#   neighbour_correlation  median correlation of the 1-40 Hz signal with the neighbouring channels
+#   noise_ratio            robust amplitude above 40 Hz / robust amplitude of the 1-40 Hz signal
+# The statistics are computed one session at a time, all channels at once: the filtered copies of every recording
+# together would take several GB. Variance, deviation and noise are then turned into robust z-scores across the
+# channels of the session (median / MAD), all sessions in one array operation. Channels bad in at least drop_fraction of the sessions are dropped from every session
+# (so all sessions keep the same channel set); the remaining bad channels are interpolated in the sessions that flag them.
+bad_channels_dir = 'data/badChannels'
+bad_channels_path = f"{bad_channels_dir}/bad_channels.csv"
+eeg_names = [name for name, ch_type in zip(channel_names, channel_types) if ch_type == 'eeg']
+
+
+def channel_neighbours():
+    # (n_eeg, n_eeg) bool matrix of the montage neighbours of every EEG channel (itself excluded)
+    info = mne.create_info(eeg_names, sampling_rate, 'eeg')
+    info.set_montage('standard_1020')
+    adjacency, names = mne.channels.find_ch_adjacency(info, ch_type='eeg')
+    order = [names.index(name) for name in eeg_names]
+    neighbours = adjacency.toarray()[np.ix_(order, order)].astype(bool)
+    np.fill_diagonal(neighbours, False)
+    return neighbours
+
+
+def channel_statistics(data, sfreq, neighbours, band=(1.0, 40.0)):
+    # Statistics of every row of data (n_channels, n_samples, volts), see the top of the file
+    band_sos = signal.butter(4, band, btype='bandpass', fs=sfreq, output='sos')
+    high_sos = signal.butter(4, band[1], btype='highpass', fs=sfreq, output='sos')
+    band_passed = signal.sosfiltfilt(band_sos, data, axis=1)
+    high_passed = signal.sosfiltfilt(high_sos, data, axis=1)
+
+    q75, q25 = np.percentile(band_passed, [75, 25], axis=1)
+    deviation = (q75 - q25) / 1.349
+    high_q75, high_q25 = np.percentile(high_passed, [75, 25], axis=1)
+    noise_ratio = (high_q75 - high_q25) / 1.349 / np.maximum(deviation, np.finfo(float).tiny)
+
+    correlation = np.corrcoef(band_passed)
+    masked = np.where(neighbours, correlation, np.nan)
+    neighbour_correlation = np.nanmedian(masked, axis=1)
+
+    return dict(variance=band_passed.var(axis=1), deviation=deviation, neighbour_correlation=neighbour_correlation, noise_ratio=noise_ratio)
+
+
+def robust_z(values):
+    # z-scores of every row of values (n_sessions, n_channels) against its median and MAD
+    median = np.median(values, axis=1, keepdims=True)
+    mad = 1.4826 * np.median(np.abs(values - median), axis=1, keepdims=True)
+    return (values - median) / np.maximum(mad, np.finfo(float).tiny)
+
+
+def _session_inputs(source):
+    # [(subject, session, loader)] plus the input files for the stage cache
+    if source == 'store':
+        from src.session_store import open_session_store, load_session, session_store_dir
+
+        index = open_session_store()
+        sessions = [(i, j) for i, j in session_grid() if f"S{i:02d}_Sess{j:02d}" in index['sessions']]
+        loaders = [(i, j, lambda i=i, j=j: np.asarray(load_session(i, j, channels=eeg_names, index=index), dtype=np.float64)) for i, j in sessions]
+        return loaders, [f"{session_store_dir}/index.json"]
+
+    paths = {(i, j): f"{original_raw_dir}/Data_S{i:02d}_Sess{j:02d}_raw.fif" for i, j in session_grid()}
+    paths = {key: path for key, path in paths.items() if os.path.exists(path)}
+    loaders = [(i, j, lambda path=path: mne.io.read_raw_fif(path, preload=False, verbose='error').get_data(picks=eeg_names))
+               for (i, j), path in paths.items()]
+    return loaders, list(paths.values())
+
+
+@measured_stage
+def detect_bad_channels(source='auto', z_threshold=5.0, correlation_threshold=0.4, drop_fraction=0.5, force=False):
+    ##################################################################
+    #        Bad channel table of every session (one read each)
+    ##################################################################
+    # source: 'store' (session_store), 'raw' (data/originalRaw) or 'auto' (the store when it was built)
+    if source == 'auto':
+        from src.session_store import open_session_store
+        source = 'store' if open_session_store() is not None else 'raw'
+    if source not in ('store', 'raw'):
+        raise ValueError(f"Unknown source '{source}', expected 'store', 'raw' or 'auto'")
+
+    if not os.path.exists(bad_channels_dir):
+        os.makedirs(bad_channels_dir)
+
+    loaders, input_paths = _session_inputs(source)
+    params = dict(source=source, z_threshold=z_threshold, correlation_threshold=correlation_threshold, drop_fraction=drop_fraction,
+                  band=(1.0, 40.0))
+    if not force and is_fresh(bad_channels_path, 'detect_bad_channels', input_paths, params):
+        print(f"Up to date, skipping {bad_channels_path}")
+        return load_bad_channels()
+    if not loaders:
+        print(f"No sessions found to detect bad channels ({source})")
+        return None
+
+    neighbours = channel_neighbours()
+    statistics = {name: np.empty((len(loaders), len(eeg_names))) for name in ('variance', 'deviation', 'neighbour_correlation', 'noise_ratio')}
+    for k, (subject, session, load) in enumerate(loaders):
+        session_statistics = channel_statistics(load(), sampling_rate, neighbours)
+        for name, values in session_statistics.items():
+            statistics[name][k] = values
+        print(f"S{subject:02d} Sess{session:02d}: statistics of {len(eeg_names)} channels")
+
+    # All sessions at once: (n_sessions, n_channels) scores and flags
+    tiny = np.finfo(float).tiny
+    scores = dict(variance_z=robust_z(np.log(np.maximum(statistics['variance'], tiny))),
+                  deviation_z=robust_z(np.log(np.maximum(statistics['deviation'], tiny))),
+                  noise_z=robust_z(statistics['noise_ratio']))
+    flags = dict(variance=np.abs(scores['variance_z']) > z_threshold,
+                 deviation=np.abs(scores['deviation_z']) > z_threshold,
+                 correlation=statistics['neighbour_correlation'] < correlation_threshold,
+                 noise=scores['noise_z'] > z_threshold)
+    bad = np.any(list(flags.values()), axis=0)
+    dropped = bad.mean(axis=0) >= drop_fraction
+
+    sessions = np.array([(subject, session) for subject, session, _ in loaders])
+    table = pd.DataFrame({
+        'subject': np.repeat(sessions[:, 0], len(eeg_names)),
+        'session': np.repeat(sessions[:, 1], len(eeg_names)),
+        'channel': np.tile(eeg_names, len(loaders)),
+        **{name: values.ravel() for name, values in statistics.items()},
+        **{name: values.ravel() for name, values in scores.items()},
+        'bad': bad.ravel(),
+        'reasons': [' '.join(name for name, flag in flags.items() if flag.flat[k]) for k in range(bad.size)],
+    })
+    table['action'] = np.where(np.tile(dropped, len(loaders)), 'drop', np.where(table['bad'], 'interpolate', ''))
+    table.to_csv(bad_channels_path, index=False)
+    record_output(bad_channels_path, 'detect_bad_channels', input_paths, params)
+
+    print(f"---------------- Bad channels ({bad.sum()} of {bad.size} session channels) ----------------")
+    print(f"Dropped from every session: {[name for name, drop in zip(eeg_names, dropped) if drop]}")
+    per_session = table[table['action'] == 'interpolate'].groupby(['subject', 'session'])['channel'].apply(list)
+    print(f"Interpolated: {len(per_session)} sessions, {int((table['action'] == 'interpolate').sum())} channels")
+    return table
+
+
+def _detect_bad_channels_task(_subject, _session, **kwargs):
+    # detect_bad_channels as a task of the scheduler's graph (it needs every session, so it runs once for all)
+    table = detect_bad_channels(**kwargs)
+    return 'skipped' if table is None else 'ok'
+
+
+def load_bad_channels(path=bad_channels_path):
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, keep_default_na=False)
+
+
+def dropped_channels(table=None):
+    # Channels dropped from every session; empty (with a note) when detect_bad_channels has not been run
+    table = load_bad_channels() if table is None else table
+    if table is None:
+        print(f"No bad channel table at {bad_channels_path}, run detect_bad_channels() first")
+        return []
+    return [name for name in eeg_names if name in set(table.loc[table['action'] == 'drop', 'channel'])]
+
+
+def session_bad_channels(subject, session, table=None):
+    # (channels dropped from every session, channels to interpolate in this one)
+    table = load_bad_channels() if table is None else table
+    if table is None:
+        raise FileNotFoundError(f"No bad channel table at {bad_channels_path}, run detect_bad_channels() first")
+    rows = table[(table['subject'] == subject) & (table['session'] == session)]
+    return dropped_channels(table), list(rows.loc[rows['action'] == 'interpolate', 'channel'])
@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import pandas as pd
+
+
+# Times the pipeline stages on synthetic data (see synthetic.py) at several scales. Every stage runs in its own Python
+# process inside a scratch directory holding the data/ tree, so its wall time and peak memory are measured in isolation.
+benchmark_dir = 'data/benchmark'
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (subjects, sessions per subject, feedback events per session)
+default_scales = [(1, 2, 30), (2, 5, 60), (5, 5, 60)]
+
+# Stage name, module, function, keyword arguments; run in this order since each consumes the previous outputs
+stages = [
+    ('save_original_raw', 'src.save_original_raw', 'save_original_raw', {}),
+    ('rereference', 'src.preprocessing', 'rereference', dict(original_dir='data/originalRaw', identifier='raw')),
+    ('filter_data', 'src.preprocessing', 'filter_data', dict(low_freq=1, high_freq=40)),
+    ('remove_artifact', 'src.preprocessing', 'remove_artifact', dict(n_components=20, random_state=97, max_iter=800)),
+    ('create_epochs', 'src.get_erp', 'create_epochs', dict(preprocessed_dir='data/preprocessed/artifactRemoved', identifier_fname='cleaned_raw', sfreq=200)),
+    ('create_grand_average', 'src.get_erp', 'create_grand_average', {}),
+    ('compute_cluster_permutation', 'src.stats_test', 'compute_cluster_permutation', dict(n_permutations=200)),
+]
+
+# Run inside the stage process: call the stage, then print its own measurements as the last line
+_stage_runner = """
+import sys, json, time, resource, importlib
+sys.path.insert(0, {repo_dir!r})
+module = importlib.import_module({module!r})
+start, cpu_start = time.perf_counter(), time.process_time()
+getattr(module, {function!r})(**json.loads({kwargs!r}))
+wall = time.perf_counter() - start
+self_usage, children_usage = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+print('BENCHMARK ' + json.dumps(dict(wall_time=wall, cpu_time=time.process_time() - cpu_start + children_usage.ru_utime + children_usage.ru_stime,
+                                     peak_rss_mb=max(self_usage.ru_maxrss, children_usage.ru_maxrss) / 1024)))
+"""
+
+
+# Import paths measured by check_import_time: what a step imports on top of main before it runs.
+# The preprocessing path must stay within import_budget seconds and must not load a GUI backend or pyplot.
+import_paths = {
+    'main': ['main'],
+    'preprocessing': ['main', 'src.preprocessing'],
+    'stats': ['main', 'src.stats_test'],
+    'plotting': ['main', 'src.plot_data'],
+}
+import_budget = 2.0
+gui_modules = ('matplotlib.pyplot', 'tkinter')
+
+# Run in a fresh process: import the modules of one path, print the time and which GUI modules got loaded
+_import_runner = """
+import sys, json, time, importlib
+sys.path.insert(0, {repo_dir!r})
+start = time.perf_counter()
+for module in {modules!r}:
+    importlib.import_module(module)
+print('BENCHMARK ' + json.dumps(dict(import_time=time.perf_counter() - start, gui_modules=[name for name in {gui_modules!r} if name in sys.modules])))
+"""
+
+
+def run_stage(stage_name, module, function, kwargs, work_dir, n_jobs=None):
+    # Run one stage in a fresh process with work_dir as working directory, returns its measurements
+    if n_jobs is not None and stage_name != 'create_grand_average':
+        kwargs = dict(kwargs, n_jobs=n_jobs)
+    code = _stage_runner.format(repo_dir=repo_dir, module=module, function=function, kwargs=json.dumps(kwargs))
+
+    env = dict(os.environ, MPLBACKEND='Agg')
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', code], cwd=work_dir, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+
+    lines = [line for line in completed.stdout.splitlines() if line.startswith('BENCHMARK ')]
+    if completed.returncode != 0 or not lines:
+        print(completed.stdout[-2000:])
+        print(completed.stderr[-2000:])
+        return dict(stage=stage_name, status='error', process_time=elapsed)
+    return dict(stage=stage_name, status='ok', process_time=elapsed, **json.loads(lines[-1][len('BENCHMARK '):]))
+
+
+def run_benchmark(scales=None, n_jobs=None, keep_data=False, output_path=f"{benchmark_dir}/benchmark.csv"):
+    ##################################################################
+    #       Time every stage on synthetic data at several scales
+    ##################################################################
+    # Appends one row per (scale, stage) to output_path: wall time, CPU time and peak RSS of the stage process
+    from src.synthetic import generate_dataset
+
+    rows = []
+    for n_subjects, n_sessions, n_feedback in scales or default_scales:
+        work_dir = tempfile.mkdtemp(prefix='p300_benchmark_')
+        try:
+            print(f"---------------- Scale: {n_subjects} subjects x {n_sessions} sessions x {n_feedback} feedback events ----------------")
+            generate_dataset(n_subjects, n_sessions, n_feedback, root=work_dir)
+            data_mb = sum(os.path.getsize(os.path.join(directory, name)) for directory, _, names in os.walk(os.path.join(work_dir, 'data'))
+                          for name in names) / 1e6
+
+            for stage_name, module, function, kwargs in stages:
+                result = run_stage(stage_name, module, function, kwargs, work_dir, n_jobs)
+                result.update(n_subjects=n_subjects, n_sessions=n_sessions, n_feedback=n_feedback, input_mb=data_mb, n_jobs=n_jobs or 1)
+                rows.append(result)
+                print(f"{stage_name}: {result['status']}, wall {result.get('wall_time', float('nan')):.1f} s, "
+                      f"peak RSS {result.get('peak_rss_mb', float('nan')):.0f} MB")
+        finally:
+            if keep_data:
+                print(f"Kept benchmark data in {work_dir}")
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = pd.DataFrame(rows)
+    if not os.path.exists(benchmark_dir):
+        os.makedirs(benchmark_dir)
+    results.assign(timestamp=pd.Timestamp.now().isoformat(timespec='seconds')).to_csv(
+        output_path, mode='a', header=not os.path.exists(output_path), index=False)
+
+    print("---------------- Benchmark ----------------")
+    print(results.pivot_table(index='stage', columns=['n_subjects', 'n_sessions'], values='wall_time', sort=False).to_string(float_format='%.1f'))
+    return results
+
+
+def check_import_time(repeats=5, budget=import_budget, output_path=f"{benchmark_dir}/import_time.csv"):
+    ##################################################################
+    #      Import time of each entry path on a headless machine
+    ##################################################################
+    # Every path is imported repeats times in a fresh process without DISPLAY (best time kept, the first runs pay
+    # for cold caches). Returns True when the preprocessing path is within budget and loads no GUI modules.
+    env = {name: value for name, value in os.environ.items() if name not in ('DISPLAY', 'WAYLAND_DISPLAY', 'MPLBACKEND')}
+
+    rows = []
+    for path_name, modules in import_paths.items():
+        code = _import_runner.format(repo_dir=repo_dir, modules=modules, gui_modules=gui_modules)
+        runs = []
+        for _ in range(repeats):
+            completed = subprocess.run([sys.executable, '-c', code], cwd=repo_dir, env=env, capture_output=True, text=True)
+            lines = [line for line in completed.stdout.splitlines() if line.startswith('BENCHMARK ')]
+            if completed.returncode != 0 or not lines:
+                print(completed.stderr[-2000:])
+                break
+            runs.append(json.loads(lines[-1][len('BENCHMARK '):]))
+        if not runs:
+            rows.append(dict(path=path_name, status='error'))
+            continue
+        rows.append(dict(path=path_name, status='ok', import_time=min(run['import_time'] for run in runs),
+                         gui_modules=' '.join(runs[0]['gui_modules'])))
+
+    results = pd.DataFrame(rows)
+    if not os.path.exists(benchmark_dir):
+        os.makedirs(benchmark_dir)
+    results.assign(timestamp=pd.Timestamp.now().isoformat(timespec='seconds')).to_csv(
+        output_path, mode='a', header=not os.path.exists(output_path), index=False)
+
+    print("---------------- Import time (headless) ----------------")
+    print(results.to_string(index=False, float_format='%.2f'))
+
+    preprocessing = rows[list(import_paths).index('preprocessing')]
+    within_budget = (preprocessing['status'] == 'ok' and preprocessing['import_time'] <= budget and not preprocessing['gui_modules'])
+    if within_budget:
+        print(f"Preprocessing imports within budget ({preprocessing['import_time']:.2f} s <= {budget:.2f} s, no GUI modules)")
+    else:
+        print(f"Preprocessing imports OVER budget ({budget:.2f} s, no GUI modules allowed): {preprocessing}")
+    return within_budget
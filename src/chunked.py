@@ -0,0 +1,224 @@
+import os
+import numpy as np
+from scipy import signal
+import mne
+
+from src.stage_cache import is_fresh, record_output
+from src.precision import fif_fmt
+from src.filter_engine import fir_kernel
+from src import metrics
+
+
+# Chunked execution of rereference, filter_data and remove_artifact (chunk_sec=... on those stages). Sessions are opened
+# without preload and written through a ChunkedRaw: Raw.save reads buffer_size_sec of it at a time and each read computes
+# just that chunk from the input file, so a worker holds a few chunks instead of two copies of the whole recording.
+#   rereference  drops the bad channels and adds the average reference projector, the samples are copied through
+#                (the session's interpolated channels are computed chunk by chunk, interpolation is instantaneous)
+#   filter       FIR chunks read (len(kernel) - 1) / 2 extra samples on each side, mirrored at the recording edges like
+#                filter_engine, so the output matches the in-memory filter
+#   ICA          applied chunk by chunk (it is instantaneous); the fit and the EOG scoring see every decim-th sample,
+#                the only part whose memory grows with the recording (by 1/decim)
+
+
+class ChunkedRaw(mne.io.BaseRaw):
+    # A non-preloaded Raw whose samples are transform(source, start, stop), an (n_channels, stop - start) block computed
+    # from the non-preloaded source when it is read
+    def __init__(self, source, transform, info=None):
+        self._source = source
+        self._transform = transform
+        super().__init__((info or source.info).copy(), preload=False, first_samps=[source.first_samp], last_samps=[source.last_samp],
+                         filenames=[None], raw_extras=[dict()], orig_format='double', verbose='error')
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        # Same contract as the file readers: the block comes back uncalibrated, then cals/mult are applied as MNE does
+        one = self._transform(self._source, start, stop) / self._cals[:, np.newaxis]
+        if mult is not None:
+            data[:] = mult @ one[idx]
+        else:
+            data[:] = one[idx]
+            data *= cals
+
+
+def chunk_samples(raw, chunk_sec, multiple_of=1):
+    n_samples = max(int(round(chunk_sec * raw.info['sfreq'])), multiple_of)
+    return n_samples - n_samples % multiple_of
+
+
+def save_chunked(raw, output_path, chunk_sec):
+    raw.save(output_path, fmt=fif_fmt(), buffer_size_sec=chunk_sec, overwrite=True)
+
+
+def fir_transform(kernel, picks):
+    # Zero-phase FIR of the picked channels of [start, stop), reading half a kernel of context on each side
+    delay = (len(kernel) - 1) // 2
+
+    def transform(source, start, stop):
+        lo, hi = max(start - delay, 0), min(stop + delay, source.n_times)
+        segment = source.get_data(start=lo, stop=hi)
+        extended = segment[picks]
+        missing_left, missing_right = delay - (start - lo), delay - (hi - stop)
+        if missing_left:
+            extended = np.concatenate([2 * extended[:, :1] - extended[:, missing_left:0:-1], extended], axis=1)
+        if missing_right:
+            extended = np.concatenate([extended, 2 * extended[:, -1:] - extended[:, -2:-missing_right - 2:-1]], axis=1)
+        block = segment[:, start - lo:stop - lo]
+        block[picks] = signal.oaconvolve(extended, kernel[None, :], mode='valid', axes=1)
+        return block
+
+    return transform
+
+
+def interpolation_transform(info):
+    # Channels marked bad in info interpolated from the others, chunk by chunk
+    def transform(source, start, stop):
+        chunk = mne.io.RawArray(source.get_data(start=start, stop=stop), info, verbose='error')
+        return chunk.interpolate_bads(reset_bads=True, verbose='error').get_data()
+
+    return transform
+
+
+def ica_transform(ica, info):
+    def transform(source, start, stop):
+        chunk = mne.io.RawArray(source.get_data(start=start, stop=stop), info, verbose='error')
+        return ica.apply(chunk, verbose='error').get_data()
+
+    return transform
+
+
+def read_decimated(raw, decim, chunk_sec):
+    # Every decim-th sample of a non-preloaded Raw as a RawArray (sfreq / decim), read chunk by chunk
+    n_chunk = chunk_samples(raw, chunk_sec, multiple_of=decim)
+    data = np.empty((len(raw.ch_names), (raw.n_times + decim - 1) // decim))
+    for start in range(0, raw.n_times, n_chunk):
+        stop = min(start + n_chunk, raw.n_times)
+        data[:, start // decim:(stop + decim - 1) // decim] = raw.get_data(start=start, stop=stop)[:, ::decim]
+
+    info = raw.info.copy()
+    with info._unlock():
+        info['sfreq'] = raw.info['sfreq'] / decim
+        if info['lowpass'] is not None:
+            info['lowpass'] = min(info['lowpass'], info['sfreq'] / 2)
+    return mne.io.RawArray(data, info, verbose='error')
+
+
+def _rereference_session_chunked(subject, session, original_dir, identifier, chunk_sec, table=None, force=False):
+    from src.preprocessing import referenced_dir
+    from src.bad_channels import session_bad_channels
+
+    file_path = f"{original_dir}/Data_S{subject:02d}_Sess{session:02d}_{identifier}.fif"
+    output_file_path = f"{referenced_dir}/Data_S{subject:02d}_Sess{session:02d}_referenced_raw.fif"
+    print(file_path)
+
+    if not os.path.exists(file_path):
+        print(f"Missing file for Subject {subject}, Session {session}.")
+        return 'skipped'
+
+    dropped, interpolated = session_bad_channels(subject, session, table)
+    params = dict(bads=dropped, interpolated=interpolated, reference='average', precision=fif_fmt())
+    if not force and is_fresh(output_file_path, 'rereference', [file_path], params):
+        print(f"Up to date, skipping {output_file_path}")
+        return 'cached'
+
+    # Dropping channels and adding a projector only touch the info, the samples stream from file to file
+    raw = mne.io.read_raw_fif(file_path, preload=False)
+    raw.drop_channels(ch_names=[name for name in dropped if name in raw.ch_names])
+    interpolated = [name for name in interpolated if name in raw.ch_names]
+    if interpolated:
+        raw.info['bads'] = interpolated
+        output = ChunkedRaw(raw, interpolation_transform(raw.info.copy()))
+        output.info['bads'] = []
+    else:
+        output = raw
+    output.set_eeg_reference('average', projection=True)
+    metrics.add(samples=raw.n_times)
+    save_chunked(output, output_file_path, chunk_sec)
+    record_output(output_file_path, 'rereference', [file_path], params)
+    print(f"=========================> Saved average referenced data to {output_file_path} ({chunk_sec} s chunks)")
+
+
+def _filter_session_chunked(subject, session, low_freq, high_freq, chunk_sec, method='fir', force=False):
+    from src.preprocessing import referenced_dir, filtered_dir
+
+    if method != 'fir':
+        # The forward-backward IIR pass needs the whole recording at once
+        raise ValueError("Chunked filtering supports method='fir' only")
+
+    file_path = f"{referenced_dir}/Data_S{subject:02d}_Sess{session:02d}_referenced_raw.fif"
+    output_file_path = f"{filtered_dir}/Data_S{subject:02d}_Sess{session:02d}_filtered_raw.fif"
+    print(file_path)
+
+    if not os.path.exists(file_path):
+        print(f"Missing file for Subject {subject}, Session {session}.")
+        return 'skipped'
+
+    params = dict(low_freq=low_freq, high_freq=high_freq, method=method, precision=fif_fmt())
+    if not force and is_fresh(output_file_path, 'filter_data', [file_path], params):
+        print(f"Up to date, skipping {output_file_path}")
+        return 'cached'
+
+    raw = mne.io.read_raw_fif(file_path, preload=False)
+    kernel = fir_kernel(raw.info['sfreq'], low_freq, high_freq)
+    if raw.n_times <= len(kernel):
+        raise ValueError(f"{file_path} is shorter than the {len(kernel)} sample filter kernel, filter it without chunk_sec")
+
+    info = raw.info.copy()
+    info.set_montage(mne.channels.make_standard_montage('standard_1020'))
+    with info._unlock():
+        if info['highpass'] is None or low_freq > info['highpass']:
+            info['highpass'] = float(low_freq)
+        if info['lowpass'] is None or high_freq < info['lowpass']:
+            info['lowpass'] = float(high_freq)
+
+    picks = mne.pick_types(raw.info, eeg=True, exclude=[])
+    metrics.add(samples=raw.n_times)
+    save_chunked(ChunkedRaw(raw, fir_transform(kernel, picks), info), output_file_path, chunk_sec)
+    record_output(output_file_path, 'filter_data', [file_path], params)
+    print(f"=========================> Saved filtered data to {output_file_path} ({chunk_sec} s chunks)")
+
+
+def _remove_artifact_session_chunked(subject, session, n_components, random_state, max_iter, chunk_sec, decim=4, eog_threshold=3.0,
+                                    exclude=None, warm_start=True, force=False):
+    from src.preprocessing import filtered_dir, cleaned_dir, ica_path, fit_ica, _previous_subject_ica, warm_start_unmixing
+
+    file_path = f"{filtered_dir}/Data_S{subject:02d}_Sess{session:02d}_filtered_raw.fif"
+    cleaned_file_path = f"{cleaned_dir}/Data_S{subject:02d}_Sess{session:02d}_cleaned_raw.fif"
+    print(file_path)
+
+    if not os.path.exists(file_path):
+        print(f"Missing file for Subject {subject}, Session {session}.")
+        return 'skipped'
+
+    # A fit on every decim-th sample is a different decomposition than the full-data fit, so decim is part of its key
+    ica_params = dict(n_components=n_components, random_state=random_state, max_iter=max_iter, method='fastica')
+    if decim > 1:
+        ica_params['decim'] = decim
+    session_exclude = list((exclude or {}).get(f"S{subject:02d}_Sess{session:02d}", []))
+    params = dict(ica_params, eog_threshold=eog_threshold, exclude=session_exclude, precision=fif_fmt())
+    if not force and is_fresh(cleaned_file_path, 'remove_artifact', [file_path], params):
+        print(f"Up to date, skipping {cleaned_file_path}")
+        return 'cached'
+
+    raw = mne.io.read_raw_fif(file_path, preload=False)
+    metrics.add(samples=raw.n_times)
+    decimated = read_decimated(raw, decim, chunk_sec)
+
+    session_ica_path = ica_path(subject, session)
+    if not force and is_fresh(session_ica_path, 'fit_ica', [file_path], ica_params):
+        print(f"Reusing fitted ICA {session_ica_path}")
+        ica = mne.preprocessing.read_ica(session_ica_path)
+    else:
+        previous_ica = _previous_subject_ica(subject, session, n_components) if warm_start else None
+        w_init = warm_start_unmixing(previous_ica, decimated) if previous_ica is not None else None
+        ica = fit_ica(decimated, n_components, random_state, max_iter, w_init=w_init)
+        ica.save(session_ica_path, overwrite=True)
+        record_output(session_ica_path, 'fit_ica', [file_path], ica_params)
+
+    eog_indices, _ = ica.find_bads_eog(decimated, ch_name='EOG', threshold=eog_threshold)
+    print('--------------------- EOG Indices ---------------------')
+    print(eog_indices)
+    ica.exclude = sorted(set(eog_indices) | set(session_exclude))
+    del decimated
+
+    save_chunked(ChunkedRaw(raw, ica_transform(ica, raw.info)), cleaned_file_path, chunk_sec)
+    record_output(cleaned_file_path, 'remove_artifact', [file_path], params)
+    print(f"=====================================> Processed and saved cleaned data to {cleaned_file_path} ({chunk_sec} s chunks)")
@@ -0,0 +1,175 @@
+import os
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse, stats
+from scipy.sparse.csgraph import connected_components
+import mne
+
+from src.session_executor import resolve_n_jobs
+
+
+# Two-condition spatio-temporal cluster permutation test (F statistic, upper tail, like mne's permutation_cluster_test
+# defaults), built for the pooled trials of all sessions:
+#   - clusters grow over neighbouring sensors (standard_1020 positions) as well as neighbouring time points
+#   - the cluster-forming threshold is given as a p-value and converted to the matching F value
+#   - permutations run in chunks of chunk_size across worker processes, the data is shared through a memory-mapped file
+#   - optional sequential stopping once every cluster p-value is confidently above or below alpha
+
+
+def channel_adjacency(info):
+    # (n_channels, n_channels) sparse adjacency of all channels in info. EEG neighbours come from the montage positions,
+    # non-EEG channels (EOG) only neighbour themselves.
+    eeg_adjacency, eeg_names = mne.channels.find_ch_adjacency(info, ch_type='eeg')
+    positions = [info['ch_names'].index(name) for name in eeg_names]
+    eeg_adjacency = sparse.coo_matrix(eeg_adjacency)
+
+    n_channels = len(info['ch_names'])
+    rows = np.concatenate([np.array(positions)[eeg_adjacency.row], np.arange(n_channels)])
+    cols = np.concatenate([np.array(positions)[eeg_adjacency.col], np.arange(n_channels)])
+    adjacency = sparse.coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n_channels, n_channels))
+    return adjacency.tocsr()
+
+
+def feature_adjacency(ch_adjacency, n_times):
+    # Adjacency of the flattened (n_channels * n_times) features, feature index = channel * n_times + time
+    time_adjacency = sparse.diags([np.ones(n_times - 1), np.ones(n_times - 1)], [-1, 1], shape=(n_times, n_times))
+    adjacency = sparse.kron(ch_adjacency, sparse.eye(n_times)) + sparse.kron(sparse.eye(ch_adjacency.shape[0]), time_adjacency)
+    return (adjacency > 0).tocsr()
+
+
+def _f_values(group_sums, total_sum, total_sumsq, n1, n2):
+    # Two-group one-way ANOVA F for every row of group_sums (sums of group 1), using the totals shared by all permutations
+    n_total = n1 + n2
+    other_sums = total_sum - group_sums
+    between = group_sums ** 2 / n1 + other_sums ** 2 / n2 - total_sum ** 2 / n_total
+    within = total_sumsq - group_sums ** 2 / n1 - other_sums ** 2 / n2
+    return between / (within / (n_total - 2))
+
+
+def find_clusters(f_values, threshold, adjacency):
+    # Connected supra-threshold features: returns the cluster label of every feature (-1 outside clusters) and the
+    # summed F of each cluster
+    above = np.flatnonzero(f_values > threshold)
+    labels = np.full(f_values.shape, -1)
+    if len(above) == 0:
+        return labels, np.zeros(0)
+
+    n_clusters, cluster_ids = connected_components(adjacency[above][:, above], directed=False)
+    labels[above] = cluster_ids
+    cluster_stats = np.bincount(cluster_ids, weights=f_values[above], minlength=n_clusters)
+    return labels, cluster_stats
+
+
+# Set once per worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(data_path, n1, threshold, adjacency):
+    X = np.load(data_path, mmap_mode='r')
+    _worker_state.update(X=X, n1=n1, threshold=threshold, adjacency=adjacency,
+                         total_sum=X.sum(axis=0), total_sumsq=np.einsum('ij,ij->j', X, X))
+
+
+def _permutation_chunk(seed, n_permutations):
+    # Max cluster statistic for n_permutations random relabelings. Group 1 sums for the whole chunk are one matrix product.
+    state = _worker_state
+    X, n1 = state['X'], state['n1']
+    rng = np.random.default_rng(seed)
+
+    selection = np.zeros((n_permutations, X.shape[0]))
+    for k in range(n_permutations):
+        selection[k, rng.permutation(X.shape[0])[:n1]] = 1.0
+    group_sums = selection @ X
+
+    f_values = _f_values(group_sums, state['total_sum'], state['total_sumsq'], n1, X.shape[0] - n1)
+    max_stats = np.zeros(n_permutations)
+    for k in range(n_permutations):
+        _, cluster_stats = find_clusters(f_values[k], state['threshold'], state['adjacency'])
+        max_stats[k] = cluster_stats.max() if len(cluster_stats) else 0.0
+    return max_stats
+
+
+def _decided(exceedances, n_done, alpha, confidence):
+    # True when the Clopper-Pearson interval of every cluster p-value lies entirely on one side of alpha
+    tail = (1 - confidence) / 2
+    lower = stats.beta.ppf(tail, exceedances, n_done - exceedances + 1)
+    upper = stats.beta.ppf(1 - tail, exceedances + 1, n_done - exceedances)
+    lower = np.nan_to_num(lower, nan=0.0)
+    upper = np.nan_to_num(upper, nan=1.0)
+    return bool(np.all((upper < alpha) | (lower > alpha)))
+
+
+def cluster_permutation_test(X, info, p_threshold=0.05, n_permutations=1000, alpha=0.05, n_jobs=1, chunk_size=50,
+                             early_stop=False, min_permutations=200, confidence=0.99, random_state=0):
+    ##################################################################
+    #        Spatio-temporal cluster permutation test, 2 groups
+    ##################################################################
+    # X = [data_a, data_b], each (n_epochs, n_channels, n_times). Returns a dict with T_obs (F values, n_channels x n_times),
+    # clusters (boolean masks), cluster_p_values, H0 (max cluster statistic of each permutation) and timing figures.
+    start = time.perf_counter()
+    data_a, data_b = X
+    n1, n2 = len(data_a), len(data_b)
+    n_channels, n_times = data_a.shape[1:]
+    threshold = stats.f.ppf(1 - p_threshold, 1, n1 + n2 - 2)
+    adjacency = feature_adjacency(channel_adjacency(info), n_times)
+
+    # Shared read-only copy of the pooled trials for the workers
+    data_file = tempfile.NamedTemporaryFile(suffix='.npy', delete=False)
+    data_file.close()
+    pooled = np.lib.format.open_memmap(data_file.name, mode='w+', dtype=np.float64, shape=(n1 + n2, n_channels * n_times))
+    pooled[:n1] = np.reshape(data_a, (n1, -1))
+    pooled[n1:] = np.reshape(data_b, (n2, -1))
+    pooled.flush()
+    del pooled
+
+    try:
+        # Observed statistic and clusters
+        _init_worker(data_file.name, n1, threshold, adjacency)
+        X_pooled = _worker_state['X']
+        T_obs = _f_values(X_pooled[:n1].sum(axis=0), _worker_state['total_sum'], _worker_state['total_sumsq'], n1, n2)
+        labels, cluster_stats = find_clusters(T_obs, threshold, adjacency)
+        print(f"F threshold {threshold:.3f} (p < {p_threshold}), {len(cluster_stats)} observed clusters")
+
+        # Chunks get their own seeds, so the result does not depend on n_jobs
+        n_chunks = int(np.ceil(n_permutations / chunk_size))
+        chunk_sizes = [min(chunk_size, n_permutations - k * chunk_size) for k in range(n_chunks)]
+        seeds = np.random.SeedSequence(random_state).spawn(n_chunks)
+
+        H0 = []
+        exceedances = np.zeros(len(cluster_stats))
+        perm_start = time.perf_counter()
+        n_jobs = min(resolve_n_jobs(n_jobs), n_chunks)
+        executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                       initargs=(data_file.name, n1, threshold, adjacency)) if n_jobs > 1 else None
+        try:
+            if executor is None:
+                chunk_results = (_permutation_chunk(seed, size) for seed, size in zip(seeds, chunk_sizes))
+            else:
+                chunk_results = (future.result() for future in [executor.submit(_permutation_chunk, seed, size) for seed, size in zip(seeds, chunk_sizes)])
+
+            # Results are consumed in chunk order, so early stopping also does not depend on n_jobs
+            for max_stats in chunk_results:
+                H0.append(max_stats)
+                exceedances += (max_stats[:, None] >= cluster_stats[None, :]).sum(axis=0)
+                n_done = sum(len(h) for h in H0)
+                if early_stop and n_done >= min_permutations and _decided(exceedances, n_done, alpha, confidence):
+                    print(f"Stopped after {n_done} permutations, every cluster p-value is clearly above or below {alpha}")
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        perm_time = time.perf_counter() - perm_start
+    finally:
+        _worker_state.clear()
+        os.remove(data_file.name)
+
+    H0 = np.concatenate(H0)
+    cluster_p_values = (exceedances + 1) / (len(H0) + 1)
+    clusters = [np.reshape(labels == k, (n_channels, n_times)) for k in range(len(cluster_stats))]
+
+    print(f"{len(H0)} permutations in {perm_time:.1f} s ({len(H0) / perm_time:.1f} permutations/s, {n_jobs} workers)")
+    return dict(T_obs=np.reshape(T_obs, (n_channels, n_times)), clusters=clusters, cluster_stats=cluster_stats,
+                cluster_p_values=cluster_p_values, H0=H0, threshold=threshold, n_permutations=len(H0),
+                permutations_per_second=len(H0) / perm_time, elapsed=time.perf_counter() - start)
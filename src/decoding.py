@@ -0,0 +1,183 @@
+import os
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import mne
+from scipy import linalg, stats
+
+from src.session_executor import session_grid, resolve_n_jobs
+from src.epochs_store import store_exists, select_epochs, open_epochs_store
+
+
+# Single-trial decoding of correct vs incorrect feedback from the epochs of create_epochs:
+#   features  'amplitude': mean amplitude of every channel in consecutive post-feedback windows
+#             'spatial':   the same window means of xDAWN-like spatial filter outputs (fitted on the training trials only)
+#   model     linear discriminant analysis with Ledoit-Wolf shrinkage of the covariance
+#   folds     stratified k-fold or leave-one-subject-out, run in parallel worker processes
+decoding_dir = 'data/decoding'
+
+
+def load_trials(epochs_dir="data/epochs"):
+    # (n_trials, n_channels, n_times) kept epochs of all sessions, labels (1 correct, 0 incorrect), subject of each
+    # trial and the epoch times. Reads the consolidated epochs store when it exists, the per-session files otherwise.
+    if store_exists():
+        data, metadata = select_epochs()
+        layout = open_epochs_store()[2]
+        times = layout['tmin'] + np.arange(layout['n_times']) / layout['sfreq']
+        return np.asarray(data, dtype=np.float64), (metadata['condition'] == 'correct').to_numpy(int), metadata['subject'].to_numpy(), times
+
+    trials, labels, subjects = [], [], []
+    for subject, session in session_grid():
+        epochs_path = f"{epochs_dir}/Data_S{subject:02d}_Sess{session:02d}_epochs_epo.fif"
+        if not os.path.exists(epochs_path):
+            continue
+        epochs = mne.read_epochs(epochs_path, preload=True, verbose=False)
+        trials.append(epochs.get_data())
+        labels.append((epochs.events[:, 2] == epochs.event_id['correct']).astype(int))
+        subjects.append(np.full(len(epochs), subject))
+        times = epochs.times
+    return np.concatenate(trials), np.concatenate(labels), np.concatenate(subjects), times
+
+
+def window_means(X, times, tmin=0.0, tmax=0.6, window=0.05):
+    # (n_trials, n_signals * n_windows) mean amplitude of each signal in consecutive windows, one reshape for all trials
+    first = np.searchsorted(times, tmin)
+    width = max(int(round(window / (times[1] - times[0]))), 1)
+    n_windows = (np.searchsorted(times, tmax, side='right') - first) // width
+    segment = X[:, :, first:first + n_windows * width]
+    return segment.reshape(X.shape[0], X.shape[1], n_windows, width).mean(axis=3).reshape(X.shape[0], -1)
+
+
+def xdawn_filters(X, y, n_filters=4):
+    # Spatial filters maximizing the ratio of each class's evoked signal to the overall signal power:
+    # generalized eigenvectors of (class-average covariance, trial covariance), top n_filters per class
+    trial_cov = np.einsum('ict,idt->cd', X, X) / (X.shape[0] * X.shape[2])
+    trial_cov += np.eye(len(trial_cov)) * 1e-3 * np.trace(trial_cov) / len(trial_cov)
+    filters = []
+    for label in (0, 1):
+        evoked = X[y == label].mean(axis=0)
+        _, vectors = linalg.eigh(evoked @ evoked.T / X.shape[2], trial_cov)
+        filters.append(vectors[:, ::-1][:, :n_filters])
+    return np.hstack(filters)
+
+
+def fit_lda(features, y):
+    # Two-class LDA with Ledoit-Wolf shrinkage; returns the weight vector and bias of the decision function
+    means = [features[y == label].mean(axis=0) for label in (0, 1)]
+    centered = np.vstack([features[y == label] - means[label] for label in (0, 1)])
+    n, p = centered.shape
+    covariance = centered.T @ centered / n
+
+    # Ledoit-Wolf shrinkage intensity towards mu * I
+    mu = np.trace(covariance) / p
+    delta = ((covariance - mu * np.eye(p)) ** 2).sum() / p
+    beta = (((centered ** 2).sum(axis=1)) ** 2).sum() / (n ** 2 * p) - (covariance ** 2).sum() / (n * p)
+    shrinkage = 0.0 if delta == 0 else min(max(beta / delta, 0.0), 1.0)
+    covariance = (1 - shrinkage) * covariance + shrinkage * mu * np.eye(p)
+
+    weights = linalg.solve(covariance, means[1] - means[0], assume_a='pos')
+    bias = -weights @ (means[0] + means[1]) / 2
+    return weights, bias
+
+
+def roc_auc(y, scores):
+    # Area under the ROC curve from the rank sum of the positive trials (Mann-Whitney U)
+    ranks = stats.rankdata(scores)
+    n_pos = int(y.sum())
+    n_neg = len(y) - n_pos
+    if n_pos == 0 or n_neg == 0:
+        return np.nan
+    return (ranks[y == 1].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+def make_folds(y, subjects, cv=5, random_state=0):
+    # cv='loso' -> one fold per subject, an int -> stratified k-fold. Returns a list of (name, test index array).
+    if cv == 'loso':
+        return [(f"S{subject:02d}", np.flatnonzero(subjects == subject)) for subject in np.unique(subjects)]
+
+    rng = np.random.default_rng(random_state)
+    fold_of = np.empty(len(y), dtype=int)
+    for label in (0, 1):
+        members = rng.permutation(np.flatnonzero(y == label))
+        fold_of[members] = np.arange(len(members)) % cv
+    return [(f"fold {k + 1}", np.flatnonzero(fold_of == k)) for k in range(cv)]
+
+
+# Set once per worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(data_path, y, times, feature_type, n_filters):
+    _worker_state.update(X=np.load(data_path, mmap_mode='r'), y=y, times=times, feature_type=feature_type, n_filters=n_filters)
+    if feature_type == 'amplitude':
+        # Fold-independent, computed once per worker
+        _worker_state['features'] = window_means(_worker_state['X'], times)
+
+
+def _run_fold(name, test_index):
+    start = time.perf_counter()
+    state = _worker_state
+    y = state['y']
+    train = np.ones(len(y), dtype=bool)
+    train[test_index] = False
+
+    if state['feature_type'] == 'amplitude':
+        train_features, test_features = state['features'][train], state['features'][test_index]
+    else:
+        X_train = np.asarray(state['X'][np.flatnonzero(train)])
+        filters = xdawn_filters(X_train, y[train], state['n_filters'])
+        train_features = window_means(np.einsum('cf,ict->ift', filters, X_train), state['times'])
+        test_features = window_means(np.einsum('cf,ict->ift', filters, np.asarray(state['X'][test_index])), state['times'])
+
+    # Standardize with the training statistics, then LDA
+    mean, std = train_features.mean(axis=0), train_features.std(axis=0) + 1e-12
+    weights, bias = fit_lda((train_features - mean) / std, y[train])
+    scores = ((test_features - mean) / std) @ weights + bias
+
+    y_test = y[test_index]
+    return dict(fold=name, n_train=int(train.sum()), n_test=len(test_index), accuracy=float(np.mean((scores > 0) == y_test)),
+                auc=float(roc_auc(y_test, scores)), wall_time=time.perf_counter() - start)
+
+
+def decode_feedback(features='amplitude', cv=5, n_filters=4, n_jobs=1, epochs_dir="data/epochs", random_state=0):
+    ##################################################################
+    #       Cross-validated single-trial correct vs incorrect
+    ##################################################################
+    # features: 'amplitude' or 'spatial'; cv: number of stratified folds or 'loso' (leave one subject out)
+    if features not in ('amplitude', 'spatial'):
+        raise ValueError(f"Unknown features '{features}', expected 'amplitude' or 'spatial'")
+
+    start = time.perf_counter()
+    X, y, subjects, times = load_trials(epochs_dir)
+    print(f"Decoding {len(y)} trials ({int(y.sum())} correct, {int(len(y) - y.sum())} incorrect) from {len(np.unique(subjects))} subjects")
+    folds = make_folds(y, subjects, cv, random_state)
+
+    # Trials shared with the workers through a memory-mapped file instead of being pickled for every fold
+    data_file = tempfile.NamedTemporaryFile(suffix='.npy', delete=False)
+    data_file.close()
+    try:
+        np.save(data_file.name, X)
+        del X
+        initargs = (data_file.name, y, times, features, n_filters)
+        n_jobs = min(resolve_n_jobs(n_jobs), len(folds))
+        if n_jobs == 1:
+            _init_worker(*initargs)
+            results = [_run_fold(name, test_index) for name, test_index in folds]
+            _worker_state.clear()
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=initargs) as executor:
+                results = list(executor.map(_run_fold, *zip(*folds)))
+    finally:
+        os.remove(data_file.name)
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False, float_format='%.3f'))
+    print(f"---------------- decoding ({features}, cv={cv}): accuracy {results['accuracy'].mean():.3f}, AUC {results['auc'].mean():.3f}, "
+          f"{len(results)} folds on {n_jobs} workers in {time.perf_counter() - start:.1f} s ----------------")
+
+    if not os.path.exists(decoding_dir):
+        os.makedirs(decoding_dir)
+    results.to_csv(f"{decoding_dir}/decoding_{features}_{cv}.csv", index=False)
+    return results
@@ -0,0 +1,189 @@
+import os
+import json
+import hashlib
+import fcntl
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import mne
+
+from src.precision import storage_dtype
+
+
+# All sessions' epochs in one place:
+#   epochs.dat     (n_rows, n_channels, n_times) array, rows are appended session by session
+#   metadata.csv   one line per feedback event: subject, session, condition, event_index (position in the session's
+#                  events), sample, rejected, drop_reason, row (position in epochs.dat, -1 if rejected),
+#                  content_sha256 (hash of the session's epoch data, the same on all its lines)
+#   layout.json    channel names, times, dtype and the number of rows written
+#   info.fif       measurement info shared by all rows, to rebuild Epochs/Evoked objects
+# Row numbers are positions, not identifiers: compaction renumbers them. Readers that need to know whether a session
+# changed use session_fingerprint, which only depends on the session's content.
+epochs_store_dir = 'data/epochsStore'
+event_names = {1: 'incorrect', 2: 'correct'}
+metadata_columns = ['subject', 'session', 'condition', 'event_index', 'sample', 'rejected', 'drop_reason', 'row', 'content_sha256']
+
+
+def _store_paths(store_dir):
+    return dict(data=f"{store_dir}/epochs.dat", metadata=f"{store_dir}/metadata.csv", layout=f"{store_dir}/layout.json",
+                info=f"{store_dir}/info.fif", lock=f"{store_dir}/.lock")
+
+
+@contextmanager
+def _locked(store_dir):
+    # create_epochs appends from several worker processes, one writer at a time
+    os.makedirs(store_dir, exist_ok=True)
+    with open(_store_paths(store_dir)['lock'], 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def store_exists(store_dir=epochs_store_dir):
+    return os.path.exists(_store_paths(store_dir)['layout'])
+
+
+def append_epochs(epochs, events, subject, session, store_dir=epochs_store_dir, compact_fraction=0.25):
+    # Add (or replace) one session: the kept epochs go to epochs.dat, every event of the session goes to metadata.csv.
+    # events is the full events array the epochs were cut from, so rejected events keep their condition.
+    # Once more than compact_fraction of the rows in epochs.dat belong to replaced sessions, the store is compacted.
+    paths = _store_paths(store_dir)
+    dtype = storage_dtype()
+    data = epochs.get_data().astype(dtype, copy=False)
+
+    with _locked(store_dir):
+        if os.path.exists(paths['layout']):
+            with open(paths['layout']) as f:
+                layout = json.load(f)
+            if layout['ch_names'] != epochs.ch_names or layout['n_times'] != len(epochs.times) or layout['dtype'] != np.dtype(dtype).name:
+                raise ValueError(f"S{subject:02d} Sess{session:02d} does not match the channels/times/dtype of {store_dir}")
+            metadata = pd.read_csv(paths['metadata'])
+        else:
+            layout = dict(ch_names=epochs.ch_names, n_times=len(epochs.times), tmin=float(epochs.times[0]), sfreq=epochs.info['sfreq'],
+                          dtype=np.dtype(dtype).name, n_rows=0)
+            metadata = pd.DataFrame(columns=metadata_columns)
+            mne.io.write_info(paths['info'], epochs.info)
+
+        # Rows of an earlier version of this session stay in epochs.dat but are no longer referenced (until compacted below)
+        metadata = metadata[~((metadata['subject'] == subject) & (metadata['session'] == session))]
+
+        # Write right after the last committed row, so a write interrupted by a crash is simply overwritten
+        first_row = layout['n_rows']
+        row_nbytes = len(layout['ch_names']) * layout['n_times'] * np.dtype(dtype).itemsize
+        with open(paths['data'], 'r+b' if os.path.exists(paths['data']) else 'wb') as f:
+            f.seek(first_row * row_nbytes)
+            data.tofile(f)
+        layout['n_rows'] = first_row + len(data)
+
+        # epochs.selection holds the position in events of every kept epoch, drop_log the reason for the others
+        rows = np.full(len(events), -1)
+        rows[epochs.selection] = np.arange(first_row, first_row + len(data))
+        session_metadata = pd.DataFrame(dict(
+            subject=subject, session=session, condition=[event_names[event_id] for event_id in events[:, 2]],
+            event_index=np.arange(len(events)), sample=events[:, 0], rejected=rows < 0,
+            drop_reason=['/'.join(reasons) for reasons in epochs.drop_log], row=rows, content_sha256=_content_sha256(data)))
+
+        metadata = pd.concat([metadata, session_metadata], ignore_index=True) if len(metadata) else session_metadata
+        metadata.to_csv(paths['metadata'] + '.tmp', index=False)
+        os.replace(paths['metadata'] + '.tmp', paths['metadata'])
+        with open(paths['layout'], 'w') as f:
+            json.dump(layout, f, indent=1)
+
+        orphaned = layout['n_rows'] - int((metadata['row'] >= 0).sum())
+        if orphaned > compact_fraction * layout['n_rows']:
+            print(f"Compacting {store_dir}: {orphaned} of {layout['n_rows']} rows belong to replaced sessions")
+            _compact(store_dir)
+
+    print(f"=====================================> Appended {len(data)} epochs of S{subject:02d} Sess{session:02d} to {store_dir}")
+
+
+def _content_sha256(data):
+    return hashlib.sha256(np.ascontiguousarray(data).tobytes()).hexdigest()
+
+
+def session_fingerprint(subject, session, data, metadata):
+    # Content fingerprint of one session in the store: its metadata lines without the row positions (which compaction
+    # changes) plus the hash of its epoch data. Stores written before content_sha256 existed hash the rows' data here.
+    lines = metadata[(metadata['subject'] == subject) & (metadata['session'] == session)]
+    if 'content_sha256' not in lines.columns or lines['content_sha256'].isna().any():
+        rows = np.sort(lines.loc[lines['row'] >= 0, 'row'].to_numpy())
+        lines = lines.assign(content_sha256=_content_sha256(data[rows]))
+    content = lines.drop(columns=['row']).reset_index(drop=True)
+    return hashlib.sha256(content.to_csv(index=False).encode()).hexdigest()
+
+
+def has_store_session(subject, session, store_dir=epochs_store_dir):
+    if not store_exists(store_dir):
+        return False
+    metadata = pd.read_csv(_store_paths(store_dir)['metadata'], usecols=['subject', 'session'])
+    return bool(((metadata['subject'] == subject) & (metadata['session'] == session)).any())
+
+
+def open_epochs_store(store_dir=epochs_store_dir):
+    # Memory-mapped (n_rows, n_channels, n_times) array, the metadata table and the layout; nothing is loaded yet
+    paths = _store_paths(store_dir)
+    with open(paths['layout']) as f:
+        layout = json.load(f)
+    metadata = pd.read_csv(paths['metadata'])
+    shape = (layout['n_rows'], len(layout['ch_names']), layout['n_times'])
+    data = np.memmap(paths['data'], dtype=layout['dtype'], mode='r', shape=shape) if layout['n_rows'] else np.empty(shape, dtype=layout['dtype'])
+    return data, metadata, layout
+
+
+def store_files(store_dir=epochs_store_dir):
+    # Files whose content defines the store, for stage cache keys of its readers
+    paths = _store_paths(store_dir)
+    return [paths['data'], paths['metadata']]
+
+
+def read_store_info(store_dir=epochs_store_dir):
+    return mne.io.read_info(_store_paths(store_dir)['info'])
+
+
+def select_epochs(condition=None, subjects=None, sessions=None, store_dir=epochs_store_dir):
+    # Kept epochs matching the selection, as an (n_selected, n_channels, n_times) array plus their metadata rows.
+    # Only the selected rows are read from disk.
+    data, metadata, _ = open_epochs_store(store_dir)
+    selected = metadata[~metadata['rejected']]
+    if condition is not None:
+        selected = selected[selected['condition'] == condition]
+    if subjects is not None:
+        selected = selected[selected['subject'].isin(subjects)]
+    if sessions is not None:
+        selected = selected[selected['session'].isin(sessions)]
+
+    rows = selected['row'].to_numpy()
+    return data[np.sort(rows)], selected.sort_values('row').reset_index(drop=True)
+
+
+def compact_epochs_store(store_dir=epochs_store_dir):
+    # Rewrite epochs.dat without the rows left behind by replaced sessions (append_epochs does this on its own once
+    # they pass its compact_fraction)
+    with _locked(store_dir):
+        _compact(store_dir)
+
+
+def _compact(store_dir):
+    # Caller holds the store lock
+    paths = _store_paths(store_dir)
+    data, metadata, layout = open_epochs_store(store_dir)
+    kept = metadata['row'] >= 0
+    old_rows = metadata.loc[kept, 'row'].to_numpy()
+    order = np.argsort(old_rows)
+
+    with open(paths['data'] + '.tmp', 'wb') as f:
+        for start in range(0, len(order), 1024):
+            data[old_rows[order[start:start + 1024]]].tofile(f)
+    new_rows = np.empty(len(old_rows), dtype=int)
+    new_rows[order] = np.arange(len(old_rows))
+    metadata.loc[kept, 'row'] = new_rows
+    layout['n_rows'] = len(old_rows)
+
+    del data
+    os.replace(paths['data'] + '.tmp', paths['data'])
+    metadata.to_csv(paths['metadata'] + '.tmp', index=False)
+    os.replace(paths['metadata'] + '.tmp', paths['metadata'])
+    with open(paths['layout'], 'w') as f:
+        json.dump(layout, f, indent=1)
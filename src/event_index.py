@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import pandas as pd
+
+from src.session_executor import session_grid
+from src.stage_cache import is_fresh, record_output
+from src.metrics import measured_stage
+
+
+# Ready-to-use MNE events arrays for every session, built in one pass over AllDataLabels.csv
+event_index_dir = 'data/eventIndex'
+
+# Event arrays already loaded in this process, keyed by sfreq
+_loaded_indexes = {}
+
+
+def event_index_paths(sfreq):
+    # Events depend on sfreq (sample = Time * sfreq), so each sfreq gets its own index
+    return f"{event_index_dir}/events_{sfreq}Hz.npz", f"{event_index_dir}/events_{sfreq}Hz_summary.csv"
+
+
+def parse_feedback_ids(feedback_labels_df):
+    # Split IdFeedBack ('S02_Sess01_FB001') into subject, session and trial numbers with a single vectorized pass.
+    # Rows come back sorted by (subject, session, trial): the n-th label of a session belongs to its n-th feedback
+    # event, whatever the row order of the labels file.
+    keys = feedback_labels_df['IdFeedBack'].str.extract(r'S(?P<subject>\d+)_Sess(?P<session>\d+)_FB(?P<trial>\d+)')
+    if keys.isna().any().any():
+        bad_ids = feedback_labels_df.loc[keys.isna().any(axis=1), 'IdFeedBack'].tolist()
+        raise ValueError(f"Unrecognized IdFeedBack values: {bad_ids[:5]}")
+    labels_df = feedback_labels_df.assign(**{name: keys[name].astype(int) for name in keys.columns})
+    return labels_df.sort_values(['subject', 'session', 'trial'], kind='stable').reset_index(drop=True)
+
+
+def has_contiguous_trials(labels):
+    # True if the (sorted) trial numbers of one session's labels are exactly 1..n, no gaps or duplicates
+    return bool(np.array_equal(labels['trial'].to_numpy(), np.arange(1, len(labels) + 1)))
+
+
+@measured_stage
+def build_event_index(sfreq=200, event_source='csv', force=False):
+    ##################################################################
+    #      Join feedback labels with FeedBackEvent times per session
+    ##################################################################
+    from src.get_erp import event_source_path, feedback_labels_path, original_dir
+
+    if not os.path.exists(event_index_dir):
+        os.makedirs(event_index_dir)
+
+    index_path, summary_path = event_index_paths(sfreq)
+    sessions = [(i, j, event_source_path(i, j, event_source)) for i, j in session_grid()]
+    sessions = [(i, j, path) for i, j, path in sessions if path is not None]
+    input_paths = sorted({path for _, _, path in sessions}) + [feedback_labels_path]
+    # label_order: indexes built before the labels were sorted by trial number are rebuilt
+    params = dict(sfreq=sfreq, label_order='trial')
+    if not force and is_fresh([index_path, summary_path], 'build_event_index', input_paths, params):
+        print(f"Up to date, skipping {index_path}")
+        return pd.read_csv(summary_path)
+
+    labels_df = parse_feedback_ids(pd.read_csv(feedback_labels_path))
+    # Sorted by trial inside each session (parse_feedback_ids), which is the order the events are matched in
+    labels_by_session = {key: group for key, group in labels_df.groupby(['subject', 'session'], sort=False)}
+
+    events_by_session = {}
+    summary = []
+    for i, j, _ in sessions:
+        if event_source == 'store':
+            from src.session_store import load_session_events
+            times, feedback = load_session_events(i, j)
+            event_times_seconds = np.asarray(times[np.asarray(feedback) == 1])
+        else:
+            session_df = pd.read_csv(f"{original_dir}/Data_S{i:02d}_Sess{j:02d}.csv", usecols=['Time', 'FeedBackEvent'])
+            event_times_seconds = session_df.loc[session_df['FeedBackEvent'] == 1, 'Time'].to_numpy()
+
+        labels = labels_by_session.get((i, j))
+        n_labels = 0 if labels is None else len(labels)
+        mismatch = n_labels != len(event_times_seconds)
+        trial_gap = labels is not None and not has_contiguous_trials(labels)
+        summary.append(dict(subject=i, session=j, n_labels=n_labels, n_events=len(event_times_seconds), mismatch=mismatch, trial_gap=trial_gap))
+
+        if mismatch:
+            print(f"S{i:02d} Sess{j:02d}: {n_labels} feedback labels but {len(event_times_seconds)} feedback events")
+            continue
+        if trial_gap:
+            # Same count but a missing or repeated trial number: pairing by position would shift the labels
+            print(f"S{i:02d} Sess{j:02d}: feedback label trial numbers are not 1..{n_labels}")
+            continue
+
+        # Same conversion as create_epochs: sample = int(Time * sfreq), ID 1 (incorrect) / 2 (correct)
+        events_by_session[f"S{i:02d}_Sess{j:02d}"] = np.column_stack((
+            (event_times_seconds * sfreq).astype(int),
+            np.zeros(n_labels, dtype=int),
+            labels['Prediction'].to_numpy() + 1
+        ))
+
+    np.savez(index_path, **events_by_session)
+    summary = pd.DataFrame(summary)
+    summary.to_csv(summary_path, index=False)
+    record_output([index_path, summary_path], 'build_event_index', input_paths, params)
+    _loaded_indexes.pop(sfreq, None)
+
+    print(f"Indexed {len(events_by_session)} sessions, {int(summary['mismatch'].sum())} with mismatched label/event counts, "
+          f"{int(summary['trial_gap'].sum())} with gaps in the trial numbers")
+    return summary
+
+
+def has_session_events(subject, session, sfreq):
+    return f"S{subject:02d}_Sess{session:02d}" in _load_index(sfreq)
+
+
+def load_indexed_events(subject, session, sfreq):
+    # Events array of one session (dict lookup after the index was loaded once in this process)
+    return _load_index(sfreq)[f"S{subject:02d}_Sess{session:02d}"]
+
+
+def _load_index(sfreq):
+    if sfreq not in _loaded_indexes:
+        index_path, _ = event_index_paths(sfreq)
+        if not os.path.exists(index_path):
+            return {}
+        with np.load(index_path) as index:
+            _loaded_indexes[sfreq] = {key: index[key] for key in index.files}
+    return _loaded_indexes[sfreq]
@@ -2,117 +2,190 @@ import os
 import pandas as pd
 import numpy as np
 import mne
-import matplotlib.pyplot as plt
 
-
-
-def create_epochs(preprocessed_dir, identifier_fname, sfreq):
-    
-    # Define original csv dir
-    original_dir = 'data/allData'
-    # Define filepath of Feedback Labels
-    feedback_labels_path = 'data/AllDataLabels.csv'
-    
-    # Define directory to save the epoched data
-    epoch_dir = 'data/epochs'
+from src.session_executor import run_sessions, print_session_summary, session_grid
+from src.stage_cache import file_sha256, is_fresh, record_output
+from src.precision import fif_fmt
+from src.epochs_store import append_epochs, has_store_session, store_exists, store_files, open_epochs_store, read_store_info, session_fingerprint
+from src import metrics
+from src.metrics import dump, measured_stage
+from src import grand_average_state
+
+
+# Define original csv dir
+original_dir = 'data/allData'
+# Define directory to save the epoched data
+epoch_dir = 'data/epochs'
+# Define filepath of Feedback Labels
+feedback_labels_path = 'data/AllDataLabels.csv'
+# Define directory to save the per-session evoked data (correct and incorrect averages of each session)
+evoked_dir = 'data/evoked'
+# Peak-to-peak amplitude above which an epoch is dropped as artifact
+default_reject_criteria = dict(eeg=150e-6)
+# Conditions averaged per session, in the order they are saved
+event_types = ('correct', 'incorrect')
+
+
+def create_epochs(preprocessed_dir, identifier_fname, sfreq, reject_criteria=None, event_source='csv', n_jobs=1, force=False):
+    # event_source='store' takes Time/FeedBackEvent from the binary session store instead of parsing the session csv,
+    # event_source='index' takes the ready-made events arrays from event_index.build_event_index
     
     # Ensure cleaned directory exists
     if not os.path.exists(epoch_dir):
         os.makedirs(epoch_dir)
 
         
-    # Load the feedback labels
-    feedback_labels_df = pd.read_csv(feedback_labels_path)
+    # Load the feedback labels (the event index already has them joined in)
+    feedback_labels_df = pd.read_csv(feedback_labels_path) if event_source != 'index' else None
 
     ### Iterate through each session for each subject
-    for i in range(1, 26+1):   # Num Subjects
-        for j in range(1, 5+1):    # Num Sessions
-            preprocessed_file_path = f"{preprocessed_dir}/Data_S{i:02d}_Sess{j:02d}_{identifier_fname}.fif"
-            print(preprocessed_file_path)
-            original_csv_path = f"{original_dir}/Data_S{i:02d}_Sess{j:02d}.csv"
-            print(original_csv_path)
-
-            # Check if both files exist before processing
-            if os.path.exists(preprocessed_file_path) and os.path.exists(original_csv_path):
-                print("===============================================================================================")
-                print("===============================================================================================")
-                print(f"Processing: {preprocessed_file_path} and {original_csv_path}")
-
-                ### Retrieve Event timestamps
-                session_df = pd.read_csv(original_csv_path)
-
-                # Get corresponding Feedback labels for each feedback event in this session from AllDataLabels.csv
-                subject_id = f"S{i:02d}"
-                session_id = f"Sess{j:02d}"
-                search_pattern = f"{subject_id}_{session_id}"
-                labels_df = feedback_labels_df[feedback_labels_df['IdFeedBack'].str.contains(search_pattern)]
-
-                if labels_df.empty:
-                    print(f"No entries found for subject {subject_id} and session {session_id}.")
-                else:
-                    print(f"Found entries for subject {subject_id} and session {session_id}:")
-                    print(labels_df)
-
-
-                # Identify relevant columns
-                event_times_seconds = session_df.loc[session_df['FeedBackEvent'] == 1, 'Time']
-                
-                print('---------------- event times seconds ----------------')
-                print(event_times_seconds)
-                print(event_times_seconds.shape)
-
-                # Convert Event times to samples
-                event_samples = (event_times_seconds * sfreq).astype(int)
-
-                print('---------------- event samples ----------------')
-                print(event_samples)
-
-                # Create the Events array for MNE
-                events = np.column_stack((
-                    event_samples,
-                    np.zeros(len(event_samples), dtype=int),
-                    labels_df['Prediction'] + 1 # Add 1 to Prediction value, 0 or 1 to make IDs 1 (incorrect) and 2 (correct)
-                ))
-
-                # Create Epochs based on incorrect and correct feedbacks (set the baseline from -0.2 from the stimulus to 0)
-                raw = mne.io.read_raw_fif(preprocessed_file_path, preload=True)
-                print("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
-                event_id = { 'incorrect': 1, 'correct': 2 }
-                epochs = mne.Epochs(raw, events=events, event_id=event_id, tmin=-0.2, tmax=0.6, baseline=(-0.2, 0), preload=True)
-                print (raw.info)
-                # Plot the epochs
-                # print(">>>>> Original epochs")
-                # epoch_fig = epochs.plot(picks=channels_to_plot, scalings=scalings, n_epochs=5, n_channels=13, title=f'S{i:02d} Sess{j:02d} Epochs', show=False)
-                # epoch_fig.set_size_inches(15, 20)
-                # epoch_fig.show()
-
-                # Reject any remaining artifacts
-                reject_criteria = dict(eeg=150e-6)
-                epochs_auto_rejected = epochs.copy().drop_bad(reject=reject_criteria)
-                print(epochs_auto_rejected.drop_log)
-                # epochs_auto_rejected.plot_drop_log()
-
-                epochs_auto_rejected.equalize_event_counts(event_ids=event_id)
-
-                if len(epochs_auto_rejected) == 0:
-                    print("No epochs left after equalizing. Skipping plotting and saving.")
-                else:
-                    # Plot the epochs after removing remaining artifacts
-                    # print(">>>>> Epochs after removing remaining artifacts")
-                    # epoch_auto_rejected_fig = epochs_auto_rejected.plot(picks=channels_to_plot, scalings=scalings, n_epochs=5, n_channels=13, title=f'S{i:02d} Sess{j:02d} Epochs', show=False)
-                    # epoch_auto_rejected_fig.set_size_inches(15, 20)
-                    # epoch_auto_rejected_fig.show()
-
-                    # Save epoched data
-                    epoch_file_path = f"{epoch_dir}/Data_S{i:02d}_Sess{j:02d}_epochs_epo.fif"
-                    epochs_auto_rejected.save(epoch_file_path, fmt="double", overwrite=True)
-                    print(f"=====================================> Saved epoch data to {epoch_file_path}")
-
-
-            else:
-                print(f"Missing file for Subject {i}, Session {j}.")
+    results = run_sessions(_create_session_epochs, n_jobs=n_jobs, preprocessed_dir=preprocessed_dir, identifier_fname=identifier_fname,
+                           sfreq=sfreq, reject_criteria=reject_criteria, event_source=event_source, feedback_labels_df=feedback_labels_df, force=force)
+    print_session_summary('create_epochs', results)
 
     print("create epochs")
+    return results
+
+
+def _create_session_epochs(i, j, preprocessed_dir, identifier_fname, sfreq, reject_criteria, feedback_labels_df, event_source='csv', force=False):
+    preprocessed_file_path = f"{preprocessed_dir}/Data_S{i:02d}_Sess{j:02d}_{identifier_fname}.fif"
+    print(preprocessed_file_path)
+    event_input_path = event_source_path(i, j, event_source, sfreq)
+    print(event_input_path)
+
+    # Check if both files exist before processing
+    if not (os.path.exists(preprocessed_file_path) and event_input_path is not None):
+        print(f"Missing file for Subject {i}, Session {j}.")
+        return 'skipped'
+
+    epoch_file_path = f"{epoch_dir}/Data_S{i:02d}_Sess{j:02d}_epochs_epo.fif"
+    input_paths = [preprocessed_file_path, event_input_path, feedback_labels_path]
+    params = dict(sfreq=sfreq, reject_criteria=reject_criteria or default_reject_criteria, tmin=-0.2, tmax=0.6, baseline=(-0.2, 0),
+                  precision=fif_fmt())
+    if not force and is_fresh(epoch_file_path, 'create_epochs', input_paths, params):
+        print(f"Up to date, skipping {epoch_file_path}")
+        if not has_store_session(i, j):
+            # Epochs written before the consolidated store existed
+            events = get_session_events(i, j, sfreq, feedback_labels_df, event_source)
+            append_epochs(mne.read_epochs(epoch_file_path, preload=True), events, i, j)
+        return 'cached'
+
+    print("===============================================================================================")
+    print("===============================================================================================")
+    print(f"Processing: {preprocessed_file_path} and {event_input_path}")
+
+    events = get_session_events(i, j, sfreq, feedback_labels_df, event_source)
+
+    # Create Epochs based on incorrect and correct feedbacks (set the baseline from -0.2 from the stimulus to 0)
+    raw = mne.io.read_raw_fif(preprocessed_file_path, preload=True)
+    epochs_auto_rejected = epoch_raw(raw, events, reject_criteria)
+    metrics.add(samples=raw.n_times, epochs_kept=len(epochs_auto_rejected), epochs_dropped=len(events) - len(epochs_auto_rejected))
+
+    # Add the session to the consolidated all-session store (rejected events are kept in its metadata)
+    append_epochs(epochs_auto_rejected, events, i, j)
+
+    if len(epochs_auto_rejected) == 0:
+        print("No epochs left after equalizing. Skipping plotting and saving.")
+        return 'skipped'
+
+    # Plot the epochs after removing remaining artifacts
+    # print(">>>>> Epochs after removing remaining artifacts")
+    # epoch_auto_rejected_fig = epochs_auto_rejected.plot(picks=channels_to_plot, scalings=scalings, n_epochs=5, n_channels=13, title=f'S{i:02d} Sess{j:02d} Epochs', show=False)
+    # epoch_auto_rejected_fig.set_size_inches(15, 20)
+    # epoch_auto_rejected_fig.show()
+
+    # Save epoched data
+    epochs_auto_rejected.save(epoch_file_path, fmt=fif_fmt(), overwrite=True)
+    record_output(epoch_file_path, 'create_epochs', input_paths, params)
+    print(f"=====================================> Saved epoch data to {epoch_file_path}")
+
+
+def event_source_path(i, j, event_source='csv', sfreq=None):
+    # File the feedback event times of a session come from, None if that session is not available from the source
+    if event_source == 'index':
+        from src.event_index import event_index_paths, has_session_events
+        return event_index_paths(sfreq)[0] if has_session_events(i, j, sfreq) else None
+    if event_source == 'store':
+        from src.session_store import has_session, session_store_dir
+        return f"{session_store_dir}/index.json" if has_session(i, j) else None
+    original_csv_path = f"{original_dir}/Data_S{i:02d}_Sess{j:02d}.csv"
+    return original_csv_path if os.path.exists(original_csv_path) else None
+
+
+def get_session_events(i, j, sfreq, feedback_labels_df, event_source='csv'):
+    # Build the MNE events array (feedback sample, 0, 1=incorrect / 2=correct) of one session
+    if event_source == 'index':
+        # Labels and event samples were already joined (and their counts checked) by build_event_index
+        from src.event_index import load_indexed_events
+        return load_indexed_events(i, j, sfreq)
+
+    ### Retrieve Event timestamps
+    if event_source == 'store':
+        from src.session_store import load_session_events
+        times, feedback = load_session_events(i, j)
+        session_df = pd.DataFrame({'Time': times, 'FeedBackEvent': feedback})
+    else:
+        original_csv_path = f"{original_dir}/Data_S{i:02d}_Sess{j:02d}.csv"
+        session_df = pd.read_csv(original_csv_path, usecols=['Time', 'FeedBackEvent'])
+
+    # Get corresponding Feedback labels for each feedback event in this session from AllDataLabels.csv
+    subject_id = f"S{i:02d}"
+    session_id = f"Sess{j:02d}"
+    search_pattern = f"{subject_id}_{session_id}"
+    labels_df = feedback_labels_df[feedback_labels_df['IdFeedBack'].str.contains(search_pattern)]
+
+    if labels_df.empty:
+        print(f"No entries found for subject {subject_id} and session {session_id}.")
+    else:
+        print(f"Found entries for subject {subject_id} and session {session_id}:")
+        dump(labels_df)
+
+
+    # Identify relevant columns
+    event_times_seconds = session_df.loc[session_df['FeedBackEvent'] == 1, 'Time']
+    
+    dump('---------------- event times seconds ----------------')
+    dump(event_times_seconds)
+    print(event_times_seconds.shape)
+
+    # Convert Event times to samples
+    event_samples = (event_times_seconds * sfreq).astype(int)
+
+    dump('---------------- event samples ----------------')
+    dump(event_samples)
+
+    # Create the Events array for MNE
+    events = np.column_stack((
+        event_samples,
+        np.zeros(len(event_samples), dtype=int),
+        labels_df['Prediction'] + 1 # Add 1 to Prediction value, 0 or 1 to make IDs 1 (incorrect) and 2 (correct)
+    ))
+
+    return events
+
+
+def epoch_raw(raw, events, reject_criteria=None):
+    # Create Epochs based on incorrect and correct feedbacks (set the baseline from -0.2 from the stimulus to 0)
+    print("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
+    event_id = { 'incorrect': 1, 'correct': 2 }
+    epochs = mne.Epochs(raw, events=events, event_id=event_id, tmin=-0.2, tmax=0.6, baseline=(-0.2, 0), preload=True)
+    dump(raw.info)
+    # Plot the epochs
+    # print(">>>>> Original epochs")
+    # epoch_fig = epochs.plot(picks=channels_to_plot, scalings=scalings, n_epochs=5, n_channels=13, show=False)
+    # epoch_fig.set_size_inches(15, 20)
+    # epoch_fig.show()
+
+    # Reject any remaining artifacts
+    if reject_criteria is None:
+        reject_criteria = default_reject_criteria
+    epochs_auto_rejected = epochs.copy().drop_bad(reject=reject_criteria)
+    dump(epochs_auto_rejected.drop_log)
+    # epochs_auto_rejected.plot_drop_log()
+
+    epochs_auto_rejected.equalize_event_counts(event_ids=event_id)
+
+    return epochs_auto_rejected
 
 
 # Averages epochs by sessions per subject
@@ -124,7 +197,7 @@ def average_epochs(subject_id, session_id, event_type):
 
     # Load epochs
     epochs = mne.read_epochs(epochs_path, preload=True)
-    print(epochs.info)
+    dump(epochs.info)
     print(event_type)
 
     # Select epochs based on the event type and average them
@@ -135,10 +208,10 @@ def average_epochs(subject_id, session_id, event_type):
         evoked = epochs[event_type].average()
         print("===============================================================")
         print("===============================================================")
-        print(epochs.info)
+        dump(epochs.info)
         evoked.info['bads'] = epochs.info['bads']
-        print(evoked.info)
-        print(evoked.get_data())
+        dump(evoked.info)
+        dump(evoked.get_data())
         print(evoked.get_data().shape)
 
         return evoked
@@ -146,70 +219,140 @@ def average_epochs(subject_id, session_id, event_type):
     return None
 
 
+# Same as average_epochs but reads the session's rows from the consolidated epochs store (opened once by the caller)
+def average_store_epochs(subject_id, session_id, event_type, store):
+    data, metadata, layout, info = store
+    rows = metadata.loc[(metadata['subject'] == subject_id) & (metadata['session'] == session_id) &
+                        (metadata['condition'] == event_type) & (metadata['row'] >= 0), 'row'].to_numpy()
+    if len(rows) == 0:
+        print(f"No {event_type} epochs stored for Subject {subject_id} Session {session_id}")
+        return None
 
-def create_grand_average():
+    evoked = mne.EvokedArray(np.mean(data[np.sort(rows)], axis=0, dtype=np.float64), info, tmin=layout['tmin'], nave=len(rows), comment=event_type)
+    return evoked
 
-    grand_average_dir = f"data/grandAverage"
 
-    # Ensure cleaned directory exists
-    if not os.path.exists(grand_average_dir):
-        os.makedirs(grand_average_dir)
-
-    all_evoked_correct = []
-    all_evoked_incorrect = []
-
-    # Loop over subjects and sessions
-    for subject_id in range(1, 27):  # Iterate through 26 subjects
-        correct_subject_evokeds = []
-        incorrect_subject_evokeds = []
-        for session_id in range(1, 6):  # Iterate through 5 sessions per subject
-            try:
-                evoked_correct = average_epochs(subject_id, session_id, 'correct')
-                correct_subject_evokeds.append(evoked_correct)
-                evoked_incorrect = average_epochs(subject_id, session_id, 'incorrect')
-                incorrect_subject_evokeds.append(evoked_incorrect)
-
-                if(evoked_correct):
-                    print(evoked_correct.info)
-                    all_evoked_correct.append(evoked_correct)
-                if(evoked_incorrect):
-                    print(evoked_incorrect.info)
-                    all_evoked_incorrect.append(evoked_incorrect)
-
-            except FileNotFoundError:
-                print(f"Data not found for Subject {subject_id} Session {session_id}")
-
-        # Save averages by subjects  -- not in use (we collected all evoked from all subject sessions since we are comparing the conditions of correct or incorrect responses not by groups)
-        # subject_average_path = f"data/evoked/bySubject/Data_S{subject_id:02d}_evokeds-ave.fif"
-        # correct_subject_evokeds = [item for item in correct_subject_evokeds if item is not None]
-        # correct_subject_average = mne.grand_average(correct_subject_evokeds)
-        # correct_subject_average.comment = 'correct'
-
-        # incorrect_subject_evokeds = [item for item in incorrect_subject_evokeds if item is not None]
-        # incorrect_subject_average = mne.grand_average(incorrect_subject_evokeds)
-        # incorrect_subject_average.comment = 'incorrect'
-        # mne.write_evokeds(subject_average_path, evoked=[correct_subject_average, incorrect_subject_average], overwrite=True)
-
-    # Compute grand averages across all epochs
-    grand_average_correct = mne.grand_average(all_evoked_correct)
-    grand_average_correct.comment = 'correct'
-    grand_average_incorrect = mne.grand_average(all_evoked_incorrect)
-    grand_average_incorrect.comment = 'incorrect'
-
-    print("---------------- Grand Average Correct ----------------")
-    print(grand_average_correct.info)
-    print(grand_average_correct.get_data().shape)
-    print("---------------- Grand Average Incorrect ----------------")
-    print(grand_average_correct.info)
-    print(grand_average_correct.get_data())
-    print(grand_average_correct.get_data().shape)
 
+# Both condition averages of one session from a single read of its epochs (file or consolidated store).
+# Returns {'correct': Evoked or None, 'incorrect': Evoked or None}
+def average_session_epochs(subject_id, session_id, store=None):
+    if store is not None:
+        return {event_type: average_store_epochs(subject_id, session_id, event_type, store) for event_type in event_types}
+
+    epochs_path = f"{epoch_dir}/Data_S{subject_id:02}_Sess{session_id:02}_epochs_epo.fif"
+    epochs = mne.read_epochs(epochs_path, preload=True)
+
+    evokeds = {}
+    for event_type in event_types:
+        if len(epochs[event_type]) == 0:
+            print(f"No {event_type} epochs for Subject {subject_id} Session {session_id}")
+            evokeds[event_type] = None
+        else:
+            evokeds[event_type] = epochs[event_type].average()
+            evokeds[event_type].info['bads'] = epochs.info['bads']
+    return evokeds
+
+
+def evoked_path(subject_id, session_id):
+    return f"{evoked_dir}/Data_S{subject_id:02d}_Sess{session_id:02d}_evoked-ave.fif"
 
-    #-- Equalize the number of trials in multiple Epochs
-    # mne.epochs.equalize_epoch_counts([grand_average_correct, grand_average_incorrect])
 
-    # Save grand averages
+def _session_fingerprint(subject_id, session_id, previous, store):
+    # Content fingerprint of one session's epochs: its content in the store (independent of row positions, see
+    # epochs_store.session_fingerprint), or the epochs file hash, only recomputed when size/mtime changed
+    if store is not None:
+        data, metadata = store[0], store[1]
+        return dict(sha256=session_fingerprint(subject_id, session_id, data, metadata))
+
+    epochs_path = f"{epoch_dir}/Data_S{subject_id:02d}_Sess{session_id:02d}_epochs_epo.fif"
+    stat = os.stat(epochs_path)
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+        return previous
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=file_sha256(epochs_path))
+
+
+@measured_stage
+def create_grand_average(force=False):
+    # Incremental: only sessions that were added, replaced or removed since the last run are (re)averaged, the others
+    # stay in the running sums of grand_average_state. force=True rebuilds the sums from every session.
+    grand_average_dir = grand_average_state.grand_average_dir
+
+    # Ensure grand average and evoked directories exist
+    for directory in (grand_average_dir, evoked_dir):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    # Skip the whole stage when none of the epochs files changed since the last run
     grand_average_path = f"{grand_average_dir}/grand_averages-ave.fif"
-    mne.write_evokeds(grand_average_path, evoked=[grand_average_correct, grand_average_incorrect], overwrite=True)
+    if store_exists():
+        # The consolidated store holds every session, each session is a slice of one memory-mapped array
+        input_paths = store_files()
+        data, metadata, layout = open_epochs_store()
+        store = (data, metadata, layout, read_store_info())
+        kept = metadata[metadata['row'] >= 0]
+        sessions = [(i, j) for i, j in session_grid() if ((kept['subject'] == i) & (kept['session'] == j)).any()]
+    else:
+        sessions = [(i, j) for i, j in session_grid() if os.path.exists(f"{epoch_dir}/Data_S{i:02d}_Sess{j:02d}_epochs_epo.fif")]
+        input_paths = [f"{epoch_dir}/Data_S{i:02d}_Sess{j:02d}_epochs_epo.fif" for i, j in sessions]
+        store = None
+    # Outputs: the grand average plus one evoked file (correct and incorrect averages) per session
+    output_paths = [grand_average_path] + [evoked_path(i, j) for i, j in sessions]
+    params = dict(weights='equal', accumulator='exact')
+    if not force and is_fresh(output_paths, 'create_grand_average', input_paths, params):
+        print(f"Up to date, skipping {grand_average_path}")
+        return
+
+    state = grand_average_state.load_state(params)
+    unreferenced = []
+    if force:
+        unreferenced = [entry['contribution'] for entry in state['sessions'].values()]
+        state = grand_average_state.new_state(params)
+
+    # Sessions that are no longer available leave the sums
+    current_keys = {f"S{i:02d}_Sess{j:02d}" for i, j in sessions}
+    for key in [key for key in state['sessions'] if key not in current_keys]:
+        print(f"Removing {key} from the grand average")
+        unreferenced.append(grand_average_state.remove_contribution(state, key))
+
+    n_updated = 0
+    for subject_id, session_id in sessions:
+        key = f"S{subject_id:02d}_Sess{session_id:02d}"
+        previous = state['sessions'].get(key)
+        fingerprint = _session_fingerprint(subject_id, session_id, previous and previous['fingerprint'], store)
+        if previous and previous['fingerprint']['sha256'] == fingerprint['sha256'] and os.path.exists(evoked_path(subject_id, session_id)):
+            previous['fingerprint'] = fingerprint
+            continue
+
+        if previous:
+            unreferenced.append(grand_average_state.remove_contribution(state, key))
+        evokeds = average_session_epochs(subject_id, session_id, store)
+
+        # Save the session averages with their nave, for plot_data('evoked') and subject-level analyses
+        session_evokeds = [evoked for evoked in evokeds.values() if evoked is not None]
+        mne.write_evokeds(evoked_path(subject_id, session_id), evoked=session_evokeds, overwrite=True)
+
+        grand_average_state.add_contribution(state, key, evokeds, fingerprint)
+        n_updated += 1
+
+    print(f"Updated {n_updated} of {len(sessions)} sessions in the grand average")
+
+    # Compute grand averages across all sessions (nave = number of averaged sessions, as mne.grand_average sets it)
+    averages = grand_average_state.state_averages(state)
+    grand_averages = [averages[event_type] for event_type in event_types if event_type in averages]
+    for grand_average in grand_averages:
+        print(f"---------------- Grand Average {grand_average.comment.capitalize()} ----------------")
+        print(f"{grand_average.nave} sessions, shape {grand_average.data.shape}")
+
+    #-- Equalize the number of trials in multiple Epochs
+    # mne.epochs.equalize_epoch_counts([grand_average_correct, grand_average_incorrect])
 
+    # Save grand averages (FIF stores evoked data as float32 whatever the precision setting)
+    mne.write_evokeds(grand_average_path, evoked=grand_averages, overwrite=True)
+    grand_average_state.save_state(state)
+    record_output(output_paths, 'create_grand_average', input_paths, params)
 
+    # Contribution files of replaced or removed sessions are only deleted once the saved state no longer needs them
+    referenced = {entry['contribution'] for entry in state['sessions'].values()}
+    for path in unreferenced:
+        if path not in referenced and os.path.exists(path):
+            os.remove(path)
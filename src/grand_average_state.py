@@ -0,0 +1,126 @@
+import os
+import json
+import numpy as np
+import mne
+
+
+# Running state of the grand average, so sessions can be added, replaced or removed without re-averaging the others:
+#   grand_average_state.json   per condition the exact sum of the session averages and the number of sessions, plus the
+#                              contributing sessions (input fingerprint and contribution file of each)
+#   contributions/             the float64 averages each session added (needed to take it out again) and info.fif
+# Sums are kept as exact integers (every float64 is an integer multiple of 2**-scale), so the result does not depend
+# on the order sessions were added or removed and always equals a full recompute bit for bit.
+grand_average_dir = 'data/grandAverage'
+state_path = f"{grand_average_dir}/grand_average_state.json"
+contributions_dir = f"{grand_average_dir}/contributions"
+info_path = f"{contributions_dir}/info.fif"
+
+
+def new_state(params):
+    return dict(params=params, scale=0, ch_names=None, tmin=None, n_times=None, conditions={}, sessions={})
+
+
+def load_state(params):
+    # Saved state, or a new empty one when there is none or it was built with other parameters
+    if not os.path.exists(state_path):
+        return new_state(params)
+    with open(state_path) as f:
+        state = json.load(f)
+    if state['params'] != json.loads(json.dumps(params)):
+        print(f"Grand average parameters changed, rebuilding {state_path}")
+        return new_state(params)
+    for condition in state['conditions'].values():
+        condition['sum'] = [int(value, 16) for value in condition['sum']]
+    return state
+
+
+def save_state(state):
+    saved = dict(state, conditions={event_type: dict(condition, sum=[hex(value) for value in condition['sum']])
+                                    for event_type, condition in state['conditions'].items()})
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(saved, f)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def _min_exponent(values):
+    # Exponent of the least significant mantissa bit of the smallest non-zero value
+    nonzero = values[values != 0]
+    if len(nonzero) == 0:
+        return 0
+    _, exponents = np.frexp(nonzero)
+    return int(exponents.min()) - 53
+
+
+def _to_fixed(values, scale):
+    # Exact integers values * 2**scale (scale is large enough that no bit is lost)
+    mantissas, exponents = np.frexp(values.ravel())
+    mantissas = (mantissas * 2.0 ** 53).astype(np.int64)
+    shifts = exponents.astype(np.int64) - 53 + scale
+    return [int(m) << int(s) if m else 0 for m, s in zip(mantissas, shifts)]
+
+
+def _rescale(state, scale):
+    if scale <= state['scale']:
+        return
+    for condition in state['conditions'].values():
+        condition['sum'] = [value << (scale - state['scale']) for value in condition['sum']]
+    state['scale'] = scale
+
+
+def add_contribution(state, key, evokeds, fingerprint):
+    # Add one session's averages ({event_type: Evoked or None}) and save them as its contribution file
+    evokeds = {event_type: evoked for event_type, evoked in evokeds.items() if evoked is not None}
+    arrays = {event_type: np.asarray(evoked.data, dtype=np.float64) for event_type, evoked in evokeds.items()}
+    for event_type, data in arrays.items():
+        if not np.all(np.isfinite(data)):
+            raise ValueError(f"{key} {event_type} average has non-finite values")
+
+    if evokeds and state['ch_names'] is None:
+        evoked = next(iter(evokeds.values()))
+        state.update(ch_names=evoked.ch_names, tmin=float(evoked.times[0]), n_times=len(evoked.times))
+        os.makedirs(contributions_dir, exist_ok=True)
+        mne.io.write_info(info_path, evoked.info)
+    for event_type, evoked in evokeds.items():
+        if evoked.ch_names != state['ch_names'] or len(evoked.times) != state['n_times']:
+            raise ValueError(f"{key} {event_type} has different channels or times than the grand average")
+
+    if arrays:
+        _rescale(state, max(-_min_exponent(data) for data in arrays.values()))
+
+    for event_type, data in arrays.items():
+        condition = state['conditions'].setdefault(event_type, dict(count=0, sum=[0] * data.size))
+        condition['sum'] = [total + value for total, value in zip(condition['sum'], _to_fixed(data, state['scale']))]
+        condition['count'] += 1
+
+    # One file per version of the session, the previous one is only deleted once the state no longer references it
+    contribution_path = f"{contributions_dir}/{key}_{fingerprint['sha256'][:16]}.npz"
+    os.makedirs(contributions_dir, exist_ok=True)
+    np.savez(contribution_path, **arrays)
+    state['sessions'][key] = dict(fingerprint=fingerprint, contribution=contribution_path,
+                                  nave={event_type: int(evoked.nave) for event_type, evoked in evokeds.items()})
+
+
+def remove_contribution(state, key):
+    # Subtract exactly what add_contribution added for this session. Returns the contribution file, now unreferenced.
+    entry = state['sessions'].pop(key)
+    with np.load(entry['contribution']) as arrays:
+        for event_type in arrays.files:
+            condition = state['conditions'][event_type]
+            condition['sum'] = [total - value for total, value in zip(condition['sum'], _to_fixed(arrays[event_type], state['scale']))]
+            condition['count'] -= 1
+    return entry['contribution']
+
+
+def state_averages(state):
+    # Grand average per condition as Evoked (nave = number of sessions, as mne.grand_average sets it).
+    # int / int is correctly rounded, so the mean is the float64 nearest to the exact mean.
+    info = mne.io.read_info(info_path)
+    shape = (len(state['ch_names']), state['n_times'])
+    grand_averages = {}
+    for event_type, condition in state['conditions'].items():
+        if condition['count'] == 0:
+            continue
+        denominator = condition['count'] << state['scale']
+        data = np.array([total / denominator for total in condition['sum']], dtype=np.float64).reshape(shape)
+        grand_averages[event_type] = mne.EvokedArray(data, info, tmin=state['tmin'], nave=condition['count'], comment=event_type)
+    return grand_averages
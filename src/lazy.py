@@ -0,0 +1,13 @@
+import importlib
+
+
+# main.py lists every step of the analysis, but a run only calls a few of them. Its entry points are bound through
+# entry_point so that a module (and what it imports: matplotlib and its GUI backend for plot_data, the cluster engine for
+# stats_test, ...) is loaded on the first call of one of its functions instead of when main is imported.
+def entry_point(module_name, function_name):
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), function_name)(*args, **kwargs)
+
+    call.__name__ = call.__qualname__ = function_name
+    call.__doc__ = f"{module_name}.{function_name}, imported on the first call"
+    return call
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+import pandas as pd
+
+
+# Structured run records instead of print dumps. Every session task run by session_executor and every stage summary
+# appends one JSON line to the metrics file: stage, subject, session, status, wall and CPU time, peak RSS, bytes read and
+# written, and whatever counters the stage reported with add() (samples, epochs_kept, epochs_dropped ...).
+# peak_rss_mb is the highest RSS sampled while the task ran; process_peak_rss_mb is the high-water mark of the whole
+# process (ru_maxrss), which in a reused pool worker also covers the tasks it ran before.
+# The metrics file and the quiet switch live in environment variables so worker processes inherit them.
+metrics_dir = 'data/metrics'
+metrics_path_env = 'P300_METRICS_PATH'
+quiet_env = 'P300_QUIET'
+
+# Record of the task running in this process, filled by add()
+_current = None
+
+
+def metrics_path():
+    if metrics_path_env not in os.environ:
+        os.environ[metrics_path_env] = f"{metrics_dir}/run_{time.strftime('%Y%m%d_%H%M%S')}.jsonl"
+    return os.environ[metrics_path_env]
+
+
+def is_quiet():
+    return os.environ.get(quiet_env, '0') == '1'
+
+
+def set_quiet(quiet=True):
+    # Quiet mode drops the large array/info dumps (see dump) and MNE's info-level logging
+    os.environ[quiet_env] = '1' if quiet else '0'
+    _apply_log_level()
+
+
+def _apply_log_level():
+    if is_quiet():
+        import mne
+        mne.set_log_level('WARNING')
+
+
+def dump(*values):
+    # print() for large objects (arrays, info, data frames), skipped in quiet mode
+    if not is_quiet():
+        print(*values)
+
+
+def add(**counters):
+    # Add counters to the record of the current task, e.g. add(samples=n_channels * n_times, epochs_kept=40)
+    if _current is not None:
+        for name, value in counters.items():
+            _current[name] = _current.get(name, 0) + value
+
+
+def _io_bytes():
+    # Bytes this process read from / wrote to storage (Linux /proc; zeros elsewhere)
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _rss_mb():
+    # Resident set size of this process now (Linux /proc; None elsewhere)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _RssSampler(threading.Thread):
+    # Samples the RSS every interval seconds until stopped, keeping the highest value
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = _rss_mb()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = _rss_mb()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        rss = _rss_mb()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+        return self.peak
+
+
+def write_record(record):
+    path = metrics_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # One write per line in append mode, so records of parallel workers do not interleave
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def measure(stage, subject=None, session=None):
+    # Measure one task; yields the record, which is written when the task ends (status set by the caller)
+    global _current
+    record = dict(stage=stage, subject=subject, session=session, status='ok')
+    previous, _current = _current, record
+    read_start, write_start = _io_bytes()
+    sampler = _RssSampler()
+    sampler.start()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        read_end, write_end = _io_bytes()
+        record.update(wall_time=time.perf_counter() - start, cpu_time=time.process_time() - cpu_start,
+                      peak_rss_mb=sampler.stop(), process_peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                      bytes_read=read_end - read_start, bytes_written=write_end - write_start)
+        _current = previous
+        write_record(record)
+
+
+def measured_stage(stage_fn):
+    # Decorator for stages that do not go through session_executor (one task for the whole stage): the call is
+    # measured and written as the stage record
+    @functools.wraps(stage_fn)
+    def wrapper(*args, **kwargs):
+        with measure(stage_fn.__name__) as record:
+            record['status'] = 'stage'
+            return stage_fn(*args, **kwargs)
+    return wrapper
+
+
+def stage_record(stage, results):
+    # One record for a whole stage from its session results (sums of the per-session figures). wall_time is the
+    # elapsed time from the first session start to the last session end, so parallel stages are not counted n_jobs
+    # times; the summed session wall times are task_time. cpu_time stays the total over all workers.
+    record = dict(stage=stage, subject=None, session=None, status='stage', n_tasks=len(results))
+    for result in results:
+        for name, value in result.get('metrics', {}).items():
+            if name in ('subject', 'session'):
+                continue
+            if name in ('peak_rss_mb', 'process_peak_rss_mb'):
+                if value is not None:
+                    record[name] = max(record.get(name, 0), value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = 'task_time' if name == 'wall_time' else name
+                record[name] = record.get(name, 0) + value
+
+    spans = [(result['started'], result['finished']) for result in results if 'started' in result]
+    if spans:
+        record['wall_time'] = max(end for _, end in spans) - min(start for start, _ in spans)
+    elif 'task_time' in record:
+        record['wall_time'] = record['task_time']
+    write_record(record)
+    return record
+
+
+def print_metrics_summary(path=None):
+    # End-of-run table: one row per stage with the summed session figures
+    path = path or metrics_path()
+    if not os.path.exists(path):
+        print(f"No metrics recorded in {path}")
+        return None
+    records = pd.read_json(path, lines=True)
+    stages = records[records['status'] == 'stage'].drop(columns=['subject', 'session', 'status'], errors='ignore')
+    columns = [name for name in ['stage', 'n_tasks', 'wall_time', 'task_time', 'cpu_time', 'peak_rss_mb', 'process_peak_rss_mb', 'bytes_read', 'bytes_written',
+                                 'samples', 'epochs_kept', 'epochs_dropped'] if name in stages.columns]
+    summary = stages[columns].groupby('stage', sort=False).sum(min_count=1)
+    # Peaks are maxima over the tasks, not sums; peak_rss_mb is per task, process_peak_rss_mb the worker high-water mark
+    for name in ('peak_rss_mb', 'process_peak_rss_mb'):
+        if name in summary.columns:
+            summary[name] = stages.groupby('stage', sort=False)[name].max()
+    for name in ('bytes_read', 'bytes_written'):
+        if name in summary.columns:
+            summary[name.replace('bytes', 'mb')] = summary.pop(name) / 1e6
+
+    print(f"---------------- Metrics ({path}) ----------------")
+    print(summary.to_string(float_format='%.1f'))
+    return summary
+
+
+_apply_log_level()
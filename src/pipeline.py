@@ -0,0 +1,175 @@
+import os
+import numpy as np
+import pandas as pd
+import mne
+
+from src.session_executor import run_sessions, print_session_summary
+from src.preprocessing import apply_rereference, apply_bandpass, apply_ica, original_raw_dir, referenced_dir, filtered_dir, cleaned_dir
+from src.get_erp import get_session_events, event_source_path, epoch_raw, epoch_dir, feedback_labels_path, default_reject_criteria
+from src.stage_cache import is_fresh, record_output
+from src.precision import fif_fmt
+from src.epochs_store import append_epochs
+from src import metrics
+from src.bad_channels import detect_bad_channels, session_bad_channels
+
+
+# Intermediate stages that can be written on request, with the directory, file suffix and stage cache name the
+# stand-alone stages use
+stage_outputs = {
+    'rereference': (referenced_dir, 'referenced_raw', 'rereference'),
+    'filter': (filtered_dir, 'filtered_raw', 'filter_data'),
+    'ica': (cleaned_dir, 'cleaned_raw', 'remove_artifact'),
+}
+
+
+def run_pipeline(low_freq, high_freq, n_components, random_state, max_iter="auto", sfreq=200, reject_criteria=None, save_stages=(),
+                 input_dir=original_raw_dir, identifier='raw', event_source='csv', filter_method='fir', n_jobs=1, force=False):
+    ##################################################################
+    #   Rereference -> Bandpass -> ICA -> Epochs on one in-memory Raw
+    ##################################################################
+    # Only the epochs are always written, intermediates are written only for the stages listed in save_stages
+    for stage in save_stages:
+        if stage not in stage_outputs:
+            raise ValueError(f"Unknown stage '{stage}', expected one of {list(stage_outputs)}")
+
+    for output_dir in [stage_outputs[stage][0] for stage in save_stages] + [epoch_dir]:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    # Load the feedback labels (the event index already has them joined in)
+    feedback_labels_df = pd.read_csv(feedback_labels_path) if event_source != 'index' else None
+    bad_channels_table = detect_bad_channels()
+
+    results = run_sessions(_run_session_pipeline, n_jobs=n_jobs, low_freq=low_freq, high_freq=high_freq, n_components=n_components,
+                           random_state=random_state, max_iter=max_iter, sfreq=sfreq, reject_criteria=reject_criteria,
+                           save_stages=tuple(save_stages), input_dir=input_dir, identifier=identifier, event_source=event_source, filter_method=filter_method, feedback_labels_df=feedback_labels_df, bad_channels_table=bad_channels_table, force=force)
+    print_session_summary('run_pipeline', results)
+
+    print("run pipeline")
+    return results
+
+
+def _save_stage(raw, stage, subject, session, save_stages, input_path, params):
+    # Writes the stage's file with the stage cache record the stand-alone stage would write, so filter_data,
+    # remove_artifact and plot_data take it as up to date. The record needs the stage's input file as written by this
+    # run (input_path None: the previous stage was not saved, the file on disk may be from another run), so the file is
+    # then saved without one. Returns the saved path, the input of the next stage.
+    if stage not in save_stages:
+        return None
+    output_dir, suffix, cache_stage = stage_outputs[stage]
+    output_file_path = f"{output_dir}/Data_S{subject:02d}_Sess{session:02d}_{suffix}.fif"
+    raw.save(output_file_path, fmt=fif_fmt(), overwrite=True)
+    if input_path is not None:
+        record_output(output_file_path, cache_stage, [input_path], params)
+    print(f"=========================> Saved {stage} data to {output_file_path}")
+    return output_file_path
+
+
+def _run_session_pipeline(subject, session, low_freq, high_freq, n_components, random_state, max_iter, sfreq, reject_criteria,
+                          save_stages, input_dir, identifier, feedback_labels_df, event_source='csv', filter_method='fir', bad_channels_table=None, force=False):
+    file_path = f"{input_dir}/Data_S{subject:02d}_Sess{session:02d}_{identifier}.fif"
+    event_input_path = event_source_path(subject, session, event_source, sfreq)
+    print(file_path)
+
+    if not (os.path.exists(file_path) and event_input_path is not None):
+        print(f"Missing file for Subject {subject}, Session {session}.")
+        return 'skipped'
+
+    epoch_file_path = f"{epoch_dir}/Data_S{subject:02d}_Sess{session:02d}_epochs_epo.fif"
+    input_paths = [file_path, event_input_path, feedback_labels_path]
+    dropped, interpolated = session_bad_channels(subject, session, bad_channels_table)
+    params = dict(bads=dropped, interpolated=interpolated, low_freq=low_freq, high_freq=high_freq, filter_method=filter_method, n_components=n_components, random_state=random_state, max_iter=max_iter,
+                  sfreq=sfreq, reject_criteria=reject_criteria or default_reject_criteria, save_stages=save_stages, precision=fif_fmt())
+    if not force and is_fresh(epoch_file_path, 'run_pipeline', input_paths, params):
+        print(f"Up to date, skipping {epoch_file_path}")
+        return 'cached'
+
+    # The only read of the session, every stage below works on this Raw in place
+    raw = mne.io.read_raw_fif(file_path, preload=True)
+
+    # Saved stages are recorded with the parameters of rereference / filter_data / remove_artifact (ICA: fitted from
+    # scratch, default EOG threshold, no manual exclusions)
+    apply_rereference(raw, dropped, interpolated)
+    saved_path = _save_stage(raw, 'rereference', subject, session, save_stages, file_path,
+                             dict(bads=dropped, interpolated=interpolated, reference='average', precision=fif_fmt()))
+
+    apply_bandpass(raw, low_freq, high_freq, filter_method)
+    saved_path = _save_stage(raw, 'filter', subject, session, save_stages, saved_path,
+                             dict(low_freq=low_freq, high_freq=high_freq, method=filter_method, precision=fif_fmt()))
+
+    apply_ica(raw, n_components, random_state, max_iter)
+    _save_stage(raw, 'ica', subject, session, save_stages, saved_path,
+                dict(n_components=n_components, random_state=random_state, max_iter=max_iter, method='fastica', eog_threshold=3.0, exclude=[], precision=fif_fmt()))
+
+    events = get_session_events(subject, session, sfreq, feedback_labels_df, event_source)
+    epochs_auto_rejected = epoch_raw(raw, events, reject_criteria)
+    metrics.add(samples=raw.n_times, epochs_kept=len(epochs_auto_rejected), epochs_dropped=len(events) - len(epochs_auto_rejected))
+    append_epochs(epochs_auto_rejected, events, subject, session)
+
+    if len(epochs_auto_rejected) == 0:
+        print("No epochs left after equalizing. Skipping saving.")
+        return 'skipped'
+
+    # Save epoched data
+    epochs_auto_rejected.save(epoch_file_path, fmt=fif_fmt(), overwrite=True)
+    record_output(epoch_file_path, 'run_pipeline', input_paths, params)
+    print(f"=====================================> Saved epoch data to {epoch_file_path}")
+
+
+def _round_to_single(data):
+    return data.astype(np.float32).astype(np.float64)
+
+
+def check_precision(subject, session, low_freq, high_freq, n_components, random_state, max_iter="auto", sfreq=200,
+                    input_dir=original_raw_dir, identifier='raw', event_source='csv'):
+    ##################################################################
+    #   Max deviation of single precision storage vs the float64 path
+    ##################################################################
+    # Runs one session through the chain twice: once in float64, once rounding the data to float32 after every stage,
+    # exactly what writing and re-reading each intermediate with fmt='single' does
+    file_path = f"{input_dir}/Data_S{subject:02d}_Sess{session:02d}_{identifier}.fif"
+    feedback_labels_df = pd.read_csv(feedback_labels_path) if event_source != 'index' else None
+    events = get_session_events(subject, session, sfreq, feedback_labels_df, event_source)
+    dropped, interpolated = session_bad_channels(subject, session)
+
+    stages = [
+        ('rereference', lambda raw: apply_rereference(raw, dropped, interpolated)),
+        ('filter', lambda raw: apply_bandpass(raw, low_freq, high_freq)),
+        ('ica', lambda raw: apply_ica(raw, n_components, random_state, max_iter)),
+    ]
+
+    raws = {}
+    for precision in ('double', 'single'):
+        raw = mne.io.read_raw_fif(file_path, preload=True)
+        if precision == 'single':
+            raw.apply_function(_round_to_single, picks='all', channel_wise=False)
+        raws[precision] = raw
+
+    report = []
+    for stage, apply_stage in stages:
+        for precision, raw in raws.items():
+            apply_stage(raw)
+            if precision == 'single':
+                raw.apply_function(_round_to_single, picks='all', channel_wise=False)
+        report.append((stage, raws['double'].get_data(), raws['single'].get_data()))
+
+    epochs = {precision: epoch_raw(raw, events) for precision, raw in raws.items()}
+    epochs['single'].apply_function(_round_to_single, picks='all', channel_wise=False)
+    report.append(('epochs', epochs['double'].get_data(), epochs['single'].get_data()))
+    for condition in ('correct', 'incorrect'):
+        report.append((f'evoked {condition}', epochs['double'][condition].average().data, epochs['single'][condition].average().data))
+
+    print(f"-------- Single vs double precision, Subject {subject} Session {session} --------")
+    results = {}
+    for stage, double_data, single_data in report:
+        if double_data.shape != single_data.shape:
+            # e.g. a different number of epochs survived the rejection threshold
+            print(f"{stage:>18}: shapes differ {double_data.shape} vs {single_data.shape}")
+            results[stage] = None
+            continue
+        max_deviation = np.max(np.abs(double_data - single_data))
+        relative = max_deviation / np.sqrt(np.mean(double_data ** 2))
+        print(f"{stage:>18}: max deviation {max_deviation * 1e6:.3e} uV ({relative:.2e} of the signal RMS)")
+        results[stage] = max_deviation
+
+    return results
@@ -1,10 +1,30 @@
 import os
+import sys
 import matplotlib
-matplotlib.use('TkAgg')
+
+
+figures_dir = 'data/figures'
+
+
+def select_backend():
+    # TkAgg windows when there is a display, Agg (figures saved to figures_dir) on a headless machine.
+    # A backend set through MPLBACKEND is left alone.
+    if os.environ.get('MPLBACKEND'):
+        return matplotlib.get_backend()
+    headless = sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    if not headless:
+        try:
+            import tkinter
+        except ImportError:
+            headless = True
+    matplotlib.use('Agg' if headless else 'TkAgg')
+    return matplotlib.get_backend()
+
+
+select_backend()
 import matplotlib.pyplot as plt
 import numpy as np
 import mne
-from mne.stats import permutation_cluster_test
 
 
 channel_names = [ 'AF3', 'AF4', 'F7', 'F5', 'F3', 'F1', 'Fz', 'F2', 'F4', 'F6', 'F8', 'FT7', 'FC5', 'FC3', 'FC1', 'FCz', 'FC2', 'FC4', 'FC6', 'FT8',
@@ -240,61 +260,20 @@ def plot_data(type, subject=None, session=None):
         # fig, anim = difference_evoked.animate_topomap(ch_type="eeg", times=times, frame_rate=2, butterfly=True, blit=False, time_unit="ms")
         # Save Animation
         # anim.save('diff_peak_animation.mp4', writer='ffmpeg', fps=10)
+        #-- Faster, one interpolation matrix for all frames (see topo_animation):
+        # from src.topo_animation import animate_evoked
+        # animate_evoked(difference_evoked, 'diff_peak_animation.mp4', times=times, fps=10)
 
     ########## Conduct Permutation Cluster Test for Correct and Incorrect Responses
     if type == "cluster_permutation":
 
-        #-- Get data for each condition over each epoch (each observation)
-        epochs_dir = "data/epochs"
-        
-        data_correct = []
-        data_incorrect = []
-        for subject_id in range(1, 27):    # Loop through subjects
-            for session_id in range(1, 6):    # Loop through sessions
-                # Define path and read epochs data for this session
-                file_path = f'{epochs_dir}/Data_S{subject_id:02d}_Sess{session_id:02d}_epochs_epo.fif'
-                epochs = mne.read_epochs(file_path, preload=True)
-
-                # Append data for each event type to the aggregate list
-                data_correct.append(epochs['correct'].get_data(copy=True))
-                data_incorrect.append(epochs['incorrect'].get_data(copy=True))
-
-        # Convert lists of arrays into a single array for each condition
-        data_correct = np.concatenate(data_correct, axis=0)  # Shape (n_correct_epochs, n_channels, n_timepoints)
-        data_incorrect = np.concatenate(data_incorrect, axis=0)  # Shape (n_incorrect_epochs, n_channels, n_timepoints)
-
-        print("-------------------- Data Correct --------------------")
-        print(data_correct)
-        print(data_correct.shape)
-        print("-------------------- Data Incorrect --------------------")
-        print(data_incorrect)
-        print(data_incorrect.shape)
-
-        # Conduct the permutation cluster test
-        X = [data_correct, data_incorrect]
-        T_obs, clusters, cluster_p_values, H0 = permutation_cluster_test(X, threshold=0.05, n_permutations=1000, tail=1)
-        # Observed Statistic
-        print("------------------ T_obs --------------------")
-        print(T_obs)
-        # Cluster Information
-        print("------------------ Clusters --------------------")
-        print(clusters)
-        # p-values for each cluster
-        print("------------------ cluster_p_values --------------------")
-        print(cluster_p_values)
-        # Permutation distribution of the max statistic
-        print("------------------ H0 --------------------")
-        print(H0)
-
-
-        # Get info and start time from any existing Evoked object
-        sample_epoch_path = f"{epochs_dir}/Data_S01_Sess01_epochs_epo.fif"
-        sample_epoch = mne.read_epochs(sample_epoch_path, preload=True)
-        info = sample_epoch[0].info
-        tmin = sample_epoch[0].times[0]
-
-        print("-------------------- Info --------------------")
-        print(info)
+        from src.stats_test import compute_cluster_permutation
+
+        #-- Saved test result (data/stats/cluster_test.npz), the test only reruns when the epochs or parameters changed
+        result = compute_cluster_permutation(p_threshold=0.05, n_permutations=1000, n_jobs=-1)
+        T_obs, clusters, cluster_p_values = result['T_obs'], result['clusters'], result['cluster_p_values']
+        info, tmin = result['info'], result['tmin']
+        print(f"{len(clusters)} clusters, p-values {cluster_p_values}, {result['n_permutations']} permutations")
 
         # Create an Evoked object containing the T-values from the permutation test 
         t_evoked = mne.EvokedArray(T_obs, info, tmin=tmin)
@@ -323,9 +302,24 @@ def plot_data(type, subject=None, session=None):
         # fig, anim = t_evoked.animate_topomap(ch_type="eeg", times=times, frame_rate=2, butterfly=True, blit=False, time_unit="ms")
         # Save Animation
         # anim.save('tval_topo_animation.mp4', writer='ffmpeg', fps=10)
+        # from src.topo_animation import animate_evoked
+        # animate_evoked(t_evoked, 'tval_topo_animation.mp4', fps=10)
 
-    # Use plt.show() to dislay all plots at once
-    plt.show()
+    # Use plt.show() to dislay all plots at once (no window on a headless machine, the figures are saved instead)
+    if matplotlib.get_backend().lower() == 'agg':
+        _save_figures(type, subject, session)
+    else:
+        plt.show()
 
     print(f"plot {type} data")
 
+
+def _save_figures(type, subject=None, session=None):
+    if not os.path.exists(figures_dir):
+        os.makedirs(figures_dir)
+    name = '_'.join(part for part in (type, subject and f"S{subject}", session and f"Sess{session}") if part)
+    for k, number in enumerate(plt.get_fignums()):
+        figure_path = f"{figures_dir}/{name}_{k + 1}.png"
+        plt.figure(number).savefig(figure_path, dpi=100)
+        print(f"Saved figure to {figure_path}")
+    plt.close('all')
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+
+
+# Precision used for everything the pipeline writes: 'double' (float64, the original behaviour) or 'single' (float32).
+# The data comes from a 200 Hz amplifier so float32 is plenty. The P300_PRECISION environment variable sets the default,
+# set_precision() changes it for this process and for worker processes started afterwards.
+# This is a storage setting: the files are written and re-read in that precision, and the arrays the pipeline holds
+# itself (session store, consolidated epochs store) are memory-mapped in it. Rereference, filter, ICA and epoching keep
+# computing in float64, MNE upcasts Raw/Epochs data to float64 in those steps anyway; check_precision in pipeline
+# measures what rounding every intermediate to float32 costs.
+storage_precision = os.environ.get('P300_PRECISION', 'double')
+
+
+def set_precision(precision):
+    # 'single' halves what is written and read between stages; in-memory processing stays float64 (see above)
+    global storage_precision
+    if precision not in ('single', 'double'):
+        raise ValueError(f"Unknown precision '{precision}', expected 'single' or 'double'")
+    storage_precision = precision
+    os.environ['P300_PRECISION'] = precision
+
+
+def fif_fmt():
+    # Value for the fmt argument of Raw.save / Epochs.save
+    return storage_precision
+
+
+def storage_dtype():
+    # dtype for arrays the pipeline stores itself (session store, consolidated epochs)
+    return np.float32 if storage_precision == 'single' else np.float64
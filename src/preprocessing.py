@@ -2,7 +2,15 @@ import pandas as pd
 import numpy as np
 import os
 import mne
-import matplotlib.pyplot as plt
+
+from src.session_executor import run_sessions, print_session_summary, num_sessions, subject_grid
+from src.stage_cache import is_fresh, record_output
+from src.precision import fif_fmt
+from src.filter_engine import filter_raws
+from src.chunked import _rereference_session_chunked, _filter_session_chunked, _remove_artifact_session_chunked
+from src import metrics
+from src.metrics import dump
+from src.bad_channels import detect_bad_channels, session_bad_channels
 
 
 all_data_dir = 'data/allData'
@@ -11,14 +19,13 @@ filtered_dir = 'data/preprocessed/bandpassFiltered'
 cleaned_dir = 'data/preprocessed/artifactRemoved'
 referenced_dir = 'data/preprocessed/rereferenced'
 interpolated_dir = 'data/preprocessed/interpolated'
+ica_dir = 'data/ica'
 
 
-# bads = ['POz', 'T7', 'T8', 'F7', 'F8', 'FT7', 'FT8', 'Fp1', 'Fp2', 'AF7', 'AF3', 'AF4', 'AF8']
-bads = ['POz', 'Fp1', 'Fp2', 'AF7', 'AF8']
-
+def interpolate_bads(n_jobs=1, force=False):
+    # Interpolates every channel detect_bad_channels flagged in the session (including the ones rereference drops
+    # from all sessions), so data/preprocessed/interpolated keeps the full channel set
 
-def interpolate_bads():
-    
     # Define output directory to save the rereferenced data
     output_dir = interpolated_dir
     
@@ -26,78 +33,61 @@ def interpolate_bads():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Iterate Over Session Files to load each EEG session data (Make sure all sessions exist)
-    session_files = ["{}/Data_S{:02d}_Sess{:02d}_raw.fif".format(original_raw_dir, i, j)
-                    for i in range(1, 26+1)
-                    for j in range(1, 5+1)]
-    
-    
-    for file_path in session_files:
-        base_name = os.path.basename(file_path)   # Get the file name from full path
-        result_name = base_name.replace(f'_raw.fif', '_interpolated_raw.fif')   # Replace the extention
-        output_file_path = os.path.join(output_dir, result_name)   # Construct the full output file path to save the filtered data to
-
-        print(file_path)
-
-        try:
-            print("--------- Original Raw Data ----------")
-            # Create a RawArray object
-            raw = mne.io.read_raw_fif(file_path, preload=True)
+    table = detect_bad_channels()
 
+    # Iterate Over Session Files to load each EEG session data (Make sure all sessions exist)
+    results = run_sessions(_interpolate_session, n_jobs=n_jobs, table=table, force=force)
+    print_session_summary('interpolate_bads', results)
 
-            # Step 1: Calculate statistical measures
-            variance_per_channel = np.var(raw.get_data(), axis=1)  # Variance for each channel
-            mean_per_channel = np.mean(np.abs(raw.get_data()), axis=1)     # Mean amplitude for each channel
+    print('get bads')
+    return results
 
-            # Step 2: Compute signal-to-noise ratio (SNR)
-            noise_level_per_channel = np.sqrt(variance_per_channel)  # Estimate noise level as standard deviation
-            snr_per_channel = mean_per_channel / noise_level_per_channel
 
-            # Step 3: Set threshold for SNR to identify bad channels
-            snr_threshold = 0.7  # Adjust as needed
-            bad_channels = [raw.info['ch_names'][i] for i, snr in enumerate(snr_per_channel) if snr < snr_threshold and 'EOG' not in raw.info['ch_names'][i]]
+def _interpolate_session(subject, session, table, force=False):
+    file_path = "{}/Data_S{:02d}_Sess{:02d}_raw.fif".format(original_raw_dir, subject, session)
+    base_name = os.path.basename(file_path)   # Get the file name from full path
+    result_name = base_name.replace(f'_raw.fif', '_interpolated_raw.fif')   # Replace the extention
+    output_file_path = os.path.join(interpolated_dir, result_name)   # Construct the full output file path to save the filtered data to
 
-            print(bad_channels)
+    print(file_path)
 
-            # Step 4: Visualize SNR distribution
-            # plt.figure(figsize=(8, 6))
-            # plt.hist(snr_per_channel, bins=20, color='skyblue', edgecolor='black')
-            # plt.axvline(x=snr_threshold, color='red', linestyle='--', label='SNR Threshold')
-            # plt.xlabel('SNR')
-            # plt.ylabel('Frequency')
-            # plt.title('Signal-to-Noise Ratio (SNR) Distribution')
-            # plt.legend()
-            # plt.show()
+    if not os.path.exists(file_path):
+        print(f"Missing file for Subject {subject}, Session {session}.")
+        return 'skipped'
 
-            # Interpolate bad channels
-            raw.info['bads'] = bad_channels
-            raw_interpolated = raw.copy().interpolate_bads(reset_bads=False)
+    rows = table[(table['subject'] == subject) & (table['session'] == session)]
+    bad_channels = list(rows.loc[rows['bad'], 'channel'])
+    params = dict(bads=bad_channels, precision=fif_fmt())
+    if not force and is_fresh(output_file_path, 'interpolate_bads', [file_path], params):
+        print(f"Up to date, skipping {output_file_path}")
+        return 'cached'
 
-            # Set the average reference
-            # raw_avg_ref = raw.copy().set_eeg_reference('average', projection=True)
-            # print(raw.info)
+    print("--------- Original Raw Data ----------")
+    # Create a RawArray object
+    raw = mne.io.read_raw_fif(file_path, preload=True)
+    metrics.add(samples=raw.n_times)
+    print(bad_channels)
 
-            # Save the preprocessed data to /Preprocessing/BandpassFiltered directory
-            raw_interpolated.save(output_file_path, fmt='double', overwrite=True)
-            print(f"=========================> Saved interpolated_data data to {output_file_path}")
+    # Interpolate bad channels
+    raw.info['bads'] = bad_channels
+    raw.interpolate_bads(reset_bads=False)
 
-        except Exception as e:
-            print(f"Error processing {file_path}: {e}")
+    # Save the preprocessed data to /Preprocessing/BandpassFiltered directory
+    raw.save(output_file_path, fmt=fif_fmt(), overwrite=True)
+    record_output(output_file_path, 'interpolate_bads', [file_path], params)
+    print(f"=========================> Saved interpolated_data data to {output_file_path}")
 
-    print('get bads')
 
-def filter_data(low_freq, high_freq):
+def filter_data(low_freq, high_freq, method='fir', chunk_sec=None, n_jobs=1, force=False):
 
     ##################################################################
     #                  Filter Data by Bandpass Filters      
     ##################################################################
-    # Iterate Over Session Files to load each EEG session data (Make sure all sessions exist)
-    session_files = ["{}/Data_S{:02d}_Sess{:02d}_referenced_raw.fif".format(referenced_dir, i, j)
-                    for i in range(1, 26+1)
-                    for j in range(1, 5+1)]
-
     # low_freq, high_freq = 0.1, 40  #-- Frequency band for P300
-    montage = mne.channels.make_standard_montage('standard_1020')  # For electrode locations
+    # method='fir' is the zero-phase firwin filter of raw.filter, method='iir' a cheaper zero-phase Butterworth
+    # (see filter_engine). Each session is its own task; the FIR kernel is designed once per worker and band and reused.
+    # chunk_sec streams each session through the FIR filter in chunks of that many seconds instead (see chunked), so a
+    # worker's memory no longer grows with the recording length.
 
     # Define output directory and file to save filtered data
     output_dir = filtered_dir
@@ -106,154 +96,394 @@ def filter_data(low_freq, high_freq):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for file_path in session_files:
-        base_name = os.path.basename(file_path)   # Get the file name from full path
-        filtered_base_name = base_name.replace('_referenced_raw.fif', '_filtered_raw.fif')   # Replace the extention
-        output_file_path = os.path.join(output_dir, filtered_base_name)   # Construct the full output file path to save the filtered data to
+    # Iterate Over Session Files to load each EEG session data (Make sure all sessions exist)
+    if chunk_sec:
+        results = run_sessions(_filter_session_chunked, n_jobs=n_jobs, low_freq=low_freq, high_freq=high_freq, chunk_sec=chunk_sec, method=method, force=force)
+    else:
+        results = run_sessions(_filter_session, n_jobs=n_jobs, low_freq=low_freq, high_freq=high_freq, method=method, force=force)
+    print_session_summary('filter_data', results)
 
-        print(file_path)
+    return results
 
-        try:
-            # Create a RawArray object
-            raw = mne.io.read_raw_fif(file_path, preload=True)
 
-            # Set the montage (electrode locations)
-            raw.set_montage(montage)
+def _filter_session(subject, session, low_freq, high_freq, method='fir', force=False):
+    file_path = "{}/Data_S{:02d}_Sess{:02d}_referenced_raw.fif".format(referenced_dir, subject, session)
+    base_name = os.path.basename(file_path)   # Get the file name from full path
+    filtered_base_name = base_name.replace('_referenced_raw.fif', '_filtered_raw.fif')   # Replace the extention
+    output_file_path = os.path.join(filtered_dir, filtered_base_name)   # Construct the full output file path to save the filtered data to
 
-            print("-------- Original info --------")
-            print(raw.info)
+    print(file_path)
 
-            # -------------------- Bandpass Filter --------------------
-            # Filter the data
-            raw_filtered = raw.copy().filter(low_freq, high_freq, method='fir', fir_design='firwin', verbose=True)
+    if not os.path.exists(file_path):
+        print(f"Missing file for Subject {subject}, Session {session}.")
+        return 'skipped'
 
-            # Examine the shape of the data
-            print("-------- Bandpass filtered info --------")
-            print(raw_filtered.get_data().shape)
-            print(raw_filtered.info)
+    params = dict(low_freq=low_freq, high_freq=high_freq, method=method, precision=fif_fmt())
+    if not force and is_fresh(output_file_path, 'filter_data', [file_path], params):
+        print(f"Up to date, skipping {output_file_path}")
+        return 'cached'
 
-            # Save the preprocessed data to /Preprocessing/BandpassFiltered directory
-            raw_filtered.save(output_file_path, fmt='double', overwrite=True)
-            print(f"=========================> Saved filtered data to {output_file_path}")
+    # Create a RawArray object
+    raw = mne.io.read_raw_fif(file_path, preload=True)
+    metrics.add(samples=raw.n_times)
 
-        except Exception as e:
-            print(f"Error processing {file_path}: {e}")
+    apply_bandpass(raw, low_freq, high_freq, method, labels=[f"S{subject:02d} Sess{session:02d}"])
 
-    # Reset the first iteration flag
-    # first_iter = True
+    # Save the preprocessed data to /Preprocessing/BandpassFiltered directory
+    raw.save(output_file_path, fmt=fif_fmt(), overwrite=True)
+    record_output(output_file_path, 'filter_data', [file_path], params)
+    print(f"=========================> Saved filtered data to {output_file_path}")
 
 
-def rereference(original_dir, identifier):
+def apply_bandpass(raw, low_freq, high_freq, method='fir', labels=None):
+    # Bandpass filter a loaded Raw (or a list of Raws with the same sfreq, filtered as one batch) in place
+    # (shared by filter_data and the fused pipeline)
+    raws = raw if isinstance(raw, list) else [raw]
+    montage = mne.channels.make_standard_montage('standard_1020')  # For electrode locations
 
-    # Define output directory to save the rereferenced data
-    output_dir = referenced_dir
-    
-    # Ensure output directory exists
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    # Set the montage (electrode locations)
+    for session_raw in raws:
+        session_raw.set_montage(montage)
 
-    # Iterate Over Session Files to load each EEG session data (Make sure all sessions exist)
-    session_files = ["{}/Data_S{:02d}_Sess{:02d}_{}.fif".format(original_dir, i, j, identifier)
-                    for i in range(1, 26+1)
-                    for j in range(1, 5+1)]
-    
-    
-    for file_path in session_files:
-        base_name = os.path.basename(file_path)   # Get the file name from full path
-        averaged_base_name = base_name.replace(f'_{identifier}.fif', '_referenced_raw.fif')   # Replace the extention
-        output_file_path = os.path.join(output_dir, averaged_base_name)   # Construct the full output file path to save the filtered data to
+    # -------------------- Bandpass Filter --------------------
+    # Filter the data (kernel designed once per sfreq and band)
+    filter_raws(raws, low_freq, high_freq, method, labels)
 
-        print(file_path)
+    # Examine the shape of the data
+    print("-------- Bandpass filtered info --------")
+    dump([session_raw.get_data().shape for session_raw in raws])
 
-        try:
-            print("--------- Original Raw Data ----------")
-            # Create a RawArray object
-            raw = mne.io.read_raw_fif(file_path, preload=True)
+    return raw
 
-            # Remove bad channels
-            raw.info['bads'] = bads
-            raw.drop_channels(ch_names=bads)
 
-            # Set the average reference
-            raw_avg_ref = raw.copy().set_eeg_reference('average', projection=True)
-            print(raw.info)
+def rereference(original_dir, identifier, chunk_sec=None, n_jobs=1, force=False):
+    # chunk_sec copies the samples through in chunks of that many seconds instead of loading each session (see chunked)
 
-            # Save the preprocessed data to /Preprocessing/BandpassFiltered directory
-            raw_avg_ref.save(output_file_path, fmt='double', overwrite=True)
-            print(f"=========================> Saved average referenced data to {output_file_path}")
+    # Define output directory to save the rereferenced data
+    output_dir = referenced_dir
+    
+    # Ensure output directory exists
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-        except Exception as e:
-            print(f"Error processing {file_path}: {e}")
+    # Bad channels of every session (data/badChannels/bad_channels.csv), only recomputed when the recordings changed
+    table = detect_bad_channels()
 
+    # Iterate Over Session Files to load each EEG session data (Make sure all sessions exist)
+    if chunk_sec:
+        results = run_sessions(_rereference_session_chunked, n_jobs=n_jobs, original_dir=original_dir, identifier=identifier, chunk_sec=chunk_sec, table=table, force=force)
+    else:
+        results = run_sessions(_rereference_session, n_jobs=n_jobs, original_dir=original_dir, identifier=identifier, table=table, force=force)
+    print_session_summary('rereference', results)
 
     print('average reference')
+    return results
 
 
-def remove_artifact(n_components, random_state, max_iter="auto"):
+def _rereference_session(subject, session, original_dir, identifier, table=None, force=False):
+    file_path = "{}/Data_S{:02d}_Sess{:02d}_{}.fif".format(original_dir, subject, session, identifier)
+    base_name = os.path.basename(file_path)   # Get the file name from full path
+    averaged_base_name = base_name.replace(f'_{identifier}.fif', '_referenced_raw.fif')   # Replace the extention
+    output_file_path = os.path.join(referenced_dir, averaged_base_name)   # Construct the full output file path to save the filtered data to
 
-    # Ensure cleaned directory exists
-    if not os.path.exists(cleaned_dir):
-        os.makedirs(cleaned_dir)
-    
+    print(file_path)
 
-    ##################################################################
-    #                  Remove EOG from EEG using ICA      
-    ##################################################################    
-    # Iterate Over BandpassFiltered Files to load Filtered EEG data (Iterate through each one to confirm the existence of each session file)
-    session_paths = ["{}/Data_S{:02d}_Sess{:02d}_filtered_raw.fif".format(filtered_dir, i, j)
-                    for i in range(1, 26+1)
-                    for j in range(1, 5+1)]
-
-    
-    for file_path in session_paths:
-        print('==============================================================================================')
-        print('==============================================================================================')
-        print(file_path)
-        file_name = os.path.basename(file_path)
+    if not os.path.exists(file_path):
+        print(f"Missing file for Subject {subject}, Session {session}.")
+        return 'skipped'
 
-        # Load the preprocessed .fif file
-        raw = mne.io.read_raw_fif(file_path, preload=True)
+    dropped, interpolated = session_bad_channels(subject, session, table)
+    params = dict(bads=dropped, interpolated=interpolated, reference='average', precision=fif_fmt())
+    if not force and is_fresh(output_file_path, 'rereference', [file_path], params):
+        print(f"Up to date, skipping {output_file_path}")
+        return 'cached'
 
-        # Initialize and fit ICA
-        ica = mne.preprocessing.ICA(n_components=n_components, random_state=random_state, method='fastica', max_iter=max_iter)
-        ica.fit(raw)
+    print("--------- Original Raw Data ----------")
+    # Create a RawArray object
+    raw = mne.io.read_raw_fif(file_path, preload=True)
+    metrics.add(samples=raw.n_times)
 
-        # Plot the components to visualize their time courses and topographies
-        # print('--------------------- Plot Components ---------------------')
-        # ica.plot_components()
+    raw_avg_ref = apply_rereference(raw, dropped, interpolated)
 
-        # Automatically find the EOG artifacts
-        eog_indices, eog_scores = ica.find_bads_eog(raw, ch_name='EOG')
-        # print('--------------------- Plot Scores ---------------------')
-        # ica.plot_scores(eog_scores)
+    # Save the preprocessed data to /Preprocessing/BandpassFiltered directory
+    raw_avg_ref.save(output_file_path, fmt=fif_fmt(), overwrite=True)
+    record_output(output_file_path, 'rereference', [file_path], params)
+    print(f"=========================> Saved average referenced data to {output_file_path}")
 
-        # Check if there are any EOG-related components
-        # if eog_indices:
-        #     # Plot the properties of EOG components to further inspect them
-        #     print('--------------------- Plot Properties ---------------------')
-        #     ica.plot_properties(filtered_raw, picks=eog_indices)
-        # else:
-        #     print('No EOG-related artifact componetns found.')
 
-        # Exclude the identified components
-        print('--------------------- EOG Indices ---------------------')
-        print(eog_indices)
-        ica.exclude = eog_indices
+def apply_rereference(raw, dropped, interpolated=()):
+    # Drop the channels that are bad in most sessions, interpolate the session's other bad channels and add the average
+    # reference projector to a loaded Raw in place (lists from bad_channels.session_bad_channels)
+    # Remove bad channels
+    raw.drop_channels(ch_names=[name for name in dropped if name in raw.ch_names])
 
-        # Apply ICA to remove EOG components
-        corrected_raw = raw.copy()
-        ica.apply(corrected_raw)
+    # Interpolate the session's bad channels from their neighbours
+    interpolated = [name for name in interpolated if name in raw.ch_names]
+    if interpolated:
+        raw.info['bads'] = interpolated
+        raw.interpolate_bads(reset_bads=True)
 
-        # Save ICA cleaned Raw data
-        cleaned_file_name = os.path.basename(file_name).replace('_filtered_raw.fif', '_cleaned_raw.fif')
-        print(cleaned_file_name)
-        cleaned_file_path = os.path.join(cleaned_dir, cleaned_file_name)
-        print(cleaned_file_path)
+    # Set the average reference
+    raw.set_eeg_reference('average', projection=True)
+    dump(raw.info)
 
-        corrected_raw.save(cleaned_file_path, fmt='double', overwrite=True)
+    return raw
 
-        print(f"=====================================> Processed and saved cleaned data to {cleaned_file_path}")
 
+def remove_artifact(n_components, random_state, max_iter="auto", eog_threshold=3.0, exclude=None, warm_start=True, mode='session', decim=4, chunk_sec=None, n_jobs=1, force=False):
+    # The fitted ICA of every session is kept in data/ica and reused as long as the filtered data and the ICA parameters
+    # (n_components, random_state, max_iter) are unchanged, so changing only eog_threshold or exclude (extra components
+    # to drop, {'S01_Sess01': [0, 3]}) just re-applies the saved decompositions.
+    # warm_start=True starts a needed refit from the subject's previous unmixing matrix.
+    # mode='subject' fits one ICA per subject on its concatenated sessions (every decim-th sample) and applies it to each
+    # session, then compares the result with the per-session ICAs already in data/ica (ica_dir/subject_vs_session.csv).
+    # chunk_sec (session mode) fits and scores the EOG components on every decim-th sample and applies the ICA in chunks
+    # of that many seconds, without loading the session (see chunked).
 
+    # Ensure cleaned and ICA directories exist
+    for directory in (cleaned_dir, ica_dir):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    
 
-    print("remove artifact")
\ No newline at end of file
+    ##################################################################
+    #                  Remove EOG from EEG using ICA      
+    ##################################################################    
+    # Iterate Over BandpassFiltered Files to load Filtered EEG data (Iterate through each one to confirm the existence of each session file)
+    if mode == 'subject':
+        results = run_sessions(_remove_artifact_subject, n_jobs=n_jobs, sessions=subject_grid(), n_components=n_components, random_state=random_state,
+                               max_iter=max_iter, decim=decim, eog_threshold=eog_threshold, exclude=exclude or {}, force=force)
+        print_session_summary('remove_artifact (subject ICA)', results)
+        _collect_ica_comparison()
+    elif chunk_sec:
+        results = run_sessions(_remove_artifact_session_chunked, n_jobs=n_jobs, n_components=n_components, random_state=random_state, max_iter=max_iter,
+                               chunk_sec=chunk_sec, decim=decim, eog_threshold=eog_threshold, exclude=exclude or {}, warm_start=warm_start, force=force)
+        print_session_summary('remove_artifact (chunked)', results)
+    else:
+        results = run_sessions(_remove_artifact_session, n_jobs=n_jobs, n_components=n_components, random_state=random_state, max_iter=max_iter,
+                               eog_threshold=eog_threshold, exclude=exclude or {}, warm_start=warm_start, force=force)
+        print_session_summary('remove_artifact', results)
+
+    print("remove artifact")
+    return results
+
+
+def ica_path(subject, session):
+    return f"{ica_dir}/Data_S{subject:02d}_Sess{session:02d}_ica.fif"
+
+
+def _remove_artifact_session(subject, session, n_components, random_state, max_iter, eog_threshold=3.0, exclude=None, warm_start=True, force=False):
+    file_path = "{}/Data_S{:02d}_Sess{:02d}_filtered_raw.fif".format(filtered_dir, subject, session)
+    print('==============================================================================================')
+    print('==============================================================================================')
+    print(file_path)
+    file_name = os.path.basename(file_path)
+
+    if not os.path.exists(file_path):
+        print(f"Missing file for Subject {subject}, Session {session}.")
+        return 'skipped'
+
+    cleaned_file_name = os.path.basename(file_name).replace('_filtered_raw.fif', '_cleaned_raw.fif')
+    cleaned_file_path = os.path.join(cleaned_dir, cleaned_file_name)
+    ica_params = dict(n_components=n_components, random_state=random_state, max_iter=max_iter, method='fastica')
+    session_exclude = list((exclude or {}).get(f"S{subject:02d}_Sess{session:02d}", []))
+    params = dict(ica_params, eog_threshold=eog_threshold, exclude=session_exclude, precision=fif_fmt())
+    if not force and is_fresh(cleaned_file_path, 'remove_artifact', [file_path], params):
+        print(f"Up to date, skipping {cleaned_file_path}")
+        return 'cached'
+
+    # Load the preprocessed .fif file
+    raw = mne.io.read_raw_fif(file_path, preload=True)
+    metrics.add(samples=raw.n_times)
+
+    # Reuse the saved decomposition when only the exclusion settings changed
+    session_ica_path = ica_path(subject, session)
+    if not force and is_fresh(session_ica_path, 'fit_ica', [file_path], ica_params):
+        print(f"Reusing fitted ICA {session_ica_path}")
+        ica = mne.preprocessing.read_ica(session_ica_path)
+    else:
+        previous_ica = _previous_subject_ica(subject, session, n_components) if warm_start else None
+        w_init = warm_start_unmixing(previous_ica, raw) if previous_ica is not None else None
+        ica = fit_ica(raw, n_components, random_state, max_iter, w_init=w_init)
+        ica.save(session_ica_path, overwrite=True)
+        record_output(session_ica_path, 'fit_ica', [file_path], ica_params)
+
+    corrected_raw = apply_ica(raw, n_components, random_state, max_iter, ica=ica, eog_threshold=eog_threshold, exclude=session_exclude)
+
+    # Save ICA cleaned Raw data
+    print(cleaned_file_name)
+    print(cleaned_file_path)
+
+    corrected_raw.save(cleaned_file_path, fmt=fif_fmt(), overwrite=True)
+    record_output(cleaned_file_path, 'remove_artifact', [file_path], params)
+
+    print(f"=====================================> Processed and saved cleaned data to {cleaned_file_path}")
+
+
+def _remove_artifact_subject(subject, _session, n_components, random_state, max_iter, decim=4, eog_threshold=3.0, exclude=None, force=False):
+    # One ICA for all sessions of a subject, the EOG components are still identified per session
+    sessions = [session for session in range(1, num_sessions + 1)
+                if os.path.exists(f"{filtered_dir}/Data_S{subject:02d}_Sess{session:02d}_filtered_raw.fif")]
+    if not sessions:
+        print(f"Missing files for Subject {subject}.")
+        return 'skipped'
+
+    file_paths = [f"{filtered_dir}/Data_S{subject:02d}_Sess{session:02d}_filtered_raw.fif" for session in sessions]
+    cleaned_paths = [f"{cleaned_dir}/Data_S{subject:02d}_Sess{session:02d}_cleaned_raw.fif" for session in sessions]
+    ica_params = dict(n_components=n_components, random_state=random_state, max_iter=max_iter, method='fastica', mode='subject', decim=decim)
+    session_params = {session: dict(ica_params, eog_threshold=eog_threshold, precision=fif_fmt(),
+                                    exclude=list((exclude or {}).get(f"S{subject:02d}_Sess{session:02d}", []))) for session in sessions}
+    if not force and all(is_fresh(path, 'remove_artifact', file_paths, session_params[session]) for session, path in zip(sessions, cleaned_paths)):
+        print(f"Up to date, skipping Subject {subject}")
+        return 'cached'
+
+    raws = [mne.io.read_raw_fif(path, preload=True) for path in file_paths]
+    metrics.add(samples=sum(raw.n_times for raw in raws))
+
+    subject_ica_path = f"{ica_dir}/Data_S{subject:02d}_subject_ica.fif"
+    if not force and is_fresh(subject_ica_path, 'fit_ica', file_paths, ica_params):
+        print(f"Reusing fitted ICA {subject_ica_path}")
+        ica = mne.preprocessing.read_ica(subject_ica_path)
+    else:
+        # The session boundaries become BAD annotations, which ICA.fit leaves out
+        concatenated = mne.concatenate_raws([raw.copy() for raw in raws])
+        ica = mne.preprocessing.ICA(n_components=n_components, random_state=random_state, method='fastica', max_iter=max_iter)
+        ica.fit(concatenated, decim=decim)
+        print(f"Subject {subject}: one ICA on {len(sessions)} sessions (decim={decim}), {ica.n_iter_} iterations")
+        del concatenated
+        ica.save(subject_ica_path, overwrite=True)
+        record_output(subject_ica_path, 'fit_ica', file_paths, ica_params)
+
+    comparison = []
+    for session, raw, file_path, cleaned_path in zip(sessions, raws, file_paths, cleaned_paths):
+        params = session_params[session]
+        cleaned_raw = apply_ica(raw, n_components, random_state, max_iter, ica=ica, eog_threshold=eog_threshold, exclude=params['exclude'])
+        subject_exclude = list(ica.exclude)
+        cleaned_raw.save(cleaned_path, fmt=fif_fmt(), overwrite=True)
+        record_output(cleaned_path, 'remove_artifact', file_paths, params)
+        print(f"=====================================> Processed and saved cleaned data to {cleaned_path}")
+
+        comparison.append(_compare_with_session_ica(subject, session, file_path, cleaned_raw, subject_exclude,
+                                                    n_components, random_state, max_iter, eog_threshold, params['exclude']))
+
+    pd.DataFrame(comparison).to_csv(f"{ica_dir}/Data_S{subject:02d}_subject_vs_session.csv", index=False)
+
+
+def _residual_eog_correlation(raw):
+    # Mean absolute correlation between the EOG channel and the EEG channels, what is left of the ocular artifact
+    eeg = raw.get_data(picks='eeg')
+    eog = raw.get_data(picks=['EOG'])[0]
+    return float(np.mean(np.abs([np.corrcoef(channel, eog)[0, 1] for channel in eeg])))
+
+
+def _compare_with_session_ica(subject, session, file_path, subject_cleaned, subject_exclude, n_components, random_state, max_iter, eog_threshold, exclude):
+    # Per-session mode result for the same session, from its saved ICA (remove_artifact mode='session' fits them)
+    row = dict(subject=subject, session=session, subject_eog_components=len(subject_exclude),
+               subject_residual_eog_corr=_residual_eog_correlation(subject_cleaned))
+    ica_params = dict(n_components=n_components, random_state=random_state, max_iter=max_iter, method='fastica')
+    if not is_fresh(ica_path(subject, session), 'fit_ica', [file_path], ica_params):
+        print(f"No per-session ICA of Subject {subject} Session {session} to compare with")
+        return row
+
+    session_ica = mne.preprocessing.read_ica(ica_path(subject, session))
+    session_cleaned = apply_ica(mne.io.read_raw_fif(file_path, preload=True), n_components, random_state, max_iter,
+                                ica=session_ica, eog_threshold=eog_threshold, exclude=exclude)
+    session_data = session_cleaned.get_data(picks='eeg')
+    difference = subject_cleaned.get_data(picks='eeg') - session_data
+    row.update(session_eog_components=len(session_ica.exclude),
+               session_residual_eog_corr=_residual_eog_correlation(session_cleaned),
+               relative_rms_difference=float(np.sqrt(np.mean(difference ** 2)) / np.sqrt(np.mean(session_data ** 2))))
+    return row
+
+
+def _collect_ica_comparison():
+    # Per-subject comparison files into one report, plus a per-subject summary
+    paths = [f"{ica_dir}/Data_S{subject:02d}_subject_vs_session.csv" for subject, _ in subject_grid()]
+    tables = [pd.read_csv(path) for path in paths if os.path.exists(path)]
+    if not tables:
+        return
+    report = pd.concat(tables, ignore_index=True)
+    report.to_csv(f"{ica_dir}/subject_vs_session.csv", index=False)
+
+    print("---------------- Subject ICA vs per-session ICA ----------------")
+    print(report.groupby('subject').mean(numeric_only=True).drop(columns='session').to_string(float_format='%.3f'))
+
+
+def _previous_subject_ica(subject, session, n_components):
+    # Most relevant saved ICA of this subject for a warm start: the session's own (outdated) one, else another session's
+    candidates = [session] + [other for other in range(1, num_sessions + 1) if other != session]
+    for candidate in candidates:
+        path = ica_path(subject, candidate)
+        if not os.path.exists(path):
+            continue
+        try:
+            ica = mne.preprocessing.read_ica(path)
+        except (OSError, ValueError):
+            # Being written by another worker
+            continue
+        if ica.n_components_ == n_components:
+            print(f"Warm start from {path}")
+            return ica
+    return None
+
+
+def warm_start_unmixing(previous_ica, raw):
+    # previous_ica's unmixing matrix expressed in the whitened PCA space ICA.fit will compute for raw, to pass as the
+    # FastICA w_init. The PCA is redone here the same way (pre-whitening, centering, sign convention of svd_flip).
+    n_components = previous_ica.n_components_
+    sensor_unmixing = previous_ica.unmixing_matrix_ @ previous_ica.pca_components_[:n_components]
+
+    data = raw.get_data(picks=previous_ica.ch_names) / previous_ica.pre_whitener_
+    data -= data.mean(axis=1, keepdims=True)
+    eigenvalues, eigenvectors = np.linalg.eigh(data @ data.T / (data.shape[1] - 1))
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    components, variances = eigenvectors[:, order].T, eigenvalues[order]
+
+    # Same sign as the PCA of ICA.fit: the largest absolute score of every component is positive
+    scores = components @ data
+    signs = np.sign(scores[np.arange(n_components), np.abs(scores).argmax(axis=1)])
+    components *= signs[:, None]
+
+    return sensor_unmixing @ components.T * np.sqrt(variances)[None, :]
+
+
+def fit_ica(raw, n_components, random_state, max_iter="auto", w_init=None):
+    # Initialize and fit ICA (w_init: starting unmixing matrix in the whitened PCA space, see warm_start_unmixing)
+    fit_params = dict(w_init=w_init) if w_init is not None else None
+    ica = mne.preprocessing.ICA(n_components=n_components, random_state=random_state, method='fastica', max_iter=max_iter, fit_params=fit_params)
+    ica.fit(raw)
+    print(f"ICA converged after {ica.n_iter_} iterations{' (warm start)' if w_init is not None else ''}")
+    return ica
+
+
+def apply_ica(raw, n_components, random_state, max_iter="auto", ica=None, eog_threshold=3.0, exclude=()):
+    # Fit ICA on a loaded Raw (unless a fitted ica is given) and remove the EOG components from it in place
+    if ica is None:
+        ica = fit_ica(raw, n_components, random_state, max_iter)
+
+    # Plot the components to visualize their time courses and topographies
+    # print('--------------------- Plot Components ---------------------')
+    # ica.plot_components()
+
+    # Automatically find the EOG artifacts
+    eog_indices, eog_scores = ica.find_bads_eog(raw, ch_name='EOG', threshold=eog_threshold)
+    # print('--------------------- Plot Scores ---------------------')
+    # ica.plot_scores(eog_scores)
+
+    # Check if there are any EOG-related components
+    # if eog_indices:
+    #     # Plot the properties of EOG components to further inspect them
+    #     print('--------------------- Plot Properties ---------------------')
+    #     ica.plot_properties(filtered_raw, picks=eog_indices)
+    # else:
+    #     print('No EOG-related artifact componetns found.')
+
+    # Exclude the identified components
+    print('--------------------- EOG Indices ---------------------')
+    print(eog_indices)
+    ica.exclude = sorted(set(eog_indices) | set(exclude))
+
+    # Apply ICA to remove EOG components
+    ica.apply(raw)
+
+    return raw
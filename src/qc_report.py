@@ -0,0 +1,178 @@
+import os
+import time
+import html
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+import mne
+
+from src.session_executor import run_sessions, print_session_summary, session_grid
+from src.stage_cache import is_fresh, record_output
+from src.preprocessing import original_raw_dir, filtered_dir, cleaned_dir
+from src.get_erp import epoch_dir, event_types
+from src import metrics
+
+
+# Batch QC report: the plot_data session views rendered to PNG files for every session (no window, no plt.show) and an
+# index page linking them. Traces are reduced to a min/max envelope of max_points per channel before drawing, so a whole
+# session is one LineCollection of a few thousand points per channel instead of the full recording.
+# Figures are built as matplotlib Figure objects and saved through their own Agg canvas, without pyplot, so importing
+# this module leaves the backend of an interactive session alone.
+qc_dir = 'data/qc'
+qc_views = ('original', 'original_vs_filtered', 'filtered_vs_cleaned', 'epochs')
+qc_channels = ['Fp1', 'F1', 'Fz', 'FC1', 'FCz', 'C1', 'Cz', 'CP1', 'CPz', 'P3', 'P1', 'Pz', 'EOG']
+
+# (title, file, vertical scale in volts) of the raw recordings each view draws, one panel per recording
+raw_panels = {
+    'original': [('Original', f"{original_raw_dir}/Data_S{{:02d}}_Sess{{:02d}}_raw.fif", 200e-6)],
+    'original_vs_filtered': [('Original', f"{original_raw_dir}/Data_S{{:02d}}_Sess{{:02d}}_raw.fif", 200e-6),
+                             ('Filtered', f"{filtered_dir}/Data_S{{:02d}}_Sess{{:02d}}_filtered_raw.fif", 50e-6)],
+    'filtered_vs_cleaned': [('Filtered', f"{filtered_dir}/Data_S{{:02d}}_Sess{{:02d}}_filtered_raw.fif", 50e-6),
+                            ('Cleaned', f"{cleaned_dir}/Data_S{{:02d}}_Sess{{:02d}}_cleaned_raw.fif", 50e-6)],
+}
+condition_colors = {'correct': 'tab:blue', 'incorrect': 'tab:red'}
+
+
+def qc_figure_path(subject, session, view):
+    return f"{qc_dir}/S{subject:02d}_Sess{session:02d}_{view}.png"
+
+
+def view_inputs(subject, session, view):
+    if view == 'epochs':
+        return [f"{epoch_dir}/Data_S{subject:02d}_Sess{session:02d}_epochs_epo.fif"]
+    return [path.format(subject, session) for _, path, _ in raw_panels[view]]
+
+
+def envelope(data, times, max_points):
+    # Min/max of every bin of samples, interleaved: max_points per channel that keep the peaks of the full trace
+    n_bins = max_points // 2
+    if data.shape[1] <= max_points:
+        return data, times
+    bin_size = data.shape[1] // n_bins
+    n_used = n_bins * bin_size
+    binned = data[:, :n_used].reshape(data.shape[0], n_bins, bin_size)
+    reduced = np.empty((data.shape[0], n_bins, 2))
+    reduced[:, :, 0] = binned.min(axis=2)
+    reduced[:, :, 1] = binned.max(axis=2)
+    reduced_times = np.repeat(times[:n_used:bin_size], 2)
+    return reduced.reshape(data.shape[0], -1), reduced_times
+
+
+def _draw_traces(ax, data, times, ch_names, scale, color='k'):
+    # Stacked traces, first channel on top, each centred on its median (the original recordings carry a DC offset)
+    offsets = np.arange(len(ch_names))[::-1] * scale
+    centred = data - np.median(data, axis=1, keepdims=True)
+    segments = np.stack([np.broadcast_to(times, centred.shape), centred + offsets[:, None]], axis=-1)
+    ax.add_collection(LineCollection(segments, colors=color, linewidths=0.5))
+    ax.set_xlim(times[0], times[-1])
+    ax.set_ylim(-scale, offsets[0] + scale)
+    ax.set_yticks(offsets)
+    ax.set_yticklabels(ch_names, fontsize=7)
+
+
+def _render_raw_view(subject, session, view, max_points):
+    panels = raw_panels[view]
+    fig = Figure(figsize=(15, 5 * len(panels)))
+    axes = fig.subplots(len(panels), 1, sharex=True, squeeze=False)
+    samples = 0
+    for ax, (title, path, scale) in zip(axes[:, 0], panels):
+        raw = mne.io.read_raw_fif(path.format(subject, session), preload=False, verbose='error')
+        picks = [name for name in qc_channels if name in raw.ch_names]
+        data = raw.get_data(picks=picks)
+        samples += data.size
+        data, times = envelope(data, raw.times, max_points)
+        _draw_traces(ax, data, times, picks, scale)
+        ax.set_title(f"S{subject:02d} Sess{session:02d} {title} ({scale * 1e6:.0f} µV per channel)", fontsize=9)
+    axes[-1, 0].set_xlabel('Time (s)')
+    return fig, samples
+
+
+def _render_epochs_view(subject, session):
+    # Per condition: every channel's average as a butterfly plot, with the epoch counts
+    epochs = mne.read_epochs(view_inputs(subject, session, 'epochs')[0], preload=True, verbose='error')
+    fig = Figure(figsize=(15, 5))
+    axes = fig.subplots(1, len(event_types), sharey=True)
+    times = epochs.times * 1e3
+    for ax, condition in zip(axes, event_types):
+        ax.axvline(0, color='0.5', linewidth=0.5)
+        ax.axhline(0, color='0.5', linewidth=0.5)
+        if condition in epochs.event_id and len(epochs[condition]):
+            condition_epochs = epochs[condition]
+            average = condition_epochs.average(picks='eeg').data * 1e6
+            ax.add_collection(LineCollection(np.stack([np.broadcast_to(times, average.shape), average], axis=-1),
+                                             colors=condition_colors[condition], linewidths=0.6, alpha=0.6))
+            ax.autoscale()
+            ax.set_title(f"{condition}: {len(condition_epochs)} epochs", fontsize=9)
+        else:
+            ax.set_title(f"{condition}: no epochs", fontsize=9)
+        ax.set_xlabel('Time (ms)')
+    axes[0].set_ylabel('µV')
+    fig.suptitle(f"S{subject:02d} Sess{session:02d} Epochs ({len(epochs)} kept)", fontsize=10)
+    return fig, epochs.get_data().size
+
+
+def _render_session(subject, session, views, max_points, dpi, force=False):
+    rendered, cached = 0, 0
+    for view in views:
+        input_paths = view_inputs(subject, session, view)
+        if not all(os.path.exists(path) for path in input_paths):
+            continue
+        figure_path = qc_figure_path(subject, session, view)
+        params = dict(view=view, channels=qc_channels, max_points=max_points, dpi=dpi)
+        if not force and is_fresh(figure_path, 'qc_report', input_paths, params):
+            cached += 1
+            continue
+
+        start = time.perf_counter()
+        if view == 'epochs':
+            fig, samples = _render_epochs_view(subject, session)
+        else:
+            fig, samples = _render_raw_view(subject, session, view, max_points)
+        fig.savefig(figure_path, dpi=dpi)
+        record_output(figure_path, 'qc_report', input_paths, params)
+        metrics.add(samples=samples)
+        print(f"Rendered {figure_path} in {time.perf_counter() - start:.2f} s")
+        rendered += 1
+
+    if not rendered and not cached:
+        print(f"Missing files for Subject {subject}, Session {session}.")
+        return 'skipped'
+    return 'ok' if rendered else 'cached'
+
+
+def write_index(views=qc_views, path=f"{qc_dir}/index.html"):
+    # One row per session, one thumbnail per view linking the full-size figure
+    rows = []
+    for subject, session in session_grid():
+        cells = []
+        for view in views:
+            figure_name = os.path.basename(qc_figure_path(subject, session, view))
+            if os.path.exists(os.path.join(qc_dir, figure_name)):
+                cells.append(f'<td><a href="{html.escape(figure_name)}"><img src="{html.escape(figure_name)}" width="240"></a></td>')
+            else:
+                cells.append('<td class="missing">-</td>')
+        rows.append(f"<tr><th>S{subject:02d} Sess{session:02d}</th>{''.join(cells)}</tr>")
+
+    header = ''.join(f"<th>{html.escape(view)}</th>" for view in views)
+    with open(path, 'w') as f:
+        f.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>P300 QC report</title>\n"
+                "<style>body{font-family:sans-serif} td,th{padding:4px;text-align:center} .missing{color:#999}</style></head>\n"
+                f"<body><h1>P300 QC report</h1>\n<table>\n<tr><th>Session</th>{header}</tr>\n" + '\n'.join(rows) + "\n</table></body></html>\n")
+    print(f"Wrote QC index {path}")
+
+
+def create_qc_report(views=qc_views, max_points=4000, dpi=80, n_jobs=-1, force=False):
+    ##################################################################
+    #       Render the QC views of every session to data/qc
+    ##################################################################
+    # views: any of qc_views. Figures whose inputs did not change since the last report are kept.
+    for view in views:
+        if view not in qc_views:
+            raise ValueError(f"Unknown view '{view}', expected one of {list(qc_views)}")
+    if not os.path.exists(qc_dir):
+        os.makedirs(qc_dir)
+
+    results = run_sessions(_render_session, n_jobs=n_jobs, views=tuple(views), max_points=max_points, dpi=dpi, force=force)
+    print_session_summary('create_qc_report', results)
+    write_index(views)
+    return results
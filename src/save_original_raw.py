@@ -1,62 +1,158 @@
 import pandas as pd
+import numpy as np
 import os
+import time
 import mne
 
+from src.session_executor import run_sessions, print_session_summary
+from src.stage_cache import is_fresh, record_output
+from src.precision import fif_fmt
+from src import metrics
+
 all_data_dir = 'data/allData/original'
 original_raw_dir = 'data/originalRaw'
 channel_names = ['Fp1', 'Fp2', 'AF7', 'AF3', 'AF4', 'AF8', 'F7', 'F5', 'F3', 'F1', 'Fz', 'F2', 'F4', 'F6', 'F8', 'FT7', 'FC5', 'FC3', 'FC1', 'FCz', 'FC2', 'FC4', 'FC6', 'FT8',
                     'T7', 'C5', 'C3', 'C1', 'Cz', 'C2', 'C4', 'C6', 'T8', 'TP7', 'CP5', 'CP3', 'CP1', 'CPz', 'CP2', 'CP4', 'CP6', 'TP8', 'P7', 'P5', 'P3', 'P1', 'Pz', 'P2', 'P4',
                     'P6', 'P8', 'PO7', 'POz', 'PO8', 'O1', 'O2', 'EOG']
-bads = ['POz', 'P5', 'Fp1', 'Fp2', 'AF7', 'AF3', 'AF4', 'AF8']
 channel_types = ['eog' if name == 'EOG' else 'eeg' for name in channel_names]
 sampling_rate=200
 
-def save_original_raw():
+def save_original_raw(n_jobs=1, force=False, csv_engine='c', source='csv'):
+    # csv_engine='c' is the original pandas path, 'pyarrow' the multithreaded Arrow reader (needs pyarrow installed)
+    # source='store' reads the binary session store (see session_store.build_session_store) instead of parsing the csv files
+    if csv_engine not in ('c', 'pyarrow'):
+        raise ValueError(f"Unknown csv_engine '{csv_engine}', expected 'c' or 'pyarrow'")
+    if source not in ('csv', 'store'):
+        raise ValueError(f"Unknown source '{source}', expected 'csv' or 'store'")
     
     # Ensure output directory exists
     if not os.path.exists(original_raw_dir):
         os.makedirs(original_raw_dir)
 
     # Iterate Over Session Files to load each EEG session data (Make sure all sessions exist)
-    session_files = ["{}/Data_S{:02d}_Sess{:02d}.csv".format(all_data_dir, i, j)
-                    for i in range(1, 26+1)
-                    for j in range(1, 5+1)]
+    results = run_sessions(_save_session_raw, n_jobs=n_jobs, force=force, csv_engine=csv_engine, source=source)
+    print_session_summary('save_original_raw', results)
+
+    print("save original raw completed")
+    return results
+
+
+def _save_session_raw(subject, session, force=False, csv_engine='c', source='csv'):
+    session_path = "{}/Data_S{:02d}_Sess{:02d}.csv".format(all_data_dir, subject, session)
+    file_name = os.path.basename(session_path)
+    fif_file_name = file_name.replace('.csv', '_raw.fif')
+    output_file_path = os.path.join(original_raw_dir, fif_file_name)
+
+    print(output_file_path)
+
+    if source == 'store':
+        from src.session_store import has_session, load_session, session_store_dir
+
+        if not has_session(subject, session):
+            print(f"Missing stored session for Subject {subject}, Session {session}.")
+            return 'skipped'
+        input_paths = [f"{session_store_dir}/index.json"]
+        output_paths = [output_file_path]
+    else:
+        if not os.path.exists(session_path):
+            print(f"Missing file for Subject {subject}, Session {session}.")
+            return 'skipped'
+        csv_path = session_path.replace('allData/original', 'allData')
+        input_paths = [session_path]
+        output_paths = [output_file_path, csv_path]
+
+    params = dict(channel_names=channel_names, sampling_rate=sampling_rate, montage='standard_1020', precision=fif_fmt())
+    if not force and is_fresh(output_paths, 'save_original_raw', input_paths, params):
+        print(f"Up to date, skipping {output_file_path}")
+        return 'cached'
+    
+    start = time.perf_counter()
+    if source == 'store':
+        # Already in volts and channel-major, this is a plain read of the session block
+        data = np.array(load_session(subject, session))
+    elif csv_engine == 'pyarrow':
+        data = _read_session_pyarrow(session_path, csv_path)
+    else:
+        data = _read_session_pandas(session_path, csv_path)
+    elapsed = time.perf_counter() - start
+    metrics.add(samples=data.shape[1])
+    print(f"Ingested {data.shape[1]} rows in {elapsed:.2f} s ({data.shape[1] / elapsed:.0f} rows/s) from {source if source == 'store' else csv_engine}")
+
+    # Create an MNE Info structure (contains information about the data)
+    info = mne.create_info(ch_names=channel_names, sfreq=sampling_rate, ch_types=channel_types)
+
+    # Bad channels are detected from the data by bad_channels.detect_bad_channels
+
+    # Create a RawArray object
+    raw = mne.io.RawArray(data, info)
+
+    # Set channel locations
+    raw.set_montage("standard_1020")
+
+    raw.save(output_file_path, fmt=fif_fmt(), overwrite=True)
+    record_output(output_paths, 'save_original_raw', input_paths, params)
+    print(f"=========================> Saved original data to {output_file_path}")
+
+
+def _read_session_pandas(session_path, csv_path):
+    # Create a dataframe of the current session data
+    df = pd.read_csv(session_path)
     
-    # Iterate through each session files in allData directory
-    for session_path in session_files:
-        file_name = os.path.basename(session_path)
-        fif_file_name = file_name.replace('.csv', '_raw.fif')
-        output_file_path = os.path.join(original_raw_dir, fif_file_name)
-
-        print(output_file_path)
-        
-        # Create a dataframe of the current session data
-        df = pd.read_csv(session_path)
-        
-        # Fix P08 typo for PO8 field if not fixed already
-        if 'P08' in df.columns:
-            df.rename(columns={'P08': 'PO8'}, inplace=True)
+    # Fix P08 typo for PO8 field if not fixed already
+    if 'P08' in df.columns:
+        df.rename(columns={'P08': 'PO8'}, inplace=True)
+
+    # Save the DataFrame back to the same file (unlinking a copy the pyarrow path linked to the original first, writing
+    # through the link would overwrite the original)
+    if os.path.abspath(session_path) != os.path.abspath(csv_path) and os.path.lexists(csv_path):
+        os.remove(csv_path)
+    df.to_csv(csv_path, index=False)
     
-        csv_path = session_path.replace('allData/original', 'allData')
-        # Save the DataFrame back to the same file
-        df.to_csv(csv_path, index=False)
-        
-        # Convert DataFrame to a NumPy array and transpose it to match MNE's expected format (in Volts)
-        data = (df[channel_names].to_numpy().T) / 1e6   # Convert microvolts to volts
+    # Convert DataFrame to a NumPy array and transpose it to match MNE's expected format (in Volts)
+    data = (df[channel_names].to_numpy().T) / 1e6   # Convert microvolts to volts
 
-        # Create an MNE Info structure (contains information about the data)
-        info = mne.create_info(ch_names=channel_names, sfreq=sampling_rate, ch_types=channel_types)
+    return data
 
-        # info['bads'] = bads
 
-        # Create a RawArray object
-        raw = mne.io.RawArray(data, info)
+def _fixed_header(session_path):
+    # Column names of the csv with the P08 -> PO8 typo fixed, the file itself is left as it is
+    with open(session_path, 'rb') as f:
+        names = f.readline().decode().rstrip('\r\n').split(',')
+    return ['PO8' if name == 'P08' else name for name in names]
 
-        # Set channel locations
-        raw.set_montage("standard_1020")
 
-        raw.save(output_file_path, fmt="double", overwrite=True)
-        print(f"=========================> Saved original data to {output_file_path}")
+def _link_session_csv(session_path, csv_path):
+    # The events are read from data/allData (Time and FeedBackEvent only), so the original file is linked there instead
+    # of being rewritten; a symlink when a hard link is not possible (e.g. another file system)
+    if os.path.abspath(session_path) == os.path.abspath(csv_path):
+        return
+    if os.path.lexists(csv_path):
+        os.remove(csv_path)
+    try:
+        os.link(session_path, csv_path)
+    except OSError:
+        os.symlink(os.path.abspath(session_path), csv_path)
 
-    print("save original raw completed")
 
+def _read_session_pyarrow(session_path, csv_path):
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    # Parse only the EEG/EOG columns, as float64 like the pandas path, under the fixed header names (the header line
+    # is skipped and replaced by column_names, so the file is never rewritten)
+    read_options = pa_csv.ReadOptions(use_threads=True, block_size=1 << 24, column_names=_fixed_header(session_path), skip_rows=1)
+    convert_options = pa_csv.ConvertOptions(include_columns=channel_names, column_types={name: pa.float64() for name in channel_names})
+    table = pa_csv.read_csv(session_path, read_options=read_options, convert_options=convert_options)
+    _link_session_csv(session_path, csv_path)
+
+    # Fill the (n_channels, n_samples) array that RawArray uses straight from the Arrow column chunks,
+    # converting to volts on the way (no DataFrame, no transposed copy)
+    data = np.empty((len(channel_names), table.num_rows))
+    for k, name in enumerate(channel_names):
+        offset = 0
+        for chunk in table.column(name).chunks:
+            values = chunk.to_numpy(zero_copy_only=False)
+            np.divide(values, 1e6, out=data[k, offset:offset + len(values)])   # Convert microvolts to volts
+            offset += len(values)
+
+    return data
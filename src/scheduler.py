@@ -0,0 +1,247 @@
+import os
+import json
+import queue
+import threading
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from src.session_executor import session_grid, resolve_n_jobs, print_session_summary, _run_session
+from src.stage_cache import stage_key
+from src.metrics import metrics_path
+from src.save_original_raw import _save_session_raw, all_data_dir
+from src.preprocessing import _rereference_session, _filter_session, _remove_artifact_session, original_raw_dir, referenced_dir, filtered_dir, cleaned_dir, ica_dir
+from src.get_erp import _create_session_epochs, event_source_path, epoch_dir, feedback_labels_path
+from src.bad_channels import _detect_bad_channels_task, bad_channels_dir
+
+
+# Runs save_original_raw -> rereference -> filter_data -> remove_artifact -> create_epochs as a graph of (stage, session)
+# tasks instead of one stage over all 130 sessions at a time: a session moves on to its next stage as soon as its previous
+# one is done, so while session N is in ICA, session N+1 is being filtered, and a prefetch thread reads the input files of
+# the next tasks in line into the OS page cache. Later stages go first, so sessions are finished before new ones are started.
+# Every finished task is appended to a checkpoint file; a rerun with the same parameters resumes where the last run stopped.
+# Task keys include the size/mtime of the files a task reads from outside the graph (the recordings, the labels), so a
+# changed recording reruns its session instead of being resumed past the stage cache.
+# Bad channel detection compares the sessions with each other, so it is one task that waits for every saved session.
+scheduler_dir = 'data/scheduler'
+checkpoint_path = f"{scheduler_dir}/checkpoint.jsonl"
+
+# Statuses that let the next stage of the session run; after an error the rest of the session is left out
+done_statuses = ('ok', 'cached', 'skipped')
+
+# Stages that run once for all sessions (as task (stage, 0, 0)) after every session finished the stages they need,
+# whatever their status (a failed session is left out, not the whole run)
+global_stages = ('detect_bad_channels',)
+
+
+def session_stages(low_freq, high_freq, n_components, random_state, max_iter, sfreq, reject_criteria, filter_method, event_source,
+                   csv_engine, warm_start, exclude, feedback_labels_df, force):
+    # (stage name, per-session function, its keyword arguments, stages it needs, input files of a session)
+    return [
+        ('save_original_raw', _save_session_raw, dict(csv_engine=csv_engine, source='csv', force=force), (),
+         lambda i, j: [f"{all_data_dir}/Data_S{i:02d}_Sess{j:02d}.csv"]),
+        ('detect_bad_channels', _detect_bad_channels_task, dict(force=force), ('save_original_raw',), lambda i, j: []),
+        ('rereference', _rereference_session, dict(original_dir=original_raw_dir, identifier='raw', force=force), ('save_original_raw', 'detect_bad_channels'),
+         lambda i, j: [f"{original_raw_dir}/Data_S{i:02d}_Sess{j:02d}_raw.fif"]),
+        ('filter_data', _filter_session, dict(low_freq=low_freq, high_freq=high_freq, method=filter_method, force=force), ('rereference',),
+         lambda i, j: [f"{referenced_dir}/Data_S{i:02d}_Sess{j:02d}_referenced_raw.fif"]),
+        ('remove_artifact', _remove_artifact_session, dict(n_components=n_components, random_state=random_state, max_iter=max_iter,
+                                                           exclude=exclude or {}, warm_start=warm_start, force=force), ('filter_data',),
+         lambda i, j: [f"{filtered_dir}/Data_S{i:02d}_Sess{j:02d}_filtered_raw.fif"]),
+        ('create_epochs', _create_session_epochs, dict(preprocessed_dir=cleaned_dir, identifier_fname='cleaned_raw', sfreq=sfreq,
+                                                       reject_criteria=reject_criteria, feedback_labels_df=feedback_labels_df,
+                                                       event_source=event_source, force=force), ('remove_artifact',),
+         lambda i, j: [f"{cleaned_dir}/Data_S{i:02d}_Sess{j:02d}_cleaned_raw.fif", event_source_path(i, j, event_source, sfreq)]),
+    ]
+
+
+def source_files(stage, subject, session, event_source, sfreq):
+    # Files a task reads that no other task of the graph writes
+    if stage == 'save_original_raw':
+        return [f"{all_data_dir}/Data_S{subject:02d}_Sess{session:02d}.csv"]
+    if stage == 'create_epochs':
+        return [event_source_path(subject, session, event_source, sfreq)] + ([feedback_labels_path] if event_source != 'index' else [])
+    return []
+
+
+def _source_fingerprint(paths):
+    # {path: [size, mtime_ns]} as stage_cache records them, None for a missing file
+    fingerprint = {}
+    for path in paths:
+        if path is not None:
+            stat = os.stat(path) if os.path.exists(path) else None
+            fingerprint[path] = [stat.st_size, stat.st_mtime_ns] if stat else None
+    return fingerprint
+
+
+def _checkpoint_params(kwargs):
+    # Parameters that decide a stage's output (the labels table is an input file, force only decides whether to rerun)
+    return {name: value for name, value in kwargs.items() if name not in ('feedback_labels_df', 'force')}
+
+
+def load_checkpoint(path=checkpoint_path):
+    # {(stage, subject, session): key} of the tasks a previous run finished
+    finished = {}
+    if not os.path.exists(path):
+        return finished
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line cut off by the crash
+                continue
+            task = (record['stage'], record['subject'], record['session'])
+            if record['status'] in ('ok', 'cached'):
+                finished[task] = record['key']
+            else:
+                finished.pop(task, None)
+    return finished
+
+
+def _write_checkpoint(path, task, key, status):
+    stage, subject, session = task
+    with open(path, 'a') as f:
+        f.write(json.dumps(dict(stage=stage, subject=subject, session=session, key=key, status=status)) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _inputs_of(task, needs, after):
+    # Tasks whose outputs this one reads: its needs, and for a global stage every session task it waits for
+    return needs[task] + after[task] if task[0] in global_stages else needs[task]
+
+
+def _read_ahead(path, chunk_size=1 << 24):
+    # Read the file once and drop the bytes: the worker that opens it next gets it from the page cache
+    try:
+        with open(path, 'rb') as f:
+            while f.read(chunk_size):
+                pass
+    except OSError:
+        pass
+
+
+def _prefetch_worker(paths):
+    while True:
+        path = paths.get()
+        if path is None:
+            return
+        _read_ahead(path)
+
+
+def run_scheduled(low_freq, high_freq, n_components, random_state, max_iter="auto", sfreq=200, reject_criteria=None, filter_method='fir',
+                  event_source='csv', csv_engine='c', warm_start=True, exclude=None, n_jobs=-1, prefetch=2, resume=True, force=False,
+                  checkpoint_path=checkpoint_path):
+    ##################################################################
+    #     All preprocessing stages as one per-session task graph
+    ##################################################################
+    # Writes the same files as running the stages one after another. prefetch is the number of upcoming tasks whose
+    # inputs are read ahead; resume=False (or force=True) starts over instead of continuing from the checkpoint.
+    # With warm_start, a session's ICA waits for the previous session of the subject, whose ICA it starts from.
+    for directory in (original_raw_dir, bad_channels_dir, referenced_dir, filtered_dir, cleaned_dir, ica_dir, epoch_dir, scheduler_dir):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    if (force or not resume) and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    feedback_labels_df = pd.read_csv(feedback_labels_path) if event_source != 'index' else None
+    stages = session_stages(low_freq, high_freq, n_components, random_state, max_iter, sfreq, reject_criteria, filter_method,
+                            event_source, csv_engine, warm_start, exclude, feedback_labels_df, force)
+    stage_order = {name: k for k, (name, _, _, _, _) in enumerate(stages)}
+    sessions = session_grid()
+
+    # Task graph: needs must have finished without error, after only orders the tasks (ICA warm starts)
+    needs, after, keys, inputs, calls = {}, {}, {}, {}, {}
+    for name, session_fn, kwargs, stage_needs, input_paths in stages:
+        stage_tasks = [(name, 0, 0)] if name in global_stages else [(name, subject, session) for subject, session in sessions]
+        for task in stage_tasks:
+            _, subject, session = task
+            if name in global_stages:
+                needs[task] = []
+                after[task] = [(need, i, j) for need in stage_needs for i, j in sessions]
+            else:
+                needs[task] = [(need, 0, 0) if need in global_stages else (need, subject, session) for need in stage_needs]
+                after[task] = [(name, subject, session - 1)] if name == 'remove_artifact' and warm_start and session > 1 else []
+            # The key covers the keys of the tasks it depends on and its source files, so changing e.g. the filter band
+            # or a recording reruns everything after it
+            dependencies = {f"{dep}": keys[dep] for dep in _inputs_of(task, needs, after)}
+            dependencies.update(_source_fingerprint(source_files(name, subject, session, event_source, sfreq)))
+            keys[task] = stage_key(name, dependencies, _checkpoint_params(kwargs))
+            inputs[task] = input_paths
+            calls[task] = (session_fn, kwargs)
+
+    # Tasks finished by an earlier run, as long as nothing they depend on has to be redone
+    finished = load_checkpoint(checkpoint_path) if resume and not force else {}
+    status = {}
+    for task in needs:
+        if finished.get(task) == keys[task] and all(status.get(dep) == 'resumed' for dep in _inputs_of(task, needs, after)):
+            status[task] = 'resumed'
+    if status:
+        print(f"Resuming from {checkpoint_path}: {len(status)} of {len(needs)} stage runs already done")
+
+    n_jobs = resolve_n_jobs(n_jobs)
+    metrics_path()
+    results = {name: [] for name in stage_order}
+    for task, task_status in status.items():
+        results[task[0]].append(dict(subject=task[1], session=task[2], status='cached', elapsed=0.0, error=None))
+
+    def is_ready(task):
+        return (task not in status
+                and all(status.get(need) in done_statuses + ('resumed',) for need in needs[task])
+                and all(dep in status for dep in after[task]))
+
+    def is_blocked(task):
+        return task not in status and any(status.get(need) in ('error', 'blocked') for need in needs[task])
+
+    prefetch_queue = queue.Queue()
+    prefetcher = threading.Thread(target=_prefetch_worker, args=(prefetch_queue,), daemon=True)
+    prefetcher.start()
+    prefetched = set()
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        while True:
+            for task in needs:
+                if is_blocked(task):
+                    status[task] = 'blocked'
+                    results[task[0]].append(dict(subject=task[1], session=task[2], status='skipped', elapsed=0.0, error='earlier stage failed'))
+                    print(f"Not running {task[0]} for Subject {task[1]} Session {task[2]}: an earlier stage failed")
+
+            # Later stages first, then grid order
+            ready = sorted((task for task in needs if is_ready(task) and task not in running.values()),
+                           key=lambda task: (-stage_order[task[0]], task[1], task[2]))
+            while ready and len(running) < n_jobs:
+                task = ready.pop(0)
+                session_fn, kwargs = calls[task]
+                running[executor.submit(_run_session, session_fn, task[1], task[2], kwargs)] = task
+
+            # Read ahead for the tasks that start next
+            for task in ready[:prefetch]:
+                for path in inputs[task](task[1], task[2]):
+                    if path is not None and path not in prefetched:
+                        prefetched.add(path)
+                        prefetch_queue.put(path)
+
+            if not running:
+                break
+
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                task = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. killed for memory), record it like any other session error
+                    result = dict(subject=task[1], session=task[2], status='error', elapsed=0.0, error=f"{type(e).__name__}: {e}")
+                status[task] = result['status']
+                results[task[0]].append(result)
+                _write_checkpoint(checkpoint_path, task, keys[task], result['status'])
+
+    prefetch_queue.put(None)
+
+    for name, stage_results in results.items():
+        stage_results.sort(key=lambda result: (result['subject'], result['session']))
+        print_session_summary(name, stage_results)
+
+    print("run scheduled")
+    return results
@@ -0,0 +1,93 @@
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from src.metrics import measure, metrics_path, stage_record
+
+
+# Size of the subject/session grid every stage walks through
+num_subjects = 26
+num_sessions = 5
+
+
+def session_grid():
+    # All (subject, session) pairs in the same order as the original nested loops
+    return [(i, j) for i in range(1, num_subjects+1) for j in range(1, num_sessions+1)]
+
+
+def subject_grid():
+    # (subject, None) pairs for stages that process all sessions of a subject at once
+    return [(i, None) for i in range(1, num_subjects+1)]
+
+
+def resolve_n_jobs(n_jobs):
+    # None/0/1 run serially, negative values count back from the number of cores (-1 = all cores)
+    if not n_jobs:
+        return 1
+    if n_jobs < 0:
+        return max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def _run_session(session_fn, subject, session, kwargs):
+    # Run one session and turn whatever happens into a result record, so one failing session never stops the others.
+    # The session's metrics (see metrics.measure) are written to the run's metrics file and returned with the result.
+    start, started = time.perf_counter(), time.time()
+    error = None
+    with measure(session_fn.__name__.lstrip('_'), subject, session) as record:
+        try:
+            status = session_fn(subject, session, **kwargs) or 'ok'
+        except Exception as e:
+            status = 'error'
+            error = f"{type(e).__name__}: {e}"
+            print(f"Error processing Subject {subject} Session {session}: {error}")
+            print(traceback.format_exc())
+        record.update(status=status, error=error)
+
+    # started/finished are wall-clock times, comparable across worker processes (the stage's span, see metrics.stage_record)
+    return dict(subject=subject, session=session, status=status, elapsed=time.perf_counter() - start, error=error, metrics=record,
+                started=started, finished=time.time())
+
+
+def run_sessions(session_fn, n_jobs=1, sessions=None, **kwargs):
+    # session_fn(subject, session, **kwargs) processes one session and returns 'ok', 'skipped' (missing input)
+    # or 'cached' (output already up to date), None counts as 'ok'.
+    # It must be a module level function so that it can be sent to the worker processes.
+    if sessions is None:
+        sessions = session_grid()
+    # Fix the metrics file name before the workers start, they inherit it through the environment
+    metrics_path()
+    n_jobs = min(resolve_n_jobs(n_jobs), max(len(sessions), 1))
+
+    if n_jobs == 1:
+        results = [_run_session(session_fn, subject, session, kwargs) for subject, session in sessions]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_run_session, session_fn, subject, session, kwargs) for subject, session in sessions]
+
+            # Collect in grid order so the results line up with the serial path
+            results = []
+            for (subject, session), future in zip(sessions, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # The worker itself died (e.g. killed for memory), record it like any other session error
+                    results.append(dict(subject=subject, session=session, status='error', elapsed=0.0, error=f"{type(e).__name__}: {e}"))
+
+    return results
+
+
+def print_session_summary(stage_name, results):
+    counts = {'ok': 0, 'cached': 0, 'skipped': 0, 'error': 0}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    total_time = sum(result['elapsed'] for result in results)
+
+    stage_record(stage_name, results)
+    print(f"---------------- {stage_name}: {counts['ok']} ok, {counts['cached']} cached, {counts['skipped']} skipped, {counts['error']} error "
+          f"({total_time:.1f} s of session time) ----------------")
+    for result in results:
+        if result['status'] == 'error':
+            session = f" Sess{result['session']:02d}" if result['session'] is not None else ''
+            print(f"S{result['subject']:02d}{session}: {result['error']}")
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+
+from src.save_original_raw import all_data_dir, channel_names, sampling_rate
+from src.session_executor import session_grid
+from src.stage_cache import file_sha256, is_fresh, record_output
+from src.precision import storage_dtype
+from src.metrics import measured_stage
+
+
+# One-time binary copy of data/allData:
+#   signals.dat   (n_channels, n_samples) block per session in volts (float64 or float32, see precision.py), back to back
+#   time.dat      float64 Time column per session
+#   feedback.dat  int8 FeedBackEvent column per session
+#   index.json    channel names, sfreq and per-session byte offsets and shapes
+session_store_dir = 'data/sessionStore'
+
+
+def _store_paths(store_dir):
+    return {name: os.path.join(store_dir, f"{name}.dat") for name in ('signals', 'time', 'feedback')}
+
+
+def _parse_session_csv(session_path, csv_engine):
+    # Only the channel columns plus Time and FeedBackEvent are parsed, P08 is read under its typo name and renamed
+    with open(session_path) as f:
+        header = f.readline().rstrip('\r\n').split(',')
+    rename = {'P08': 'PO8'} if 'P08' in header else {}
+    wanted = [{v: k for k, v in rename.items()}.get(name, name) for name in channel_names]
+    dtypes = {name: np.float64 for name in wanted + ['Time']}
+    dtypes['FeedBackEvent'] = np.int8
+
+    df = pd.read_csv(session_path, engine=csv_engine, usecols=wanted + ['Time', 'FeedBackEvent'], dtype=dtypes)
+    df.rename(columns=rename, inplace=True)
+
+    # (n_channels, n_samples) in volts, filled column by column so there is no transposed copy
+    data = np.empty((len(channel_names), len(df)), dtype=storage_dtype())
+    for k, name in enumerate(channel_names):
+        np.divide(df[name].to_numpy(), 1e6, out=data[k])   # Convert microvolts to volts
+
+    return data, df['Time'].to_numpy(), df['FeedBackEvent'].to_numpy()
+
+
+@measured_stage
+def build_session_store(store_dir=session_store_dir, csv_engine='c', force=False):
+    ##################################################################
+    #          Convert every session CSV to the binary store
+    ##################################################################
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    index_path = os.path.join(store_dir, 'index.json')
+    sessions = [(i, j, f"{all_data_dir}/Data_S{i:02d}_Sess{j:02d}.csv") for i, j in session_grid()]
+    sessions = [(i, j, path) for i, j, path in sessions if os.path.exists(path)]
+    csv_paths = [path for _, _, path in sessions]
+    params = dict(channel_names=channel_names, sfreq=sampling_rate, dtype=np.dtype(storage_dtype()).name)
+    if not force and is_fresh(index_path, 'build_session_store', csv_paths, params):
+        print(f"Up to date, skipping {index_path}")
+        return
+
+    paths = _store_paths(store_dir)
+    index = dict(channel_names=channel_names, sfreq=sampling_rate, dtype=np.dtype(storage_dtype()).name, sessions={})
+    offsets = {name: 0 for name in paths}
+    files = {name: open(path + '.tmp', 'wb') for name, path in paths.items()}
+    try:
+        for i, j, session_path in sessions:
+            print(session_path)
+            start = time.perf_counter()
+            data, times, feedback = _parse_session_csv(session_path, csv_engine)
+
+            index['sessions'][f"S{i:02d}_Sess{j:02d}"] = dict(
+                subject=i, session=j, n_samples=data.shape[1], sha256=file_sha256(session_path),
+                signal_offset=offsets['signals'], time_offset=offsets['time'], feedback_offset=offsets['feedback'])
+
+            for name, array in (('signals', data), ('time', times), ('feedback', feedback)):
+                array.tofile(files[name])
+                offsets[name] += array.nbytes
+
+            print(f"=========================> Stored {data.shape} in {time.perf_counter() - start:.2f} s")
+    finally:
+        for f in files.values():
+            f.close()
+
+    for name, path in paths.items():
+        os.replace(path + '.tmp', path)
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    record_output(index_path, 'build_session_store', csv_paths, params)
+
+    print("build session store completed")
+
+
+def open_session_store(store_dir=session_store_dir):
+    # Returns the store index, or None when the store was never built
+    index_path = os.path.join(store_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def has_session(subject, session, store_dir=session_store_dir):
+    index = open_session_store(store_dir)
+    return index is not None and f"S{subject:02d}_Sess{session:02d}" in index['sessions']
+
+
+def load_session(subject, session, channels=None, start=None, stop=None, store_dir=session_store_dir, index=None):
+    # Memory-mapped (n_channels, n_samples) view of one session in volts, nothing is read until the values are used.
+    # channels can be a list of names (returns a copy of those rows) or None for all channels (returns a view).
+    index = index or open_session_store(store_dir)
+    entry = index['sessions'][f"S{subject:02d}_Sess{session:02d}"]
+    signals = np.memmap(_store_paths(store_dir)['signals'], dtype=index['dtype'], mode='r',
+                        offset=entry['signal_offset'], shape=(len(index['channel_names']), entry['n_samples']))
+
+    signals = signals[:, start:stop]
+    if channels is not None:
+        rows = [index['channel_names'].index(name) for name in channels]
+        signals = signals[rows]
+    return signals
+
+
+def load_session_events(subject, session, store_dir=session_store_dir, index=None):
+    # Memory-mapped Time and FeedBackEvent columns of one session
+    index = index or open_session_store(store_dir)
+    entry = index['sessions'][f"S{subject:02d}_Sess{session:02d}"]
+    paths = _store_paths(store_dir)
+    times = np.memmap(paths['time'], dtype=np.float64, mode='r', offset=entry['time_offset'], shape=(entry['n_samples'],))
+    feedback = np.memmap(paths['feedback'], dtype=np.int8, mode='r', offset=entry['feedback_offset'], shape=(entry['n_samples'],))
+    return times, feedback
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+
+
+# Every output file gets a small record next to it (<dir>/.stage_keys/<file>.json) holding the stage, its parameters,
+# and the size/mtime/sha256 of every input. One record per output keeps parallel workers from racing on a shared manifest.
+record_dir_name = '.stage_keys'
+
+# Hashes already computed in this process, keyed by (path, size, mtime_ns), so shared inputs like AllDataLabels.csv are read once
+_hash_memo = {}
+
+
+def file_sha256(file_path, chunk_size=1 << 22):
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _hash_memo:
+        return _hash_memo[memo_key]
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    _hash_memo[memo_key] = sha.hexdigest()
+    return _hash_memo[memo_key]
+
+
+def _normalize_params(params):
+    # Round trip through JSON so tuples/lists, numpy scalars etc. compare the same way as the stored record
+    return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+
+def _record_path(output_path):
+    return os.path.join(os.path.dirname(output_path), record_dir_name, os.path.basename(output_path) + '.json')
+
+
+def _read_record(output_path):
+    record_path = _record_path(output_path)
+    if not os.path.exists(record_path):
+        return None
+    try:
+        with open(record_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def stage_key(stage, input_hashes, params):
+    # Content address of an output: the stage name, its parameters and the hashes of its inputs
+    payload = json.dumps({'stage': stage, 'params': _normalize_params(params), 'inputs': input_hashes}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def is_fresh(output_paths, stage, input_paths, params):
+    # True if every output exists and was produced by this stage from the same input contents and parameters
+    if isinstance(output_paths, str):
+        output_paths = [output_paths]
+
+    for output_path in output_paths:
+        record = _read_record(output_path)
+        if record is None or not os.path.exists(output_path):
+            return False
+        if record['stage'] != stage or record['params'] != _normalize_params(params):
+            return False
+        if sorted(record['inputs']) != sorted(input_paths):
+            return False
+
+        input_hashes = {}
+        for input_path in input_paths:
+            if not os.path.exists(input_path):
+                return False
+            entry = record['inputs'][input_path]
+            stat = os.stat(input_path)
+            if stat.st_size != entry['size']:
+                return False
+            # Only hash the content when the file was touched, a rewritten but identical file is still fresh
+            if stat.st_mtime_ns != entry['mtime_ns'] and file_sha256(input_path) != entry['sha256']:
+                return False
+            input_hashes[input_path] = entry['sha256']
+
+        if stage_key(stage, input_hashes, params) != record['key']:
+            return False
+
+    return True
+
+
+def record_output(output_paths, stage, input_paths, params):
+    # Write the record for freshly produced outputs (call after the outputs were saved)
+    if isinstance(output_paths, str):
+        output_paths = [output_paths]
+
+    inputs = {}
+    for input_path in input_paths:
+        stat = os.stat(input_path)
+        inputs[input_path] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=file_sha256(input_path))
+    key = stage_key(stage, {path: entry['sha256'] for path, entry in inputs.items()}, params)
+
+    for output_path in output_paths:
+        record_path = _record_path(output_path)
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        record = dict(stage=stage, key=key, params=_normalize_params(params), inputs=inputs)
+        with open(record_path + '.tmp', 'w') as f:
+            json.dump(record, f, indent=1)
+        os.replace(record_path + '.tmp', record_path)
+
+    return key
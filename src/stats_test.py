@@ -1,73 +1,153 @@
 import os
+import json
 import numpy as np
 import mne
-from mne.stats import permutation_cluster_test
 
+from src.session_executor import session_grid
+from src.stage_cache import file_sha256, is_fresh, record_output, stage_key
+from src.epochs_store import store_exists, store_files, select_epochs, open_epochs_store, read_store_info
+from src.cluster_engine import cluster_permutation_test
+from src.metrics import dump, measured_stage
 
-def compute_cluster_permutation():
+
+perm_test_dir = "data/stats"
+perm_test_path = f"{perm_test_dir}/perm_test_evoked-ave.fif"
+# Full test result next to the T-value evoked: T_obs, bit-packed cluster masks, cluster statistics and p-values, the
+# permutation distribution H0, the parameters and the fingerprint (stage key) of the epochs it was computed from
+cluster_result_path = f"{perm_test_dir}/cluster_test.npz"
+
+
+@measured_stage
+def compute_cluster_permutation(p_threshold=0.05, n_permutations=1000, n_jobs=1, chunk_size=50, early_stop=False, random_state=0, force=False):
+    # Returns the test result (see load_cluster_result), from cluster_test.npz when it is up to date
     #-- Get data for each condition over each epoch (each observation)
     epochs_dir = "data/epochs"
+
+    # Skip the test when neither the epochs nor the test parameters changed since the last run
+    if store_exists():
+        input_paths = store_files()
+    else:
+        input_paths = [f'{epochs_dir}/Data_S{subject_id:02d}_Sess{session_id:02d}_epochs_epo.fif' for subject_id, session_id in session_grid()]
+    # The cluster-forming threshold is a p-value (converted to an F value by the engine), clusters span neighbouring
+    # sensors and time points. n_jobs and chunk_size only change the speed, not the result.
+    params = dict(p_threshold=p_threshold, n_permutations=n_permutations, tail=1, adjacency='standard_1020',
+                  early_stop=early_stop, random_state=random_state)
+    output_paths = [perm_test_path, cluster_result_path]
+    if not force and is_fresh(output_paths, 'compute_cluster_permutation', input_paths, params):
+        print(f"Up to date, loading {cluster_result_path}")
+        return load_cluster_result()
     
     #-- Prep data for correct and incorrect responses based on epochs for all sessions
-    data_correct = []
-    data_incorrect = []
-    for subject_id in range(1, 27):    # Loop through subjects
-        for session_id in range(1, 6):    # Loop through sessions
-            # Define path and read epochs data for this session
-            file_path = f'{epochs_dir}/Data_S{subject_id:02d}_Sess{session_id:02d}_epochs_epo.fif'
-            epochs = mne.read_epochs(file_path, preload=True)
-
-            # Append data for each event type to the aggregate list
-            data_correct.append(epochs['correct'].get_data(copy=True))
-            data_incorrect.append(epochs['incorrect'].get_data(copy=True))
-
-    # Convert lists of arrays into a single array for each condition
-    data_correct = np.concatenate(data_correct, axis=0)  # Shape (n_correct_epochs, n_channels, n_timepoints)
-    data_incorrect = np.concatenate(data_incorrect, axis=0)  # Shape (n_incorrect_epochs, n_channels, n_timepoints)
+    data_correct, data_incorrect, info, tmin = load_condition_data(epochs_dir)
 
     print("-------------------- Data Correct --------------------")
-    print(data_correct)
+    dump(data_correct)
     print(data_correct.shape)
     print("-------------------- Data Incorrect --------------------")
-    print(data_incorrect)
+    dump(data_incorrect)
     print(data_incorrect.shape)
 
     # Conduct the permutation cluster test
     X = [data_correct, data_incorrect]
-    T_obs, clusters, cluster_p_values, H0 = permutation_cluster_test(X, threshold=0.05, n_permutations=1000, tail=1)
+    result = cluster_permutation_test(X, info, p_threshold=p_threshold, n_permutations=n_permutations, n_jobs=n_jobs,
+                                      chunk_size=chunk_size, early_stop=early_stop, random_state=random_state)
+    T_obs, clusters, cluster_p_values, H0 = result['T_obs'], result['clusters'], result['cluster_p_values'], result['H0']
     # Observed Statistic
     print("------------------ T_obs --------------------")
-    print(T_obs)
+    dump(T_obs)
     # Cluster Information
     print("------------------ Clusters --------------------")
-    print(clusters)
+    print(f"{len(clusters)} clusters, sizes {[int(c.sum()) for c in clusters]}")
     # p-values for each cluster
     print("------------------ cluster_p_values --------------------")
     print(cluster_p_values)
     # Permutation distribution of the max statistic
     print("------------------ H0 --------------------")
-    print(H0)
-
-    # Get info and start time from any existing Evoked object
-    sample_epoch_path = f"{epochs_dir}/Data_S01_Sess01_epochs_epo.fif"
-    sample_epoch = mne.read_epochs(sample_epoch_path, preload=True)
-    info = sample_epoch[0].info
-    tmin = sample_epoch[0].times[0]
+    print(f"{len(H0)} permutations, max cluster statistic {H0.max() if len(H0) else 0:.2f}")
 
     print("-------------------- Info --------------------")
-    print(info)
+    dump(info)
 
     # Create an Evoked object containing the T-values from the permutation test 
     t_evoked = mne.EvokedArray(T_obs, info, tmin=tmin)
 
     # Save the evoked object based on T-values obtained from cluster permutation test
-    perm_test_dir = "data/stats"
 
     # Ensure permTest directory exists
     if not os.path.exists(perm_test_dir):
         os.makedirs(perm_test_dir)
 
     # Save Evoked object containing the T-values form the permutation test
-    perm_test_path = f"{perm_test_dir}/perm_test_evoked-ave.fif"
     t_evoked.save(perm_test_path, overwrite=True)
 
+    fingerprint = stage_key('compute_cluster_permutation', {path: file_sha256(path) for path in input_paths}, params)
+    save_cluster_result(result, params, fingerprint, tmin)
+    record_output(output_paths, 'compute_cluster_permutation', input_paths, params)
+    return load_cluster_result()
+
+
+def save_cluster_result(result, params, fingerprint, tmin, path=cluster_result_path):
+    # Cluster masks are stored as one bit per (channel, time) point, so even many clusters take a few kB
+    shape = result['T_obs'].shape
+    masks = np.zeros((len(result['clusters']), shape[0] * shape[1]), dtype=bool)
+    for k, mask in enumerate(result['clusters']):
+        masks[k] = mask.ravel()
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, T_obs=result['T_obs'], shape=np.array(shape), cluster_masks=np.packbits(masks, axis=1),
+                            cluster_stats=result['cluster_stats'], cluster_p_values=result['cluster_p_values'],
+                            H0=result['H0'], threshold=result['threshold'], tmin=tmin,
+                            params=json.dumps(params, sort_keys=True), fingerprint=fingerprint)
+    os.replace(path + '.tmp', path)
+
+
+def load_cluster_result(path=cluster_result_path):
+    # Same keys as cluster_engine.cluster_permutation_test, plus info/tmin to rebuild the T-value evoked, params and fingerprint
+    with np.load(path) as saved:
+        shape = tuple(saved['shape'])
+        masks = np.unpackbits(saved['cluster_masks'], axis=1, count=shape[0] * shape[1]).astype(bool)
+        result = dict(T_obs=saved['T_obs'], clusters=[mask.reshape(shape) for mask in masks],
+                      cluster_stats=saved['cluster_stats'], cluster_p_values=saved['cluster_p_values'], H0=saved['H0'],
+                      threshold=float(saved['threshold']), tmin=float(saved['tmin']), n_permutations=len(saved['H0']),
+                      params=json.loads(str(saved['params'])), fingerprint=str(saved['fingerprint']))
+    result['info'] = mne.read_evokeds(perm_test_path, verbose=False)[0].info
+    return result
+
+
+
+def load_condition_data(epochs_dir="data/epochs"):
+    # (n_epochs, n_channels, n_times) arrays of the correct and incorrect epochs of all sessions, plus the info and tmin
+    # to rebuild Evoked objects. Reads the consolidated epochs store when it exists, the per-session files otherwise.
+    use_store = store_exists()
+    epochs_paths = [f'{epochs_dir}/Data_S{subject_id:02d}_Sess{session_id:02d}_epochs_epo.fif' for subject_id, session_id in session_grid()]
+
+    #-- Prep data for correct and incorrect responses based on epochs for all sessions
+    if use_store:
+        # One read per condition straight from the consolidated store, no per-session lists to concatenate
+        data_correct, _ = select_epochs(condition='correct')
+        data_incorrect, _ = select_epochs(condition='incorrect')
+    else:
+        data_correct = []
+        data_incorrect = []
+        for file_path in epochs_paths:    # Loop through subjects and sessions
+            # Read epochs data for this session
+            epochs = mne.read_epochs(file_path, preload=True)
+
+            # Append data for each event type to the aggregate list
+            data_correct.append(epochs['correct'].get_data(copy=True))
+            data_incorrect.append(epochs['incorrect'].get_data(copy=True))
+
+        # Convert lists of arrays into a single array for each condition
+        data_correct = np.concatenate(data_correct, axis=0)  # Shape (n_correct_epochs, n_channels, n_timepoints)
+        data_incorrect = np.concatenate(data_incorrect, axis=0)  # Shape (n_incorrect_epochs, n_channels, n_timepoints)
+
+    # Get info and start time from any existing Evoked object
+    if use_store:
+        info = read_store_info()
+        tmin = open_epochs_store()[2]['tmin']
+    else:
+        sample_epoch_path = f"{epochs_dir}/Data_S01_Sess01_epochs_epo.fif"
+        sample_epoch = mne.read_epochs(sample_epoch_path, preload=True)
+        info = sample_epoch[0].info
+        tmin = sample_epoch[0].times[0]
+
+    return data_correct, data_incorrect, info, tmin
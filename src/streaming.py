@@ -0,0 +1,225 @@
+import os
+import time
+import socket
+import struct
+import numpy as np
+import pandas as pd
+from scipy import signal
+import mne
+
+from src.save_original_raw import all_data_dir, channel_names, channel_types, sampling_rate
+from src.bad_channels import load_bad_channels, session_bad_channels, bad_channels_path
+from src.get_erp import feedback_labels_path, default_reject_criteria, event_types
+from src.event_index import parse_feedback_ids, has_contiguous_trials
+from src.filter_engine import iir_sos
+
+
+# Live version of the feedback ERP analysis: sample chunks come from a source, are rereferenced and band-passed as they
+# arrive, and every feedback epoch (-0.2 to 0.6 s) is cut, baselined, checked and added to the running averages as soon as
+# its last sample is in. Bad channels are handled like rereference: the common set is dropped and the session's other
+# bad channels are interpolated sample by sample (spherical spline interpolation is one fixed matrix, computed once).
+# Differences with the offline pipeline: the band-pass is causal (Butterworth SOS, so the ERP is delayed by the
+# filter's group delay) and there is no ICA or equalization of the event counts.
+streaming_dir = 'data/streaming'
+event_names = {1: 'incorrect', 2: 'correct'}
+
+# Socket frame: int32 sample count, then (n_channels + 1) x n float32 values, channel rows followed by FeedBackEvent
+frame_header = struct.Struct('<i')
+
+
+def csv_replay_source(subject, session, chunk_size=20, realtime=False):
+    # Chunks of a recorded session as they would come from the amplifier: dict(data=(n_channels, n) volts, feedback=(n,),
+    # received=perf_counter time the chunk became available). realtime=True paces the chunks at the sampling rate.
+    session_path = f"{all_data_dir}/Data_S{subject:02d}_Sess{session:02d}.csv"
+    with open(session_path) as f:
+        header = f.readline().rstrip('\r\n').split(',')
+    # P08 is the typo'd PO8 column of the original files
+    columns = ['P08' if name == 'PO8' and 'P08' in header else name for name in channel_names]
+
+    start = time.perf_counter()
+    n_sent = 0
+    for chunk in pd.read_csv(session_path, usecols=columns + ['FeedBackEvent'], chunksize=chunk_size):
+        if realtime:
+            time.sleep(max(start + (n_sent + len(chunk)) / sampling_rate - time.perf_counter(), 0))
+        n_sent += len(chunk)
+        yield dict(data=chunk[columns].to_numpy(dtype=np.float64).T / 1e6,   # Convert microvolts to volts
+                   feedback=chunk['FeedBackEvent'].to_numpy(), received=time.perf_counter())
+
+
+def serve_session(subject, session, host='127.0.0.1', port=5555, chunk_size=20, realtime=True):
+    # Local stand-in for the amplifier: waits for one client and streams a recorded session to it in socket frames
+    with socket.create_server((host, port)) as server:
+        print(f"Serving S{subject:02d} Sess{session:02d} on {host}:{port}")
+        connection, _ = server.accept()
+        with connection:
+            for chunk in csv_replay_source(subject, session, chunk_size, realtime):
+                values = np.vstack([chunk['data'], chunk['feedback'][None, :]]).astype(np.float32)
+                connection.sendall(frame_header.pack(values.shape[1]) + values.tobytes())
+
+
+def socket_source(host='127.0.0.1', port=5555, n_channels=len(channel_names)):
+    # Chunks from serve_session (or an amplifier bridge speaking the same frames), same dicts as csv_replay_source
+    with socket.create_connection((host, port)) as connection:
+        stream = connection.makefile('rb')
+        while True:
+            header = stream.read(frame_header.size)
+            if len(header) < frame_header.size:
+                return
+            n_samples, = frame_header.unpack(header)
+            values = np.frombuffer(stream.read((n_channels + 1) * n_samples * 4), dtype=np.float32).reshape(n_channels + 1, n_samples)
+            yield dict(data=values[:-1].astype(np.float64), feedback=values[-1].astype(int), received=time.perf_counter())
+
+
+def interpolation_matrix(ch_names, interpolated):
+    # (n_channels, n_channels) matrix T with T @ data = data with the interpolated channels replaced by their spherical
+    # spline estimate, as raw.interpolate_bads does. The interpolation is linear, so it is read off the identity.
+    info = mne.create_info(ch_names, sampling_rate, [channel_types[channel_names.index(name)] for name in ch_names])
+    info.set_montage('standard_1020')
+    identity = mne.io.RawArray(np.eye(len(ch_names)), info, verbose='error')
+    identity.info['bads'] = list(interpolated)
+    return identity.interpolate_bads(reset_bads=True, verbose='error').get_data()
+
+
+def stream_bad_channels(subject, session):
+    # (dropped, interpolated) of the session from the bad channel table, none (with a note) without one
+    table = load_bad_channels()
+    if table is None:
+        print(f"No bad channel table at {bad_channels_path}, streaming without bad channel handling")
+        return [], []
+    return session_bad_channels(subject, session, table)
+
+
+class StreamProcessor:
+    # Incremental interpolation -> rereference -> causal band-pass -> epoching -> running averages over incoming chunks.
+    # labels: event IDs (1 incorrect, 2 correct) of the session's feedback events in order, as in AllDataLabels.csv
+    # dropped, interpolated: the session's bad channels (see stream_bad_channels)
+
+    def __init__(self, labels, low_freq=1, high_freq=40, sfreq=sampling_rate, tmin=-0.2, tmax=0.6, reject_criteria=None,
+                 buffer_seconds=4.0, dropped=(), interpolated=()):
+        self.labels = list(labels)
+        self.sfreq = sfreq
+        self.reject = (reject_criteria or default_reject_criteria)['eeg']
+
+        # Same channels as rereference: the channels dropped from every session dropped, the session's other bad
+        # channels interpolated, EOG kept but not part of the average reference
+        self.ch_names = [name for name in channel_names if name not in dropped]
+        self.keep = np.array([channel_names.index(name) for name in self.ch_names])
+        self.eeg = np.array([name != 'EOG' for name in self.ch_names])
+        interpolated = [name for name in interpolated if name in self.ch_names]
+        self.interpolation = interpolation_matrix(self.ch_names, interpolated) if interpolated else None
+
+        self.sos = iir_sos(sfreq, low_freq, high_freq)
+        self.zi = None
+
+        # Epoch window in samples relative to the event (tmax included, like mne.Epochs)
+        self.pre = int(round(-tmin * sfreq))
+        self.post = int(round(tmax * sfreq))
+        self.times = np.arange(-self.pre, self.post + 1) / sfreq
+
+        # Ring buffer of the latest filtered samples, n_seen counts every sample since the start
+        self.buffer = np.zeros((len(self.ch_names), int(buffer_seconds * sfreq)))
+        self.n_seen = 0
+        self.pending = []   # (event sample, event id, received time of the chunk with the event)
+        self.n_events = 0
+
+        self.sums = {name: np.zeros((len(self.ch_names), len(self.times))) for name in event_types}
+        self.counts = {name: 0 for name in event_types}
+        self.latencies = []
+
+    def process_chunk(self, chunk):
+        data = chunk['data'][self.keep]
+        n = data.shape[1]
+        if self.interpolation is not None:
+            data = self.interpolation @ data
+
+        # Average reference over the EEG channels, then the causal band-pass (filter state carried between chunks)
+        data[self.eeg] -= data[self.eeg].mean(axis=0)
+        if self.zi is None:
+            self.zi = signal.sosfilt_zi(self.sos)[:, None, :] * data[:, :1][None, :, :]
+        data, self.zi = signal.sosfilt(self.sos, data, axis=1, zi=self.zi)
+
+        # Append to the ring buffer (write position = absolute sample index modulo its length)
+        positions = (self.n_seen + np.arange(n)) % self.buffer.shape[1]
+        self.buffer[:, positions] = data
+        for offset in np.flatnonzero(chunk['feedback'] == 1):
+            if self.n_events >= len(self.labels):
+                print(f"Feedback event {self.n_events + 1} has no label, ignored")
+            else:
+                self.pending.append((self.n_seen + offset, self.labels[self.n_events], chunk['received']))
+            self.n_events += 1
+        self.n_seen += n
+
+        # Epochs whose window is complete
+        completed = [event for event in self.pending if event[0] + self.post < self.n_seen]
+        self.pending = [event for event in self.pending if event[0] + self.post >= self.n_seen]
+        return [self._epoch(*event, completed_at=chunk['received']) for event in completed]
+
+    def _epoch(self, event_sample, event_id, event_received, completed_at):
+        condition = event_names[event_id]
+        first = event_sample - self.pre
+        if first < 0 or self.n_seen - first > self.buffer.shape[1]:
+            status = 'outside buffer'
+        else:
+            epoch = self.buffer[:, np.arange(first, event_sample + self.post + 1) % self.buffer.shape[1]]
+            epoch = epoch - epoch[:, :self.pre + 1].mean(axis=1, keepdims=True)   # Baseline -0.2 to 0 s
+            peak_to_peak = np.ptp(epoch[self.eeg], axis=1).max()
+            if peak_to_peak > self.reject:
+                status = 'rejected'
+            else:
+                status = 'kept'
+                self.sums[condition] += epoch
+                self.counts[condition] += 1
+
+        # Latency from the arrival of the chunk holding the epoch's last sample to the updated average
+        latency = time.perf_counter() - completed_at
+        record = dict(event_sample=event_sample, condition=condition, status=status, latency_ms=latency * 1e3,
+                      since_event_ms=(time.perf_counter() - event_received) * 1e3)
+        self.latencies.append(record)
+        return record
+
+    def averages(self):
+        # Running per-condition averages, (n_channels, n_times) in volts, None while a condition has no epoch yet
+        return {name: self.sums[name] / self.counts[name] if self.counts[name] else None for name in event_types}
+
+
+def session_labels(subject, session):
+    # Event IDs of a session's feedback events in order (1 incorrect, 2 correct)
+    labels_df = parse_feedback_ids(pd.read_csv(feedback_labels_path))
+    labels_df = labels_df[(labels_df['subject'] == subject) & (labels_df['session'] == session)]
+    if not has_contiguous_trials(labels_df):
+        raise ValueError(f"Feedback label trial numbers of S{subject:02d} Sess{session:02d} are not 1..{len(labels_df)}")
+    return (labels_df['Prediction'].to_numpy() + 1).tolist()
+
+
+def run_stream(subject, session, source='replay', low_freq=1, high_freq=40, reject_criteria=None, chunk_size=20, realtime=False,
+               host='127.0.0.1', port=5555):
+    ##################################################################
+    #      Live feedback ERP of one session from a sample stream
+    ##################################################################
+    # source='replay' reads the session csv chunk by chunk, source='socket' connects to serve_session / an amplifier bridge
+    if source == 'replay':
+        chunks = csv_replay_source(subject, session, chunk_size, realtime)
+    elif source == 'socket':
+        chunks = socket_source(host, port)
+    else:
+        raise ValueError(f"Unknown source '{source}', expected 'replay' or 'socket'")
+
+    dropped, interpolated = stream_bad_channels(subject, session)
+    processor = StreamProcessor(session_labels(subject, session), low_freq, high_freq, reject_criteria=reject_criteria,
+                                dropped=dropped, interpolated=interpolated)
+    for chunk in chunks:
+        for record in processor.process_chunk(chunk):
+            print(f"S{subject:02d} Sess{session:02d} event at sample {record['event_sample']}: {record['condition']} {record['status']}, "
+                  f"latency {record['latency_ms']:.2f} ms, running n = {processor.counts}")
+
+    latencies = pd.DataFrame(processor.latencies)
+    if not os.path.exists(streaming_dir):
+        os.makedirs(streaming_dir)
+    latency_path = f"{streaming_dir}/Data_S{subject:02d}_Sess{session:02d}_latency.csv"
+    latencies.to_csv(latency_path, index=False)
+
+    if len(latencies):
+        print(f"---------------- stream: {len(latencies)} events, {processor.counts} kept, latency median "
+              f"{latencies['latency_ms'].median():.2f} ms, p95 {latencies['latency_ms'].quantile(0.95):.2f} ms, "
+              f"max {latencies['latency_ms'].max():.2f} ms ----------------")
+    return processor
@@ -0,0 +1,108 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+from src.save_original_raw import all_data_dir, channel_names, sampling_rate
+from src.get_erp import original_dir, feedback_labels_path
+
+
+# Synthetic recordings in the layout of the real data, so every stage can be run and timed without data/allData:
+#   data/allData/original/Data_SXX_SessYY.csv   Time, the 57 channels in microvolts (PO8 under its original 'P08' typo),
+#                                               FeedBackEvent (1 at each feedback onset)
+#   data/allData/Data_SXX_SessYY.csv            same file, where create_epochs reads the feedback times
+#   data/AllDataLabels.csv                      IdFeedBack ('S02_Sess01_FB001'), Prediction (1 correct, 0 incorrect)
+# Each session is background noise with alpha, eye blinks on EOG and the frontal channels, and after every feedback a
+# fronto-central negativity plus a centro-parietal P300 that is larger after incorrect feedback.
+
+# Scalp weight of the evoked components (channels not listed get a small share)
+p300_weights = {'Pz': 1.0, 'CPz': 0.9, 'P1': 0.85, 'P2': 0.85, 'CP1': 0.8, 'CP2': 0.8, 'Cz': 0.7, 'POz': 0.7, 'P3': 0.6, 'P4': 0.6}
+ern_weights = {'FCz': 1.0, 'Fz': 0.8, 'Cz': 0.8, 'FC1': 0.7, 'FC2': 0.7, 'F1': 0.5, 'F2': 0.5}
+blink_weights = {'Fp1': 0.6, 'Fp2': 0.6, 'AF7': 0.4, 'AF8': 0.4, 'AF3': 0.4, 'AF4': 0.4, 'F7': 0.2, 'F8': 0.2}
+
+
+def _channel_weights(weights, floor=0.05):
+    return np.array([weights.get(name, floor) for name in channel_names])
+
+
+def generate_session(subject, session, n_feedback=60, interval=(4.0, 6.0), sfreq=sampling_rate, p_correct=0.7, seed=0):
+    # One session as (DataFrame in the csv layout, feedback labels 1 correct / 0 incorrect).
+    # The session lasts about n_feedback * mean(interval) + 10 s.
+    rng = np.random.default_rng([seed, subject, session])
+    onsets = 5.0 + np.cumsum(rng.uniform(*interval, n_feedback))
+    n_samples = int((onsets[-1] + 5.0) * sfreq)
+    times = np.arange(n_samples) / sfreq
+    labels = (rng.random(n_feedback) < p_correct).astype(int)
+
+    # Background: AR(1) noise per channel (1/f-like), a 10 Hz alpha rhythm strongest at the back, slow drift
+    white = rng.normal(0, 4.0, (len(channel_names), n_samples))
+    noise = signal.lfilter([1.0], [1.0, -0.95], white, axis=1)
+    alpha_weights = np.array([1.0 if name.startswith(('P', 'O')) else 0.3 for name in channel_names])
+    alpha = 6.0 * np.sin(2 * np.pi * 10.0 * times + rng.uniform(0, 2 * np.pi))
+    data = noise * 0.3 + alpha_weights[:, None] * alpha[None, :] + 10.0 * np.sin(2 * np.pi * 0.05 * times)[None, :]
+
+    # Eye blinks: ~300 ms bumps every few seconds on EOG, leaking into the frontal channels
+    blink_times = np.cumsum(rng.uniform(2.0, 8.0, int(times[-1] / 2.0)))
+    blink_times = blink_times[blink_times < times[-1] - 1]
+    blink = np.zeros(n_samples)
+    for blink_time in blink_times:
+        blink += 150.0 * np.exp(-0.5 * ((times - blink_time) / 0.08) ** 2)
+    eog = channel_names.index('EOG')
+    data += np.outer(_channel_weights(blink_weights, floor=0.0), blink)
+    data[eog] += blink
+
+    # Feedback responses: negativity at 250 ms (incorrect only) and P300 at 350 ms (larger after incorrect feedback)
+    p300 = _channel_weights(p300_weights)
+    ern = _channel_weights(ern_weights)
+    window = np.arange(int(-0.2 * sfreq), int(0.8 * sfreq))
+    for onset, label in zip(onsets, labels):
+        start = int(onset * sfreq)
+        t = window / sfreq
+        latency_jitter = rng.normal(0, 0.02)
+        p300_wave = (4.0 if label else 8.0) * np.exp(-0.5 * ((t - 0.35 - latency_jitter) / 0.08) ** 2)
+        ern_wave = (0.0 if label else -5.0) * np.exp(-0.5 * ((t - 0.25 - latency_jitter) / 0.04) ** 2)
+        data[:, start + window] += np.outer(p300, p300_wave) + np.outer(ern, ern_wave)
+
+    feedback = np.zeros(n_samples, dtype=int)
+    feedback[(onsets * sfreq).astype(int)] = 1
+
+    columns = {'Time': np.round(times, 3)}
+    for k, name in enumerate(channel_names):
+        columns['P08' if name == 'PO8' else name] = data[k]
+    columns['FeedBackEvent'] = feedback
+    return pd.DataFrame(columns), labels
+
+
+def generate_dataset(n_subjects=26, n_sessions=5, n_feedback=60, interval=(4.0, 6.0), p_correct=0.7, seed=0, root='.'):
+    ##################################################################
+    #         Write synthetic sessions and AllDataLabels.csv
+    ##################################################################
+    # root is the directory the data/ tree is written under (the working directory of the stages reading it)
+    csv_dir = os.path.join(root, all_data_dir)
+    events_dir = os.path.join(root, original_dir)
+    for directory in (csv_dir, events_dir):
+        os.makedirs(directory, exist_ok=True)
+
+    label_rows = []
+    for subject in range(1, n_subjects + 1):
+        for session in range(1, n_sessions + 1):
+            df, labels = generate_session(subject, session, n_feedback, interval, p_correct=p_correct, seed=seed)
+            session_path = f"{csv_dir}/Data_S{subject:02d}_Sess{session:02d}.csv"
+            df.to_csv(session_path, index=False, float_format='%.4f')
+
+            # create_epochs reads the feedback times from data/allData
+            events_path = f"{events_dir}/Data_S{subject:02d}_Sess{session:02d}.csv"
+            if os.path.abspath(events_path) != os.path.abspath(session_path):
+                if os.path.exists(events_path):
+                    os.remove(events_path)
+                try:
+                    os.link(session_path, events_path)
+                except OSError:
+                    shutil.copyfile(session_path, events_path)
+
+            label_rows += [dict(IdFeedBack=f"S{subject:02d}_Sess{session:02d}_FB{k + 1:03d}", Prediction=label) for k, label in enumerate(labels)]
+            print(f"Wrote {session_path} ({len(df)} samples, {len(labels)} feedback events)")
+
+    pd.DataFrame(label_rows).to_csv(os.path.join(root, feedback_labels_path), index=False)
+    print(f"Synthetic dataset: {n_subjects} subjects x {n_sessions} sessions under {os.path.abspath(root)}")
@@ -0,0 +1,208 @@
+import os
+import time
+import shutil
+import subprocess
+from functools import lru_cache
+import numpy as np
+from scipy.interpolate import CloughTocher2DInterpolator
+import mne
+
+from src.session_executor import run_sessions, print_session_summary, subject_grid, num_sessions
+from src.stage_cache import is_fresh, record_output
+from src.get_erp import evoked_path
+from src.grand_average_state import grand_average_dir
+from src.stats_test import perm_test_path
+from src import metrics
+
+
+# Scalp map animations without animate_topomap: the sensor -> pixel interpolation is linear in the sensor values, so it
+# is computed once as a (n_pixels, n_channels) matrix and every frame is one matrix-vector product with the values at
+# one time point, computed as the frame is sent, so a worker holds one frame at a time. Frames are colour-mapped with a
+# lookup table and streamed to ffmpeg as raw rgb24, no figure is drawn. Subject animations are rendered in parallel over the session executor's processes.
+animation_dir = 'data/animations'
+grand_average_path = f"{grand_average_dir}/grand_averages-ave.fif"
+
+# Head outline, sensors and time bar colours (RGB)
+outline_color = (0, 0, 0)
+background_color = (255, 255, 255)
+
+
+def sensor_positions(info):
+    # 2D positions of the EEG sensors: azimuthal equidistant projection of the 3D montage positions, as MNE's topomaps
+    picks = mne.pick_types(info, eeg=True, exclude='bads')
+    positions = np.array([info['chs'][pick]['loc'][:3] for pick in picks])
+    radius = np.linalg.norm(positions, axis=1)
+    theta = np.arccos(np.clip(positions[:, 2] / radius, -1, 1))
+    phi = np.arctan2(positions[:, 1], positions[:, 0])
+    return picks, np.column_stack([theta * np.cos(phi), theta * np.sin(phi)])
+
+
+# A float32 matrix is ~50 MB at size=512; a couple of layouts per process are all the stages use
+@lru_cache(maxsize=2)
+def _interpolation_matrix(positions_key, size, n_border=64, n_neighbours=3):
+    positions = np.array(positions_key)
+    n_channels = len(positions)
+    centre = positions.mean(axis=0)
+    head_radius = np.linalg.norm(positions - centre, axis=1).max() * 1.08
+
+    # Extra points on the head outline, each the mean of its nearest sensors (the 'local' extrapolation of MNE)
+    angles = np.linspace(0, 2 * np.pi, n_border, endpoint=False)
+    border = centre + head_radius * 1.05 * np.column_stack([np.cos(angles), np.sin(angles)])
+    nearest = np.argsort(np.linalg.norm(border[:, None, :] - positions[None, :, :], axis=2), axis=1)[:, :n_neighbours]
+    border_weights = np.zeros((n_border, n_channels))
+    np.put_along_axis(border_weights, nearest, 1.0 / n_neighbours, axis=1)
+
+    # The Clough-Tocher interpolant is linear in the values: interpolating the unit vectors gives its matrix
+    interpolator = CloughTocher2DInterpolator(np.vstack([positions, border]), np.vstack([np.eye(n_channels), border_weights]))
+    axis = np.linspace(-head_radius, head_radius, size)
+    grid_x, grid_y = np.meshgrid(centre[0] + axis, centre[1] - axis)
+    inside = np.hypot(grid_x - centre[0], grid_y - centre[1]) <= head_radius
+    weights = np.nan_to_num(interpolator(grid_x[inside], grid_y[inside])).astype(np.float32)
+
+    # Overlay pixels: the head outline ring and a small square at every sensor
+    pixel = 2 * head_radius / (size - 1)
+    distance = np.hypot(grid_x - centre[0], grid_y - centre[1])
+    outline = np.abs(distance - head_radius) <= 1.5 * pixel
+    sensor_rows = np.clip(np.round((centre[1] + head_radius - positions[:, 1]) / pixel).astype(int), 0, size - 1)
+    sensor_cols = np.clip(np.round((positions[:, 0] - centre[0] + head_radius) / pixel).astype(int), 0, size - 1)
+    return weights, inside, outline, (sensor_rows, sensor_cols)
+
+
+def interpolation_matrix(info, size=512):
+    # (weights (n_inside_pixels, n_channels), inside mask, outline mask, sensor pixels, EEG picks) for a size x size map
+    picks, positions = sensor_positions(info)
+    positions_key = tuple(map(tuple, np.round(positions, 6)))
+    return _interpolation_matrix(positions_key, size) + (picks,)
+
+
+def colour_table(cmap='RdBu_r', n_colours=256):
+    from matplotlib import colormaps
+    return (colormaps[cmap](np.linspace(0, 1, n_colours))[:, :3] * 255).astype(np.uint8)
+
+
+def render_frames(data, info, size=512, vlim=None, cmap='RdBu_r'):
+    # Yields one (size, size + time bar, 3) uint8 frame per column of data (n_channels, n_times)
+    weights, inside, outline, (sensor_rows, sensor_cols), picks = interpolation_matrix(info, size)
+    sensor_values = np.asarray(data[picks], dtype=np.float32)
+    if vlim is None:
+        # From the sensor values: the interpolated maps stay within them up to a small overshoot, which is clipped
+        limit = float(np.abs(sensor_values).max()) or 1.0
+        vlim = (-limit, limit)
+    table = colour_table(cmap)
+    n_frames = sensor_values.shape[1]
+
+    bar_height = max(size // 64, 4)
+    frame = np.empty((size + bar_height, size, 3), dtype=np.uint8)
+    for k in range(n_frames):
+        values = weights @ sensor_values[:, k]
+        indices = np.clip(((values - vlim[0]) / (vlim[1] - vlim[0]) * (len(table) - 1)).round(), 0, len(table) - 1).astype(np.uint8)
+        frame[:] = background_color
+        scalp = frame[:size]
+        scalp[inside] = table[indices]
+        scalp[outline] = outline_color
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                scalp[np.clip(sensor_rows + dr, 0, size - 1), np.clip(sensor_cols + dc, 0, size - 1)] = outline_color
+        # Progress of the frame time through the epoch
+        frame[size:, :int(round((k + 1) / n_frames * size))] = outline_color
+        yield frame
+
+
+def write_animation(frames, output_path, size, bar_height=None, fps=10):
+    # Pipe raw rgb24 frames into ffmpeg (H.264, yuv420p needs even dimensions so the frame height is padded)
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg not found on PATH, it is needed to encode the animations")
+    height = size + (bar_height or max(size // 64, 4))
+    command = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f"{size}x{height}", '-r', str(fps),
+               '-i', '-', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', output_path]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    n_frames = 0
+    try:
+        for frame in frames:
+            process.stdin.write(frame.tobytes())
+            n_frames += 1
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed writing {output_path}")
+    return n_frames
+
+
+def animate_evoked(evoked, output_path, times=None, size=512, fps=10, vlim=None, cmap='RdBu_r'):
+    ##################################################################
+    #        Scalp map animation of an evoked object to mp4
+    ##################################################################
+    # times: the time points to show (nearest samples), all samples of the evoked by default
+    start = time.perf_counter()
+    sample_indices = np.arange(len(evoked.times)) if times is None else np.unique(np.searchsorted(evoked.times, times).clip(0, len(evoked.times) - 1))
+    data = evoked.data[:, sample_indices]
+    n_frames = write_animation(render_frames(data, evoked.info, size, vlim, cmap), output_path, size, fps=fps)
+    elapsed = time.perf_counter() - start
+    print(f"=====================================> Saved {n_frames} frames to {output_path} in {elapsed:.2f} s ({n_frames / elapsed:.0f} frames/s)")
+    return n_frames
+
+
+def difference_evoked(evokeds):
+    # correct - incorrect from a list of evokeds with those comments
+    by_condition = {evoked.comment: evoked for evoked in evokeds}
+    return mne.combine_evoked([by_condition['correct'], by_condition['incorrect']], [1, -1])
+
+
+def _animate_subject(subject, _session, size, fps, force=False):
+    # Difference wave of the subject: per condition, the average of its session averages
+    input_paths = [evoked_path(subject, session) for session in range(1, num_sessions + 1) if os.path.exists(evoked_path(subject, session))]
+    if not input_paths:
+        print(f"Missing evoked files for Subject {subject}.")
+        return 'skipped'
+
+    output_path = f"{animation_dir}/S{subject:02d}_difference_topo.mp4"
+    params = dict(kind='difference', size=size, fps=fps, interpolation='clough_tocher')
+    if not force and is_fresh(output_path, 'topo_animation', input_paths, params):
+        print(f"Up to date, skipping {output_path}")
+        return 'cached'
+
+    session_evokeds = [mne.read_evokeds(path, verbose='error') for path in input_paths]
+    conditions = {}
+    for condition in ('correct', 'incorrect'):
+        evokeds = [evoked for evokeds in session_evokeds for evoked in evokeds if evoked.comment == condition]
+        if not evokeds:
+            print(f"No {condition} evoked data for Subject {subject}.")
+            return 'skipped'
+        conditions[condition] = mne.grand_average(evokeds)
+        conditions[condition].comment = condition
+    evoked = difference_evoked(list(conditions.values()))
+
+    metrics.add(samples=evoked.data.shape[1])
+    animate_evoked(evoked, output_path, size=size, fps=fps)
+    record_output(output_path, 'topo_animation', input_paths, params)
+
+
+def create_topo_animations(subjects=True, size=512, fps=10, n_jobs=-1, force=False):
+    ##################################################################
+    #     Difference / T-value scalp animations over every sample
+    ##################################################################
+    # Grand average difference wave and cluster test T-values (when computed), then one difference animation per
+    # subject (subjects=False skips those), all written to data/animations
+    if not os.path.exists(animation_dir):
+        os.makedirs(animation_dir)
+
+    if os.path.exists(grand_average_path):
+        output_path = f"{animation_dir}/grand_average_difference_topo.mp4"
+        params = dict(kind='difference', size=size, fps=fps, interpolation='clough_tocher')
+        if force or not is_fresh(output_path, 'topo_animation', [grand_average_path], params):
+            animate_evoked(difference_evoked(mne.read_evokeds(grand_average_path, verbose='error')), output_path, size=size, fps=fps)
+            record_output(output_path, 'topo_animation', [grand_average_path], params)
+
+    if os.path.exists(perm_test_path):
+        output_path = f"{animation_dir}/tval_topo.mp4"
+        params = dict(kind='t_values', size=size, fps=fps, interpolation='clough_tocher')
+        if force or not is_fresh(output_path, 'topo_animation', [perm_test_path], params):
+            animate_evoked(mne.read_evokeds(perm_test_path, verbose='error')[0], output_path, size=size, fps=fps)
+            record_output(output_path, 'topo_animation', [perm_test_path], params)
+
+    if not subjects:
+        return []
+    results = run_sessions(_animate_subject, n_jobs=n_jobs, sessions=subject_grid(), size=size, fps=fps, force=force)
+    print_session_summary('create_topo_animations', results)
+    return results
@@ -0,0 +1,20 @@
+import pytest
+
+from src.synthetic import generate_dataset
+
+
+# Every stage reads and writes under data/ relative to the working directory, so each test runs in its own tmp_path
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('P300_METRICS_PATH', str(tmp_path / 'metrics.jsonl'))
+    return tmp_path
+
+
+@pytest.fixture
+def synthetic_data(workdir):
+    # One subject, two short sessions in the layout of data/allData plus data/AllDataLabels.csv
+    generate_dataset(n_subjects=1, n_sessions=2, n_feedback=20, root='.')
+    return workdir
@@ -0,0 +1,39 @@
+import os
+import numpy as np
+import mne
+
+from src.chunked import ChunkedRaw, save_chunked, _filter_session_chunked
+from src.preprocessing import _filter_session, referenced_dir, filtered_dir
+from tests.test_filter_engine import synthetic_raw
+
+
+def _referenced_session(path=f"{referenced_dir}/Data_S01_Sess01_referenced_raw.fif"):
+    os.makedirs(referenced_dir, exist_ok=True)
+    synthetic_raw(1, 1).save(path, overwrite=True, verbose='error')
+    return path
+
+
+def test_chunked_raw_matches_preloaded(workdir):
+    path = _referenced_session()
+    source = mne.io.read_raw_fif(path, preload=False, verbose='error')
+    chunked = ChunkedRaw(source, lambda raw, start, stop: raw.get_data(start=start, stop=stop))
+    preloaded = mne.io.read_raw_fif(path, preload=True, verbose='error')
+
+    assert chunked.n_times == preloaded.n_times
+    assert np.array_equal(chunked.get_data(), preloaded.get_data())
+    assert np.array_equal(chunked.get_data(start=1000, stop=1234), preloaded.get_data(start=1000, stop=1234))
+
+    # Saved chunk by chunk, read back whole
+    save_chunked(chunked, 'copy_raw.fif', chunk_sec=5)
+    assert np.array_equal(mne.io.read_raw_fif('copy_raw.fif', preload=True, verbose='error').get_data(), preloaded.get_data())
+
+
+def test_chunked_filter_matches_in_memory(workdir):
+    _referenced_session()
+    os.makedirs(filtered_dir)
+    assert _filter_session(1, 1, 1, 40) is None
+    in_memory = mne.io.read_raw_fif(f"{filtered_dir}/Data_S01_Sess01_filtered_raw.fif", preload=True, verbose='error').get_data()
+
+    _filter_session_chunked(1, 1, 1, 40, chunk_sec=5, force=True)
+    chunked = mne.io.read_raw_fif(f"{filtered_dir}/Data_S01_Sess01_filtered_raw.fif", preload=True, verbose='error').get_data()
+    np.testing.assert_allclose(chunked, in_memory, rtol=0, atol=1e-9 * np.abs(in_memory).max())
@@ -0,0 +1,47 @@
+import numpy as np
+import mne
+from scipy import stats
+
+from src.save_original_raw import channel_names
+from src.cluster_engine import cluster_permutation_test, channel_adjacency
+
+
+def _condition_data(n_epochs=30, n_times=25, seed=0):
+    # Two conditions over the EEG channels, the second with a positive effect on the centro-parietal channels
+    ch_names = [name for name in channel_names if name != 'EOG']
+    info = mne.create_info(ch_names, 200, 'eeg')
+    info.set_montage('standard_1020')
+    rng = np.random.default_rng(seed)
+    data_a = rng.normal(size=(n_epochs, len(ch_names), n_times))
+    data_b = rng.normal(size=(n_epochs, len(ch_names), n_times))
+    effect = [ch_names.index(name) for name in ('Cz', 'CPz', 'Pz', 'CP1', 'CP2', 'P1', 'P2')]
+    data_b[:, effect, 10:18] += 1.5
+    return data_a, data_b, info
+
+
+def test_matches_mne_spatio_temporal_cluster_test():
+    data_a, data_b, info = _condition_data()
+    p_threshold = 0.01
+    result = cluster_permutation_test([data_a, data_b], info, p_threshold=p_threshold, n_permutations=200, random_state=0)
+
+    threshold = stats.f.ppf(1 - p_threshold, 1, len(data_a) + len(data_b) - 2)
+    T_obs, clusters, cluster_p_values, _ = mne.stats.spatio_temporal_cluster_test(
+        [data_a.transpose(0, 2, 1), data_b.transpose(0, 2, 1)], threshold=threshold, n_permutations=200, tail=1,
+        adjacency=channel_adjacency(info), out_type='mask', seed=0, verbose='error')
+
+    # Same statistic and the same clusters; p-values come from different permutations, so only the planted effect's
+    # decision is compared
+    assert np.allclose(result['T_obs'], T_obs.T)
+    assert sorted(mask.tobytes() for mask in result['clusters']) == sorted(mask.T.tobytes() for mask in clusters)
+    largest = np.argmax(result['cluster_stats'])
+    mne_largest = [mask.T.tobytes() for mask in clusters].index(result['clusters'][largest].tobytes())
+    assert result['cluster_p_values'][largest] < 0.05
+    assert cluster_p_values[mne_largest] < 0.05
+
+
+def test_result_does_not_depend_on_n_jobs():
+    data_a, data_b, info = _condition_data(seed=1)
+    serial = cluster_permutation_test([data_a, data_b], info, n_permutations=100, chunk_size=20, n_jobs=1, random_state=3)
+    parallel = cluster_permutation_test([data_a, data_b], info, n_permutations=100, chunk_size=20, n_jobs=2, random_state=3)
+    assert np.array_equal(serial['H0'], parallel['H0'])
+    assert np.array_equal(serial['cluster_p_values'], parallel['cluster_p_values'])
@@ -0,0 +1,58 @@
+import numpy as np
+import mne
+
+from src.epochs_store import append_epochs, open_epochs_store, session_fingerprint, compact_epochs_store
+from src.get_erp import create_grand_average
+from src.grand_average_state import grand_average_dir
+
+
+info = mne.create_info(['Fz', 'Cz', 'Pz', 'EOG'], 200, ['eeg', 'eeg', 'eeg', 'eog'])
+event_id = {'incorrect': 1, 'correct': 2}
+
+
+def _session_epochs(seed, n_epochs=12):
+    rng = np.random.default_rng(seed)
+    events = np.column_stack([np.arange(n_epochs) * 400 + 200, np.zeros(n_epochs, dtype=int), np.tile([1, 2], n_epochs // 2)])
+    epochs = mne.EpochsArray(rng.normal(scale=1e-5, size=(n_epochs, 4, 40)), info, events=events, event_id=event_id, tmin=-0.2, verbose='error')
+    return epochs, events
+
+
+def _grand_average_data():
+    return [evoked.data for evoked in mne.read_evokeds(f"{grand_average_dir}/grand_averages-ave.fif", verbose='error')]
+
+
+def test_fingerprint_survives_compaction(workdir):
+    for session in (1, 2, 3):
+        append_epochs(*_session_epochs(session), 1, session, compact_fraction=1.0)
+    append_epochs(*_session_epochs(10), 1, 1, compact_fraction=1.0)
+
+    data, metadata, _ = open_epochs_store()
+    before = {session: session_fingerprint(1, session, data, metadata) for session in (1, 2, 3)}
+    compact_epochs_store()
+    data, metadata, layout = open_epochs_store()
+    after = {session: session_fingerprint(1, session, data, metadata) for session in (1, 2, 3)}
+
+    assert layout['n_rows'] == 36
+    assert before == after
+
+
+def test_replaced_session_after_compaction_matches_full_recompute(workdir):
+    for session in (1, 2):
+        append_epochs(*_session_epochs(session), 1, session)
+    create_grand_average()
+    data, metadata, _ = open_epochs_store()
+    old_fingerprint = session_fingerprint(1, 2, data, metadata)
+
+    # Same events and rejections, new data; replacing the last session of a small store compacts it back onto the
+    # row numbers the session had before
+    append_epochs(*_session_epochs(20), 1, 2)
+    data, metadata, layout = open_epochs_store()
+    assert layout['n_rows'] == 24
+    assert session_fingerprint(1, 2, data, metadata) != old_fingerprint
+
+    create_grand_average()
+    incremental = _grand_average_data()
+    create_grand_average(force=True)
+    recomputed = _grand_average_data()
+    for incremental_data, recomputed_data in zip(incremental, recomputed):
+        assert np.array_equal(incremental_data, recomputed_data)
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import mne
+
+from src.synthetic import generate_session
+from src.save_original_raw import channel_names, channel_types, sampling_rate
+from src.filter_engine import filter_raws, fir_kernel
+from src.session_executor import run_sessions
+from src.preprocessing import _filter_session, referenced_dir, filtered_dir
+
+
+def synthetic_raw(subject=1, session=1, n_feedback=20):
+    df, _ = generate_session(subject, session, n_feedback=n_feedback)
+    df = df.rename(columns={'P08': 'PO8'})
+    info = mne.create_info(channel_names, sampling_rate, channel_types)
+    raw = mne.io.RawArray(df[channel_names].to_numpy().T / 1e6, info, verbose='error')
+    raw.set_montage('standard_1020')
+    return raw
+
+
+def test_fir_matches_raw_filter():
+    raws = [synthetic_raw(1, 1), synthetic_raw(1, 2, n_feedback=15)]
+    expected = [raw.copy().filter(1, 40, method='fir', fir_design='firwin', verbose='error').get_data() for raw in raws]
+
+    # Both sessions in one batch, of different lengths
+    filter_raws(raws, 1, 40, 'fir')
+    for raw, data in zip(raws, expected):
+        np.testing.assert_allclose(raw.get_data(), data, rtol=0, atol=1e-9 * np.abs(data).max())
+        assert raw.info['highpass'] == 1 and raw.info['lowpass'] == 40
+
+
+def test_kernel_is_designed_once():
+    fir_kernel.cache_clear()
+    filter_raws([synthetic_raw(1, 1)], 1, 40, 'fir')
+    filter_raws([synthetic_raw(1, 2)], 1, 40, 'fir')
+    assert fir_kernel.cache_info().misses == 1
+
+
+def test_filter_data_runs_per_session(workdir):
+    # One unreadable session fails on its own, the other session is filtered
+    os.makedirs(referenced_dir)
+    os.makedirs(filtered_dir)
+    synthetic_raw(1, 2).save(f"{referenced_dir}/Data_S01_Sess02_referenced_raw.fif", verbose='error')
+    with open(f"{referenced_dir}/Data_S01_Sess01_referenced_raw.fif", 'wb') as f:
+        f.write(b'not a fif file')
+
+    results = run_sessions(_filter_session, sessions=[(1, 1), (1, 2)], low_freq=1, high_freq=40)
+    assert [result['status'] for result in results] == ['error', 'ok']
+    assert os.path.exists(f"{filtered_dir}/Data_S01_Sess02_filtered_raw.fif")
@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import mne
+
+from src import grand_average_state
+from src.grand_average_state import new_state, add_contribution, remove_contribution, state_averages
+
+
+info = mne.create_info(['Fz', 'Cz', 'Pz', 'EOG'], 200, ['eeg', 'eeg', 'eeg', 'eog'])
+params = dict(weights='equal', accumulator='exact')
+
+
+def _session_evokeds(seed):
+    # Averages with a wide range of magnitudes, so the sums need the exact accumulator
+    rng = np.random.default_rng(seed)
+    return {condition: mne.EvokedArray(rng.normal(size=(4, 50)) * 10.0 ** rng.integers(-9, -3, size=(4, 1)), info, tmin=-0.2,
+                                       nave=20, comment=condition) for condition in ('correct', 'incorrect')}
+
+
+def _fingerprint(seed):
+    return dict(sha256=f"{seed:064x}")
+
+
+def test_incremental_matches_full_recompute(workdir):
+    sessions = {f"S01_Sess{k:02d}": _session_evokeds(k) for k in range(1, 5)}
+    replaced = _session_evokeds(99)
+
+    # Incremental: add all, remove one, replace another
+    state = new_state(params)
+    for key, evokeds in sessions.items():
+        add_contribution(state, key, evokeds, _fingerprint(int(key[-2:])))
+    remove_contribution(state, 'S01_Sess02')
+    remove_contribution(state, 'S01_Sess04')
+    add_contribution(state, 'S01_Sess04', replaced, _fingerprint(99))
+    incremental = state_averages(state)
+
+    # Full recompute from the final set of sessions, in another order
+    final = {'S01_Sess04': replaced, 'S01_Sess03': sessions['S01_Sess03'], 'S01_Sess01': sessions['S01_Sess01']}
+    state = new_state(params)
+    for k, (key, evokeds) in enumerate(final.items()):
+        add_contribution(state, key, evokeds, _fingerprint(100 + k))
+    recomputed = state_averages(state)
+
+    for condition in ('correct', 'incorrect'):
+        assert np.array_equal(incremental[condition].data, recomputed[condition].data)
+        assert incremental[condition].nave == recomputed[condition].nave == 3
+        mean = np.mean([evokeds[condition].data for evokeds in final.values()], axis=0)
+        assert np.allclose(incremental[condition].data, mean, rtol=1e-15, atol=0)
+
+
+def test_state_round_trip(workdir):
+    os.makedirs(grand_average_state.grand_average_dir, exist_ok=True)
+    state = new_state(params)
+    add_contribution(state, 'S01_Sess01', _session_evokeds(1), _fingerprint(1))
+    grand_average_state.save_state(state)
+    loaded = grand_average_state.load_state(params)
+    assert loaded['conditions'] == state['conditions']
+    assert grand_average_state.load_state(dict(params, weights='nave'))['conditions'] == {}
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import mne
+
+from src.precision import set_precision, fif_fmt
+from src.session_executor import run_sessions
+from src.save_original_raw import _save_session_raw, original_raw_dir
+from src.bad_channels import detect_bad_channels
+from src.pipeline import check_precision
+
+
+def _save_sessions():
+    os.makedirs(original_raw_dir)
+    run_sessions(_save_session_raw, sessions=[(1, 1), (1, 2)], force=True)
+
+
+def test_single_precision_storage(synthetic_data, monkeypatch):
+    _save_sessions()
+    double = mne.io.read_raw_fif(f"{original_raw_dir}/Data_S01_Sess01_raw.fif", preload=True, verbose='error')
+
+    monkeypatch.setenv('P300_PRECISION', 'double')
+    set_precision('single')
+    try:
+        assert fif_fmt() == 'single'
+        path = f"{original_raw_dir}/Data_S01_Sess01_single_raw.fif"
+        double.save(path, fmt=fif_fmt())
+    finally:
+        set_precision('double')
+
+    single = mne.io.read_raw_fif(path, preload=True, verbose='error')
+    assert os.path.getsize(path) < 0.6 * os.path.getsize(f"{original_raw_dir}/Data_S01_Sess01_raw.fif")
+    assert np.allclose(single.get_data(), double.get_data(), rtol=1e-6, atol=0)
+
+
+def test_check_precision_deviation(synthetic_data):
+    _save_sessions()
+    detect_bad_channels(source='raw')
+
+    results = check_precision(1, 1, low_freq=1, high_freq=40, n_components=15, random_state=97)
+
+    # Rounding every intermediate to float32 stays far below the amplifier's resolution (volts)
+    assert results['rereference'] < 1e-9
+    assert results['filter'] < 1e-9
+    for stage in ('ica', 'epochs', 'evoked correct', 'evoked incorrect'):
+        assert results[stage] is None or results[stage] < 1e-7
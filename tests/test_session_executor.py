@@ -0,0 +1,36 @@
+import os
+import numpy as np
+import mne
+
+from src.session_executor import run_sessions
+from src.save_original_raw import _save_session_raw, original_raw_dir
+
+
+sessions = [(1, 1), (1, 2)]
+
+
+def _saved_data():
+    return {(i, j): mne.io.read_raw_fif(f"{original_raw_dir}/Data_S{i:02d}_Sess{j:02d}_raw.fif", preload=True, verbose='error').get_data()
+            for i, j in sessions}
+
+
+def test_parallel_matches_serial(synthetic_data):
+    os.makedirs(original_raw_dir)
+    serial = run_sessions(_save_session_raw, n_jobs=1, sessions=sessions, force=True)
+    serial_data = _saved_data()
+    parallel = run_sessions(_save_session_raw, n_jobs=2, sessions=sessions, force=True)
+    parallel_data = _saved_data()
+
+    assert [(r['subject'], r['session'], r['status']) for r in parallel] == [(r['subject'], r['session'], r['status']) for r in serial]
+    for key in sessions:
+        assert np.array_equal(parallel_data[key], serial_data[key])
+
+
+def test_failing_session_does_not_stop_the_others(synthetic_data):
+    os.makedirs(original_raw_dir)
+    with open("data/allData/original/Data_S01_Sess01.csv", 'w') as f:
+        f.write("not,a,session\n")
+
+    results = run_sessions(_save_session_raw, n_jobs=2, sessions=sessions + [(1, 3)], force=True)
+    assert [r['status'] for r in results] == ['error', 'ok', 'skipped']
+    assert os.path.exists(f"{original_raw_dir}/Data_S01_Sess02_raw.fif")